@@ -0,0 +1,229 @@
+import argparse
+import csv
+import logging
+import multiprocessing
+import os
+import sys
+import time
+
+import pandas as pd
+
+import core
+
+logger = logging.getLogger(__name__)
+
+OUTPUT_COLUMNS = [
+    "job",
+    "destinations",
+    "active_days",
+    "relevant_hours",
+    "parent_station",
+    "stop_name",
+    "stop_lat",
+    "stop_lon",
+    "min_routes",
+    "total_routes",
+]
+
+# set in the parent before the pool forks, the workers share it copy-on-write
+_feed = None
+_station_index = None
+
+
+class JobError(ValueError):
+    pass
+
+
+def read_jobs(path):
+    """Read the job CSV.
+
+    Columns: `destinations` (stop ids or names separated by `;`), optional
+    `id`, `weekdays` (separated by `;`), `hours` (`6-22`) and `exclude`
+    (route ids separated by `;`). A row which can not be parsed becomes a
+    job with an `error`, the other rows still run.
+    """
+    jobs = pd.read_csv(path, dtype=str).fillna("")
+    for index, row in enumerate(jobs.to_dict(orient="records")):
+        job = {
+            "job": row.get("id") or str(index),
+            "destinations": _split(row["destinations"]),
+            "active_days": core.WEEKDAYS[:5],
+            "relevant_hours": (6, 22),
+            "excluded": _split(row.get("exclude", "")),
+        }
+        try:
+            job["active_days"] = _weekdays(row.get("weekdays", "")) or core.WEEKDAYS[:5]
+            job["relevant_hours"] = _hours(row.get("hours") or "6-22")
+        except JobError as error:
+            job["error"] = str(error)
+        yield job
+
+
+def _split(value):
+    return [part.strip() for part in value.split(";") if part.strip()]
+
+
+def _weekdays(value):
+    days = [day.capitalize() for day in _split(value)]
+    unknown = [day for day in days if day not in core.WEEKDAYS]
+    if unknown:
+        raise JobError(f"weekdays must be weekday names, not {', '.join(unknown)}")
+    return days
+
+
+def _hours(value):
+    try:
+        lower, upper = (int(hour) for hour in value.split("-"))
+    except ValueError:
+        raise JobError(f"hours must be two hours like 6-22, not {value!r}")
+    if not 0 <= lower <= upper <= 23:
+        raise JobError(f"hours must be ordered and between 0 and 23, not {value!r}")
+    return (lower, upper)
+
+
+def _resolve(destinations):
+    if not destinations:
+        raise JobError("no destinations")
+    station_ids = [_station_index.resolve(name) for name in destinations]
+    unresolved = [
+        name for name, station_id in zip(destinations, station_ids) if not station_id
+    ]
+    if unresolved:
+        raise JobError(f"unknown destinations {', '.join(unresolved)}")
+    return station_ids
+
+
+def triangulate(job):
+    """The job id, candidates, duration and the error the job failed with.
+
+    A failed job has no candidates, the other jobs go on.
+    """
+    start = time.perf_counter()
+    candidates, error = pd.DataFrame(columns=OUTPUT_COLUMNS), None
+    try:
+        candidates = _triangulate(job)
+    except JobError as job_error:
+        error = str(job_error)
+    except Exception as job_error:
+        # raised in a worker it would end the whole run
+        logger.exception("job %s failed", job["job"])
+        error = repr(job_error)
+    return job["job"], candidates, time.perf_counter() - start, error
+
+
+def _triangulate(job):
+    if "error" in job:
+        raise JobError(job["error"])
+    destination_stops = []
+    for station_id in _resolve(job["destinations"]):
+        routes = core.get_routes(_feed, station_id)
+        destination_stops.append(
+            core.get_stops(
+                _feed,
+                routes.loc[~routes["route_id"].isin(job["excluded"])]["route_id"],
+                job["active_days"],
+                job["relevant_hours"],
+            )
+        )
+
+    candidates = core.rank_candidates(destination_stops).assign(
+        job=job["job"],
+        destinations=";".join(job["destinations"]),
+        active_days=";".join(job["active_days"]),
+        relevant_hours="-".join(map(str, job["relevant_hours"])),
+    )
+    return candidates[OUTPUT_COLUMNS]
+
+
+class ResultWriter:
+    """Appends result chunks to a CSV or Parquet file as they arrive."""
+
+    def __init__(self, path):
+        self.path = path
+        self.parquet = path.endswith(".parquet")
+        self._writer = None
+        self._file = None
+
+    def write(self, frame):
+        if self.parquet:
+            import pyarrow
+            import pyarrow.parquet
+
+            table = pyarrow.Table.from_pandas(frame, preserve_index=False)
+            if self._writer is None:
+                self._writer = pyarrow.parquet.ParquetWriter(self.path, table.schema)
+            self._writer.write_table(table.cast(self._writer.schema))
+        else:
+            if self._writer is None:
+                self._file = open(self.path, "w", newline="")
+                self._writer = csv.writer(self._file)
+                self._writer.writerow(OUTPUT_COLUMNS)
+            self._writer.writerows(frame.itertuples(index=False))
+            self._file.flush()
+
+    def close(self):
+        if self._writer is None:
+            # no job produced anything, still leave a valid empty file behind
+            self.write(pd.DataFrame(columns=OUTPUT_COLUMNS))
+        if self.parquet:
+            self._writer.close()
+        else:
+            self._file.close()
+
+
+def run(jobs_path, output_path, feed_path=core.FEED_PATH, processes=None):
+    global _feed, _station_index
+    # loaded before the fork, the workers do not get the loading thread
+    _feed = core.load_feed(feed_path, lazy=False)
+    _station_index = core.station_index(_feed)
+
+    jobs = list(read_jobs(jobs_path))
+    processes = processes or os.cpu_count()
+    writer = ResultWriter(output_path)
+    start = time.perf_counter()
+    # a few chunks per worker keep them busy without too much inter process traffic
+    chunksize = max(1, len(jobs) // (processes * 4))
+    failed = {}
+    # fork shares the loaded feed with the workers without pickling it
+    with multiprocessing.get_context("fork").Pool(processes) as pool:
+        for done, (job_id, candidates, duration, error) in enumerate(
+            pool.imap_unordered(triangulate, jobs, chunksize), 1
+        ):
+            if error is not None:
+                failed[job_id] = error
+                logger.error("job %s failed: %s", job_id, error)
+            elif len(candidates):
+                writer.write(candidates)
+            logger.debug("job %d/%d took %.3f s", done, len(jobs), duration)
+    writer.close()
+
+    elapsed = time.perf_counter() - start
+    logger.info(
+        "%d jobs (%d failed) on %d processes in %.2f s (%.1f jobs/s)",
+        len(jobs),
+        len(failed),
+        processes,
+        elapsed,
+        len(jobs) / elapsed if elapsed else 0,
+    )
+    return elapsed, failed
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Triangulate many destination sets in parallel."
+    )
+    parser.add_argument("jobs", help="CSV with a destinations column")
+    parser.add_argument("output", help="result file, .csv or .parquet")
+    parser.add_argument("--feed", default=core.FEED_PATH)
+    parser.add_argument("--processes", type=int, default=None)
+    parser.add_argument("--verbose", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
+    _, failed = run(args.jobs, args.output, args.feed, args.processes)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,149 @@
+import argparse
+import json
+import resource
+import statistics
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+BACKENDS = ["pandas", "sqlite", "parquet"]
+
+
+def rss_mb():
+    # the current resident memory, ru_maxrss is only the peak
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def _latency(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, (time.perf_counter() - start) * 1000
+
+
+def _summary(latencies):
+    return {
+        "median_ms": statistics.median(latencies),
+        "max_ms": max(latencies),
+    }
+
+
+def run(backend, path, count):
+    """Latency of the uncached queries and memory of one backend."""
+    sys.path.insert(0, str(ROOT))
+    import core
+
+    start = time.perf_counter()
+    # loaded right away, a lazy feed would charge the load to the first query
+    feed = core.load_feed(path, backend=backend, lazy=False)
+    load_seconds = time.perf_counter() - start
+    loaded_rss = rss_mb()
+
+    stations = core.parse_stations(feed)["stop_id"].tolist()
+    stations = stations[:: max(len(stations) // count, 1)][:count]
+    days = core.WEEKDAYS[:5]
+    hours = (6, 9)
+    latencies = {"get_routes": [], "get_stops": [], "find_shared": []}
+    previous = None
+    for station_id in stations:
+        # the undecorated functions, the cache would hide the backend
+        routes, latency = _latency(core.get_routes.__wrapped__, feed, station_id)
+        latencies["get_routes"].append(latency)
+        stops, latency = _latency(
+            core.get_stops.__wrapped__, feed, routes["route_id"], days, hours
+        )
+        latencies["get_stops"].append(latency)
+        if previous is not None:
+            _, latency = _latency(core.find_shared, previous, stops)
+            latencies["find_shared"].append(latency)
+        previous = stops
+
+    return {
+        "backend": backend,
+        "stations": len(stations),
+        "load_s": load_seconds,
+        "loaded_rss_mb": loaded_rss,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        **{name: _summary(values) for name, values in latencies.items() if values},
+    }
+
+
+def measure(backend, path, count):
+    # every backend in its own process, the memory of one does not count for
+    # the other
+    result = subprocess.run(
+        [
+            sys.executable,
+            "-m",
+            "benchmarks.backends",
+            "--child",
+            backend,
+            "--feed",
+            str(Path(path).resolve()),
+            "--stations",
+            str(count),
+        ],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return json.loads(result.stdout.splitlines()[-1])
+
+
+def report(measurement):
+    lines = [
+        f"{measurement['backend']}: loaded in {measurement['load_s']:.1f} s,"
+        f" {measurement['loaded_rss_mb']:.0f} MB resident,"
+        f" {measurement['peak_rss_mb']:.0f} MB peak"
+    ]
+    for name in ("get_routes", "get_stops", "find_shared"):
+        if name in measurement:
+            lines.append(
+                f"  {name:12} {measurement[name]['median_ms']:8.1f} ms median"
+                f" {measurement[name]['max_ms']:8.1f} ms max"
+            )
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Query latency and memory of the feed backends."
+    )
+    parser.add_argument(
+        "backends", nargs="*", default=BACKENDS, help=", ".join(BACKENDS)
+    )
+    parser.add_argument("--feed", default=str(ROOT / "gtfs.zip"))
+    parser.add_argument("--stations", type=int, default=50)
+    parser.add_argument("--json", help="write the measurements to this file")
+    parser.add_argument("--child", choices=BACKENDS, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        print(json.dumps(run(args.child, args.feed, args.stations)))
+        return
+
+    measurements = []
+    # checked here, argparse does not take choices for an optional list
+    unknown = [backend for backend in args.backends if backend not in BACKENDS]
+    if unknown:
+        parser.error(f"unknown backends {', '.join(unknown)}")
+
+    for backend in args.backends:
+        # the first run builds the database, it is measured once it exists
+        if backend != "pandas":
+            measure(backend, args.feed, 1)
+        measurements.append(measure(backend, args.feed, args.stations))
+        print(report(measurements[-1]))
+
+    if args.json:
+        Path(args.json).write_text(json.dumps(measurements, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+import argparse
+import json
+import subprocess
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+# cold import budgets in milliseconds, core has to stay usable in worker processes
+# and the app modules must not hold up the first render with the map libraries
+BUDGETS = {"core": 800, "rendering": 600}
+# processing is the Streamlit adapter and cannot load without it, its budget is
+# streamlit's own import measured in the same run plus what the app modules may
+# add on top: 60-120 ms were measured (958 against 842 ms on one machine, 560
+# against 533 ms on another), 250 ms leaves room for about twice that
+RELATIVE_BUDGETS = {"processing": ("streamlit", 250)}
+
+
+def measure(module):
+    # -X importtime writes one line per imported module to stderr
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        self_us, cumulative_us, name = line.removeprefix("import time:").split("|")
+        imports.append(
+            {
+                "module": name.strip(),
+                "depth": (len(name) - len(name.lstrip())) // 2,
+                "self_ms": int(self_us) / 1000,
+                "cumulative_ms": int(cumulative_us) / 1000,
+            }
+        )
+    # interpreter startup (site, encodings) is reported separately
+    total = next(
+        entry["cumulative_ms"]
+        for entry in imports
+        if entry["module"] == module and entry["depth"] == 0
+    )
+    return {"module": module, "total_ms": total, "imports": imports}
+
+
+def report(measurement, top=10, budget=None):
+    lines = [f"{measurement['module']}: {measurement['total_ms']:.0f} ms"]
+    if budget is not None:
+        lines[0] += f" (budget {budget} ms)"
+    heaviest = sorted(
+        (entry for entry in measurement["imports"] if entry["depth"] <= 1),
+        key=lambda entry: entry["cumulative_ms"],
+        reverse=True,
+    )
+    for entry in heaviest[:top]:
+        lines.append(f"  {entry['cumulative_ms']:8.1f} ms  {entry['module']}")
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Cold import time of the modules.")
+    parser.add_argument("modules", nargs="*", default=[*BUDGETS, *RELATIVE_BUDGETS])
+    parser.add_argument("--top", type=int, default=10)
+    parser.add_argument("--json", help="write the measurements to this file")
+    args = parser.parse_args()
+
+    measurements = [measure(module) for module in args.modules]
+    baselines = {}
+    over_budget = False
+    for measurement in measurements:
+        budget = BUDGETS.get(measurement["module"])
+        if measurement["module"] in RELATIVE_BUDGETS:
+            baseline, allowance = RELATIVE_BUDGETS[measurement["module"]]
+            if baseline not in baselines:
+                baselines[baseline] = measure(baseline)["total_ms"]
+            budget = round(baselines[baseline] + allowance)
+        print(report(measurement, args.top, budget))
+        over_budget |= budget is not None and measurement["total_ms"] > budget
+
+    if args.json:
+        Path(args.json).write_text(json.dumps(measurements, indent=2))
+    sys.exit(1 if over_budget else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,400 @@
+import argparse
+import json
+import resource
+import subprocess
+import sys
+import time
+import warnings
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+from benchmarks.backends import rss_mb
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# one interaction sequence of a user, every step reruns the script
+ACTIONS = ["load", "pick_a", "pick_b", "exclude", "hours", "click_route"]
+PERCENTILES = [50, 90, 99]
+
+
+class Session:
+    """The widget values of one simulated user of main.py."""
+
+    def __init__(self, station_ids, random):
+        self.station_ids = station_ids
+        self.random = random
+        # a few stations are picked far more often than the rest
+        weights = 1 / np.arange(1, len(station_ids) + 1)
+        self.weights = weights / weights.sum()
+        self.reset()
+
+    def reset(self):
+        self.station_a = None
+        self.station_b = None
+        self.excluded = []
+        self.days = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday"]
+        self.hours = (6, 22)
+        self.route_id = None
+
+    def _station(self):
+        return self.station_ids[
+            self.random.choice(len(self.station_ids), p=self.weights)
+        ]
+
+    def act(self, action, routes, stops):
+        """Change the widgets like `action` would, `routes` and `stops` are the
+        results of the previous rerun."""
+        if action == "load":
+            self.reset()
+        elif action == "pick_a":
+            self.station_a = self._station()
+        elif action == "pick_b":
+            self.station_b = self._station()
+        elif action == "exclude" and len(routes):
+            route_id = routes[self.random.integers(len(routes))]
+            # toggles, a route picked twice is included again
+            if route_id in self.excluded:
+                self.excluded.remove(route_id)
+            else:
+                self.excluded.append(route_id)
+        elif action == "hours":
+            lower = int(self.random.integers(0, 20))
+            self.hours = (lower, int(self.random.integers(lower + 1, 24)))
+        elif action == "click_route" and len(stops):
+            self.route_id = stops[self.random.integers(len(stops))]
+
+
+class DirectTarget:
+    """Does the work of one rerun of main.py with core and rendering.
+
+    The Streamlit widgets and the websocket are left out, the maps are
+    serialized to HTML like streamlit_folium does.
+    """
+
+    def __init__(self, feed_path):
+        sys.path.insert(0, str(ROOT))
+        import core
+        import rendering
+        from cache import LRUCache
+
+        # folium warns about the basemap on every map
+        warnings.filterwarnings("ignore", "CartoDB tiles", UserWarning)
+        self.core = core
+        self.rendering = rendering
+        self.feed = core.load_feed(feed_path, lazy=False)
+        # shared by the sessions of a worker, like the cache_resource one
+        self.layers = LRUCache(rendering.LAYER_CACHE_MAX_BYTES)
+
+    def station_ids(self):
+        return self.core.parse_stations(self.feed)["stop_id"].tolist()
+
+    def _layers(self, station_id, session, routes, stops, style):
+        key = lambda style_key: self.rendering.layer_key(  # noqa: E731
+            self.core.feed_version(self.feed),
+            station_id,
+            session.days,
+            session.hours,
+            routes.loc[routes["route_id"].isin(session.excluded)]["route_id"],
+            style_key,
+        )
+        return self.rendering.draw_destination_layers(self.layers, key, stops, *style)
+
+    def rerun(self, session):
+        core = self.core
+        rendering = self.rendering
+        station_ids = [session.station_a, session.station_b]
+        (routes_a, routes_b), _ = core.get_routes_concurrently(self.feed, station_ids)
+        (stops_a, stops_b), _ = core.get_stops_concurrently(
+            self.feed,
+            [
+                routes.loc[~routes["route_id"].isin(session.excluded)]["route_id"]
+                for routes in (routes_a, routes_b)
+            ],
+            session.days,
+            session.hours,
+        )
+        shared = core.find_shared(stops_a, stops_b)
+        layers = [
+            self._layers(station_id, session, routes, stops, style)
+            for station_id, routes, stops, style in zip(
+                station_ids,
+                (routes_a, routes_b),
+                (stops_a, stops_b),
+                rendering.DESTINATION_STYLES,
+            )
+        ]
+
+        main_map = rendering.new_map()
+        for name in ("routes", "stations"):
+            for destination in layers:
+                destination[name].add_to(main_map)
+        rendering.draw_stations(shared, "#fc8d59", "square").add_to(main_map)
+        main_map.get_root().add_child(rendering.generate_main_legend())
+        rendering.payload_size(main_map)
+        for destination in layers:
+            mini_map = rendering.new_map()
+            destination["mini_routes"].add_to(mini_map)
+            destination["mini_stations"].add_to(mini_map)
+            rendering.payload_size(mini_map)
+
+        if session.route_id is not None:
+            selected_route = core.get_stops(
+                self.feed, [session.route_id], session.days, session.hours
+            )
+            chart_data, time_data = core.route_details(
+                selected_route, shared["parent_station"]
+            )
+            rendering.draw_route_detail(chart_data, time_data).to_json()
+
+        routes = np.union1d(routes_a["route_id"], routes_b["route_id"])
+        return routes, stops_a["route_id"].unique()
+
+
+class HttpTarget:
+    """The same interactions as calls to the query API of `server.py`."""
+
+    def __init__(self, url):
+        sys.path.insert(0, str(ROOT))
+        from client import QueryClient
+
+        self.client = QueryClient(url)
+
+    def station_ids(self):
+        return self.client.get_stations()["stop_id"].tolist()
+
+    def rerun(self, session):
+        routes = [
+            self.client.get_routes(station_id)["route_id"]
+            for station_id in (session.station_a, session.station_b)
+            if station_id is not None
+        ]
+        stops = []
+        if len(routes) == 2:
+            self.client.get_shared(
+                [session.station_a, session.station_b],
+                session.excluded,
+                session.days,
+                session.hours,
+            )
+        if routes:
+            stops = self.client.get_stops(routes[0], session.days, session.hours)
+            # no stops come back without columns
+            stops = stops["route_id"].unique() if len(stops) else []
+        if session.route_id is not None:
+            self.client.get_stops([session.route_id], session.days, session.hours)
+        routes = np.unique(np.concatenate(routes)) if routes else []
+        return routes, stops
+
+
+def _session(target, station_ids, seed, iterations, think, records):
+    random = np.random.default_rng(seed)
+    session = Session(station_ids, random)
+    routes, stops = [], []
+    for _ in range(iterations):
+        for action in ACTIONS:
+            session.act(action, routes, stops)
+            start = time.perf_counter()
+            routes, stops = target.rerun(session)
+            records.append((action, (time.perf_counter() - start) * 1000))
+            if think:
+                # the user looks at the result before the next interaction
+                time.sleep(random.exponential(think))
+
+
+def run_worker(target, sessions, iterations, think, seed, pid=None):
+    """Run `sessions` concurrent sessions in threads, like one Streamlit process.
+
+    Returns the latencies of the reruns, the wall time and the memory of the
+    worker and of the server process `pid`.
+    """
+    start = time.perf_counter()
+    target = HttpTarget(target) if target.startswith("http") else DirectTarget(target)
+    setup_seconds = time.perf_counter() - start
+    station_ids = target.station_ids()
+    loaded_rss = rss_mb()
+
+    records = []
+    start = time.perf_counter()
+    with ThreadPoolExecutor(sessions, "session") as executor:
+        futures = [
+            executor.submit(
+                _session,
+                target,
+                station_ids,
+                seed * 1000 + number,
+                iterations,
+                think,
+                records,
+            )
+            for number in range(sessions)
+        ]
+        # a failed session fails the worker
+        for future in futures:
+            future.result()
+    return {
+        "setup_s": setup_seconds,
+        "wall_s": time.perf_counter() - start,
+        "loaded_rss_mb": loaded_rss,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "server_rss_mb": server_rss_mb(pid) if pid else None,
+        "records": records,
+    }
+
+
+def server_rss_mb(pid):
+    with open(f"/proc/{pid}/status") as status:
+        for line in status:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) / 1024
+    return None
+
+
+def run(target, workers, sessions, iterations, think, seed, pid=None):
+    # the workers start at the same time, each in its own process
+    processes = [
+        subprocess.Popen(
+            [
+                sys.executable,
+                "-m",
+                "benchmarks.load",
+                target if target.startswith("http") else str(Path(target).resolve()),
+                "--child",
+                str(seed + number),
+                "--sessions",
+                str(sessions),
+                "--iterations",
+                str(iterations),
+                "--think",
+                str(think),
+                *(["--pid", str(pid)] if pid else []),
+            ],
+            cwd=ROOT,
+            stdout=subprocess.PIPE,
+            text=True,
+        )
+        for number in range(workers)
+    ]
+    results = []
+    for process in processes:
+        output, _ = process.communicate()
+        if process.returncode:
+            raise RuntimeError(f"worker failed with exit code {process.returncode}")
+        results.append(json.loads(output.splitlines()[-1]))
+    return results
+
+
+def _percentiles(latencies):
+    values = np.percentile(latencies, PERCENTILES)
+    return {f"p{p}_ms": float(value) for p, value in zip(PERCENTILES, values)}
+
+
+def summarize(results):
+    records = [record for result in results for record in result["records"]]
+    # the workers run side by side, the slowest one sets the duration
+    wall = max(result["wall_s"] for result in results)
+    return {
+        "reruns": len(records),
+        "reruns_per_s": len(records) / wall if wall else 0,
+        "all": _percentiles([latency for _, latency in records]),
+        **{
+            action: _percentiles(
+                [latency for name, latency in records if name == action]
+            )
+            for action in ACTIONS
+        },
+        "workers": [
+            {
+                key: result[key]
+                for key in (
+                    "setup_s",
+                    "wall_s",
+                    "loaded_rss_mb",
+                    "peak_rss_mb",
+                    "server_rss_mb",
+                )
+            }
+            for result in results
+        ],
+    }
+
+
+def report(summary):
+    lines = [
+        f"{summary['reruns']} reruns, {summary['reruns_per_s']:.1f} reruns/s",
+        f"{'action':12} {'p50':>10} {'p90':>10} {'p99':>10}",
+    ]
+    for action in ["all", *ACTIONS]:
+        values = summary[action]
+        lines.append(
+            f"{action:12}"
+            + "".join(f" {values[f'p{p}_ms']:7.1f} ms" for p in PERCENTILES)
+        )
+    for number, worker in enumerate(summary["workers"]):
+        line = (
+            f"worker {number}: {worker['loaded_rss_mb']:.0f} MB loaded,"
+            f" {worker['peak_rss_mb']:.0f} MB peak"
+        )
+        if worker["server_rss_mb"] is not None:
+            line += f", server {worker['server_rss_mb']:.0f} MB"
+        lines.append(line)
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Simulate concurrent dashboard sessions and measure the reruns."
+    )
+    parser.add_argument(
+        "target",
+        nargs="?",
+        default=str(ROOT / "gtfs.zip"),
+        help="a feed to run the processing directly on, or the URL of a query API",
+    )
+    parser.add_argument("--workers", type=int, default=1, help="processes")
+    parser.add_argument(
+        "--sessions", type=int, default=4, help="concurrent sessions per worker"
+    )
+    parser.add_argument(
+        "--iterations", type=int, default=3, help="interaction sequences per session"
+    )
+    parser.add_argument(
+        "--think", type=float, default=0, help="mean seconds between interactions"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--pid", type=int, help="also measure this server process")
+    parser.add_argument("--json", help="write the summary to this file")
+    parser.add_argument("--child", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child is not None:
+        result = run_worker(
+            args.target,
+            args.sessions,
+            args.iterations,
+            args.think,
+            args.child,
+            args.pid,
+        )
+        print(json.dumps(result))
+        return
+
+    summary = summarize(
+        run(
+            args.target,
+            args.workers,
+            args.sessions,
+            args.iterations,
+            args.think,
+            args.seed,
+            args.pid,
+        )
+    )
+    print(report(summary))
+    if args.json:
+        Path(args.json).write_text(json.dumps(summary, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,276 @@
+import argparse
+import json
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+import zipfile
+from datetime import datetime, timezone
+from pathlib import Path
+
+from benchmarks import import_time
+
+ROOT = Path(__file__).resolve().parent.parent
+
+DAYS = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday"]
+HOURS = (6, 22)
+
+
+def _frame_size(frame):
+    return {"rows": len(frame), "bytes": int(frame.memory_usage(deep=True).sum())}
+
+
+def _feed_size(feed):
+    tables = [
+        getattr(feed, name)
+        for name in ("routes", "trips", "stops", "calendar", "calendar_dates")
+        if getattr(feed, name) is not None
+    ]
+    timetable = getattr(feed, "timetable", None)
+    return {
+        "rows": sum(len(table) for table in tables),
+        "bytes": sum(_frame_size(table)["bytes"] for table in tables)
+        + (
+            timetable.memory_usage()
+            if timetable is not None
+            else _frame_size(feed.stop_times)["bytes"]
+        ),
+    }
+
+
+def _layer_size(layer):
+    return {"bytes": sum(len(part.encode()) for part in layer.to_fragment()[1:])}
+
+
+def measure(name, function, size, repeat):
+    """Wall time of `repeat` calls, peak memory of one more and the result size.
+
+    The peak is what tracemalloc sees, the Python and numpy allocations.
+    """
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        durations.append((time.perf_counter() - start) * 1000)
+    # traced separately, tracemalloc slows the calls down
+    tracemalloc.start()
+    function()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return {
+        "name": name,
+        "min_ms": min(durations),
+        "median_ms": statistics.median(durations),
+        "peak_kb": peak / 1024,
+        "output": size(result),
+    }
+
+
+def station_pairs(feed, count):
+    """The best connected stations paired up, the same for the same feed."""
+    import core
+
+    stations = core.parse_stations(feed)["stop_id"]
+    platforms = feed.stops.loc[feed.stops["parent_station"].isin(stations)]
+    stop_routes = core.stop_times_of(feed, times=None)[["trip_id", "stop_id"]].merge(
+        feed.trips[["trip_id", "route_id"]], on="trip_id"
+    )
+    route_counts = (
+        stop_routes.merge(platforms[["stop_id", "parent_station"]], on="stop_id")
+        .groupby("parent_station")["route_id"]
+        .nunique()
+        .sort_values(ascending=False, kind="stable")
+    )
+    hubs = route_counts.index[: count + 1].tolist()
+    return [(hubs[i], hubs[i + 1]) for i in range(min(count, len(hubs) - 1))]
+
+
+def run(feed_path, pairs, repeat):
+    sys.path.insert(0, str(ROOT))
+    import core
+    import rendering
+
+    results = []
+    results.append(
+        measure(
+            "load_feed",
+            lambda: core.load_feed(feed_path, lazy=False),
+            _feed_size,
+            1,
+        )
+    )
+    feed = core.load_feed(feed_path, lazy=False)
+    results.append(
+        measure(
+            "parse_stations",
+            lambda: core.parse_stations.__wrapped__(feed),
+            _frame_size,
+            repeat,
+        )
+    )
+
+    # the undecorated functions, the cache would only measure a lookup
+    for station_a, station_b in station_pairs(feed, pairs):
+        case = []
+        stops = []
+        for station_id in (station_a, station_b):
+            routes = core.get_routes.__wrapped__(feed, station_id)
+            case.append(
+                measure(
+                    "get_routes",
+                    lambda: core.get_routes.__wrapped__(feed, station_id),
+                    _frame_size,
+                    repeat,
+                )
+            )
+            stops.append(
+                core.get_stops.__wrapped__(feed, routes["route_id"], DAYS, HOURS)
+            )
+            case.append(
+                measure(
+                    "get_stops",
+                    lambda: core.get_stops.__wrapped__(
+                        feed, routes["route_id"], DAYS, HOURS
+                    ),
+                    _frame_size,
+                    repeat,
+                )
+            )
+        shared = core.find_shared(*stops)
+        case.append(
+            measure(
+                "find_shared",
+                lambda: core.find_shared(*stops),
+                _frame_size,
+                repeat,
+            )
+        )
+        # the longest route of A, like a route clicked on the map
+        route_id = stops[0]["route_id"].value_counts().index[0]
+        selected_route = core.get_stops.__wrapped__(feed, [route_id], DAYS, HOURS)
+        case.append(
+            measure(
+                "route_details",
+                lambda: core.route_details(selected_route, shared["parent_station"]),
+                lambda result: _frame_size(result[0]) | {"rows_time": len(result[1])},
+                repeat,
+            )
+        )
+        case.append(
+            measure(
+                "draw_routes",
+                lambda: rendering.draw_routes(stops[0], "plasma"),
+                _layer_size,
+                repeat,
+            )
+        )
+        case.append(
+            measure(
+                "draw_stations",
+                lambda: rendering.draw_stations(stops[0], "#ffffbf"),
+                _layer_size,
+                repeat,
+            )
+        )
+        for result in case:
+            result["case"] = f"{station_a} {station_b}"
+        results.extend(case)
+    return feed, results
+
+
+def _commit():
+    result = subprocess.run(
+        ["git", "rev-parse", "--short", "HEAD"],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+    )
+    return result.stdout.strip() or None
+
+
+def summarize(results):
+    # per benchmark over all station pairs
+    names = list(dict.fromkeys(result["name"] for result in results))
+    return {
+        name: {
+            key: statistics.median(
+                result[key] for result in results if result["name"] == name
+            )
+            for key in ("min_ms", "median_ms", "peak_kb")
+        }
+        for name in names
+    }
+
+
+def report(summary, previous=None):
+    lines = [f"{'benchmark':16} {'median':>10} {'peak':>10}"]
+    for name, values in summary.items():
+        line = (
+            f"{name:16} {values['median_ms']:8.2f} ms"
+            f" {values['peak_kb'] / 1024:7.1f} MB"
+        )
+        if previous and name in previous:
+            before = previous[name]["median_ms"]
+            line += f"  {values['median_ms'] / before if before else 0:5.2f}x"
+        lines.append(line)
+    return "\n".join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Wall time, peak memory and output size of the hot paths."
+    )
+    parser.add_argument("--feed", default=str(ROOT / "gtfs.zip"))
+    parser.add_argument("--pairs", type=int, default=5, help="station pairs")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--json", help="write the results to this file")
+    parser.add_argument("--compare", help="results of an earlier run to compare to")
+    parser.add_argument(
+        "--imports", action="store_true", help="also measure the cold import times"
+    )
+    args = parser.parse_args()
+
+    if not zipfile.is_zipfile(args.feed) and not Path(args.feed).is_dir():
+        # the bundled gtfs.zip is a git LFS pointer unless it was pulled
+        parser.error(
+            f"{args.feed} is not a GTFS zip or folder,"
+            " python -m benchmarks.synthetic generates one"
+        )
+
+    feed, results = run(args.feed, args.pairs, args.repeat)
+    summary = summarize(results)
+    previous = (
+        json.loads(Path(args.compare).read_text())["summary"] if args.compare else None
+    )
+    print(report(summary, previous))
+
+    output = {
+        "meta": {
+            "time": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+            "commit": _commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "feed": str(args.feed),
+            "feed_version": feed.version,
+            "repeat": args.repeat,
+            # pyarrow and the CSV parsing are not traced, this covers them
+            "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        },
+        "summary": summary,
+        "results": results,
+    }
+    if args.imports:
+        output["imports"] = [
+            import_time.measure(module) for module in import_time.BUDGETS
+        ]
+        for measurement in output["imports"]:
+            print(import_time.report(measurement, top=5))
+    if args.json:
+        Path(args.json).write_text(json.dumps(output, indent=2))
+
+
+if __name__ == "__main__":
+    main()
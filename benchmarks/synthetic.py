@@ -0,0 +1,387 @@
+import argparse
+import io
+import sys
+import time
+import zipfile
+from functools import partial
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+ROOT = Path(__file__).resolve().parent.parent
+
+# at scale 1 about the size of the Swiss rail network
+STATIONS = 1800
+ROUTES = 1500
+# non-rail routes, they are pruned when the feed is loaded
+OTHER_ROUTES = 0.5
+TRIPS_PER_ROUTE = 40
+# the area the stations are spread over
+LAT_RANGE = (45.9, 47.7)
+LON_RANGE = (6.0, 10.4)
+RAIL_ROUTE_TYPES = [2, 100, 102, 103, 106]
+OTHER_ROUTE_TYPES = [700, 900]
+NAMES = ["Zürich", "Genève", "Bern", "Lausanne", "Biel/Bienne", "Thun", "Köniz"]
+PARTS = ["Nord", "Süd", "Ost", "West", "Bahnhof", "Dorf", "Flughafen", "HB"]
+SERVICES = pd.DataFrame(
+    [
+        ("WD", 1, 1, 1, 1, 1, 0, 0),
+        ("SA", 0, 0, 0, 0, 0, 1, 0),
+        ("SU", 0, 0, 0, 0, 0, 0, 1),
+        ("ALL", 1, 1, 1, 1, 1, 1, 1),
+        ("NIGHT", 0, 0, 0, 0, 1, 1, 0),
+    ],
+    columns=[
+        "service_id",
+        "monday",
+        "tuesday",
+        "wednesday",
+        "thursday",
+        "friday",
+        "saturday",
+        "sunday",
+    ],
+).assign(start_date="20241215", end_date="20251213")
+HOLIDAYS = ["20241225", "20250101", "20250418", "20250801"]
+# share of the route stations only served by a few trips, they become ghost stops
+GHOST_SHARE = 0.02
+CHUNK_ROUTES = 200
+# the stations a route can go on to from a station
+NEIGHBORS = 12
+DWELL = 60
+# long enough for the last trips after midnight
+TIME_HOURS = 36
+# fixed, the same feed gives the same zip
+ZIP_DATE = (2024, 12, 15, 0, 0, 0)
+
+
+def _station_names(count, random):
+    # unique names with umlauts and accents, the search folds them
+    bases = [
+        *NAMES,
+        *(f"{name}-{part}" for name in NAMES for part in PARTS),
+    ]
+    names = []
+    for position in range(count):
+        base = bases[position % len(bases)]
+        number = position // len(bases)
+        names.append(base if number == 0 else f"{base} {number}")
+    order = random.permutation(count)
+    return [names[position] for position in order]
+
+
+def stations(count, random):
+    """Stations with the `Parent<id>` ids and one to four platforms each."""
+    # clustered around a few cities, like a real network
+    centers = random.uniform(
+        [LAT_RANGE[0], LON_RANGE[0]], [LAT_RANGE[1], LON_RANGE[1]], (24, 2)
+    )
+    cluster = random.integers(0, len(centers), count)
+    positions = centers[cluster] + random.normal(0, 0.25, (count, 2))
+    positions[:, 0] = positions[:, 0].clip(*LAT_RANGE)
+    positions[:, 1] = positions[:, 1].clip(*LON_RANGE)
+    numbers = 8500000 + np.arange(count)
+    parents = pd.DataFrame(
+        {
+            "stop_id": [f"Parent{number}" for number in numbers],
+            "stop_name": _station_names(count, random),
+            "stop_lat": positions[:, 0].round(6),
+            "stop_lon": positions[:, 1].round(6),
+            "location_type": 1,
+            "parent_station": None,
+            "platform_code": None,
+        }
+    )
+    platform_counts = random.integers(1, 5, count)
+    station = np.repeat(np.arange(count), platform_counts)
+    platform = np.arange(len(station)) - np.repeat(
+        np.cumsum(platform_counts) - platform_counts, platform_counts
+    )
+    platforms = pd.DataFrame(
+        {
+            "stop_id": [
+                f"{number}:0:{code + 1}"
+                for number, code in zip(numbers[station], platform)
+            ],
+            "stop_name": parents["stop_name"].to_numpy()[station],
+            "stop_lat": parents["stop_lat"].to_numpy()[station],
+            "stop_lon": parents["stop_lon"].to_numpy()[station],
+            "location_type": None,
+            "parent_station": parents["stop_id"].to_numpy()[station],
+            "platform_code": (platform + 1).astype(str),
+        }
+    )
+    # the platforms of station i are platforms[offsets[i]:offsets[i + 1]]
+    offsets = np.r_[0, np.cumsum(platform_counts)]
+    return pd.concat([parents, platforms], ignore_index=True), offsets
+
+
+def route_paths(station_frame, count, random):
+    """Station positions along every route, walks to close unvisited stations."""
+    sys.path.insert(0, str(ROOT))
+    from spatial import PointGrid
+
+    grid = PointGrid(
+        np.arange(len(station_frame)),
+        station_frame["stop_lat"],
+        station_frame["stop_lon"],
+    )
+    lats = station_frame["stop_lat"].to_numpy()
+    lons = station_frame["stop_lon"].to_numpy()
+    # looked up once, the walks only step between neighbors
+    neighbors = [
+        grid.nearest(lat, lon, NEIGHBORS + 1)[0][1:].tolist()
+        for lat, lon in zip(lats, lons)
+    ]
+    paths = []
+    for length in random.integers(3, 30, count):
+        path = [int(random.integers(len(station_frame)))]
+        heading = random.normal(size=2)
+        while len(path) < length:
+            candidates = [c for c in neighbors[path[-1]] if c not in path]
+            if not candidates:
+                break
+            # keep going roughly in the same direction
+            steps = np.column_stack(
+                [lats[candidates] - lats[path[-1]], lons[candidates] - lons[path[-1]]]
+            )
+            score = steps @ heading + random.normal(0, 0.01, len(candidates))
+            path.append(candidates[int(np.argmax(score))])
+        paths.append(np.array(path))
+    return paths
+
+
+def _member(name):
+    member = zipfile.ZipInfo(name, ZIP_DATE)
+    member.compress_type = zipfile.ZIP_DEFLATED
+    return member
+
+
+def _write(archive, name, text):
+    archive.writestr(_member(name), text)
+
+
+def _time_texts(hours):
+    # every second of the service day as text, hours past 24 are kept, trips
+    # after midnight belong to the day before
+    seconds = np.arange(hours * 3600)
+    return np.array(
+        [
+            f"{hour:02d}:{minute:02d}:{second:02d}"
+            for hour, minute, second in zip(
+                seconds // 3600, seconds // 60 % 60, seconds % 60
+            )
+        ],
+        dtype=object,
+    )
+
+
+def route_stop_times(route_id, path, trips, platform_offsets, lats, lons, random):
+    """Trips in both directions, some short turns and after midnight runs.
+
+    Returns the trips and the stop times with station and platform positions.
+    """
+    distances = np.hypot(
+        np.diff(lats[path]) * 111, np.diff(lons[path]) * 76
+    )  # km, roughly
+    travel = np.r_[0, np.cumsum(distances / 80 * 3600 + 60)].astype(np.int64)
+    ghost = random.random(len(path)) < GHOST_SHARE
+    # from early morning until after midnight
+    starts = random.integers(4 * 3600 + 30 * 60, 25 * 3600 + 30 * 60, trips)
+    services = np.where(
+        starts >= 24 * 3600,
+        "NIGHT",
+        np.array(["WD", "SA", "SU", "ALL"])[random.integers(0, 4, trips)],
+    )
+    trip_ids = [f"{route_id}-{number}" for number in range(trips)]
+    directions = np.arange(trips) % 2
+
+    parts = []
+    for number in range(trips):
+        stations, times, ghosts = path, travel, ghost
+        if directions[number]:
+            stations, times, ghosts = path[::-1], travel[-1] - travel[::-1], ghost[::-1]
+        if number % 5 == 4 and len(stations) > 3:
+            # a short turn, ends one station early
+            stations, times, ghosts = stations[:-1], times[:-1], ghosts[:-1]
+        parts.append((number, stations, starts[number] + times, ghosts))
+
+    lengths = [len(stations) for _, stations, _, _ in parts]
+    stations = np.concatenate([stations for _, stations, _, _ in parts])
+    platform_counts = np.diff(platform_offsets)[stations]
+    # ghost stops only let passengers on or off on a few trips
+    ghosts = np.concatenate([ghosts for _, _, _, ghosts in parts])
+    passengers = (ghosts & (random.random(len(stations)) > 0.01)).astype(np.int8)
+    stop_times = {
+        "trip": np.repeat([number for number, _, _, _ in parts], lengths),
+        "arrival": np.concatenate([arrival for _, _, arrival, _ in parts]),
+        "platform": platform_offsets[stations] + random.integers(0, platform_counts),
+        "stop_sequence": np.concatenate([np.arange(1, n + 1) for n in lengths]),
+        "passengers": passengers,
+    }
+    trip_rows = pd.DataFrame(
+        {
+            "route_id": route_id,
+            "service_id": services,
+            "trip_id": trip_ids,
+            "direction_id": directions,
+        }
+    )
+    return trip_rows, stop_times
+
+
+def generate(
+    path,
+    scale=1.0,
+    seed=0,
+    station_count=STATIONS,
+    rail_routes=ROUTES,
+    trips_per_route=TRIPS_PER_ROUTE,
+):
+    """Write a synthetic GTFS zip, the same arguments give the same feed.
+
+    The counts are scaled by `scale`, the trips only down. Returns the number
+    of rows per table.
+    """
+    random = np.random.default_rng(seed)
+    station_count = max(int(station_count * scale), 4)
+    rail_routes = max(int(rail_routes * scale), 2)
+    route_count = rail_routes + int(rail_routes * OTHER_ROUTES)
+    trips_per_route = max(int(trips_per_route * min(scale, 1) ** 0.5), 2)
+
+    stops, platform_offsets = stations(station_count, random)
+    parents = stops.iloc[:station_count]
+    platform_ids = stops["stop_id"].to_numpy()[station_count:]
+    time_texts = _time_texts(TIME_HOURS)
+    lats = parents["stop_lat"].to_numpy()
+    lons = parents["stop_lon"].to_numpy()
+    paths = route_paths(parents, route_count, random)
+
+    route_types = np.r_[
+        random.choice(RAIL_ROUTE_TYPES, rail_routes),
+        random.choice(OTHER_ROUTE_TYPES, route_count - rail_routes),
+    ]
+    prefixes = np.where(
+        route_types < 700,
+        random.choice(["IC", "IR", "RE", "S", "R"], route_count),
+        "B",
+    )
+    routes = pd.DataFrame(
+        {
+            "route_id": [f"R{number}" for number in range(route_count)],
+            "agency_id": "11",
+            "route_short_name": [
+                f"{prefix}{number % 99 + 1}" for number, prefix in enumerate(prefixes)
+            ],
+            "route_long_name": None,
+            "route_type": route_types,
+        }
+    )
+    # special trains, left out of the routes of a station
+    routes.loc[random.random(route_count) < 0.01, "route_short_name"] = "EXT"
+
+    counts = {"stops": len(stops), "routes": len(routes), "stop_times": 0}
+    trips = []
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as archive:
+        write = partial(_write, archive)
+        write(
+            "agency.txt",
+            "agency_id,agency_name,agency_url,agency_timezone\n"
+            "11,Synthetic Railways,https://example.org,Europe/Zurich\n",
+        )
+        write("stops.txt", stops.to_csv(index=False))
+        write("routes.txt", routes.to_csv(index=False))
+        write("calendar.txt", SERVICES.to_csv(index=False))
+        write(
+            "calendar_dates.txt",
+            pd.DataFrame(
+                {
+                    "service_id": ["WD"] * len(HOLIDAYS) + ["SU"] * len(HOLIDAYS),
+                    "date": HOLIDAYS * 2,
+                    "exception_type": [2] * len(HOLIDAYS) + [1] * len(HOLIDAYS),
+                }
+            ).to_csv(index=False),
+        )
+        # written in chunks of routes, the whole table is never in memory
+        with archive.open(_member("stop_times.txt"), "w") as member:
+            text = io.TextIOWrapper(member, encoding="utf-8", newline="")
+            for start in range(0, route_count, CHUNK_ROUTES):
+                chunk = []
+                for number in range(start, min(start + CHUNK_ROUTES, route_count)):
+                    trip_rows, stop_times = route_stop_times(
+                        routes["route_id"].iat[number],
+                        paths[number],
+                        trips_per_route,
+                        platform_offsets,
+                        lats,
+                        lons,
+                        random,
+                    )
+                    trips.append(trip_rows)
+                    arrival = stop_times["arrival"]
+                    if arrival.max() + DWELL >= len(time_texts):
+                        # very long routes of sparse feeds
+                        time_texts = _time_texts((arrival.max() + DWELL) // 3600 + 1)
+                    chunk.append(
+                        pd.DataFrame(
+                            {
+                                "trip_id": trip_rows["trip_id"].to_numpy()[
+                                    stop_times["trip"]
+                                ],
+                                "arrival_time": time_texts[arrival],
+                                "departure_time": time_texts[arrival + DWELL],
+                                "stop_id": platform_ids[stop_times["platform"]],
+                                "stop_sequence": stop_times["stop_sequence"],
+                                "pickup_type": stop_times["passengers"],
+                                "drop_off_type": stop_times["passengers"],
+                            }
+                        )
+                    )
+                chunk = pd.concat(chunk, ignore_index=True)
+                chunk.to_csv(text, index=False, header=start == 0)
+                counts["stop_times"] += len(chunk)
+            text.flush()
+            text.detach()
+        trips = pd.concat(trips, ignore_index=True)
+        write("trips.txt", trips.to_csv(index=False))
+    counts["trips"] = len(trips)
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Write a deterministic synthetic GTFS feed."
+    )
+    parser.add_argument("output", help="the zip file to write")
+    parser.add_argument(
+        "--scale",
+        type=float,
+        default=1.0,
+        help="1 is about the Swiss rail network, 0.01 a tiny feed",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--stations", type=int, default=STATIONS)
+    parser.add_argument(
+        "--routes", type=int, default=ROUTES, help="rail routes, before scaling"
+    )
+    parser.add_argument("--trips-per-route", type=int, default=TRIPS_PER_ROUTE)
+    args = parser.parse_args()
+
+    start = time.perf_counter()
+    counts = generate(
+        args.output,
+        args.scale,
+        args.seed,
+        args.stations,
+        args.routes,
+        args.trips_per_route,
+    )
+    print(
+        f"Wrote {args.output} in {time.perf_counter() - start:.1f} s: "
+        + ", ".join(f"{count} {name}" for name, count in counts.items())
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+import json
+from urllib.parse import urlencode
+from urllib.request import urlopen
+
+import pandas as pd
+
+DEFAULT_URL = "http://127.0.0.1:8000"
+
+
+class QueryClient:
+    """Calls the query API of `server.py` and returns the results as dataframes."""
+
+    def __init__(self, base_url=DEFAULT_URL, timeout=60):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+
+    def _get(self, path, **params):
+        query = urlencode(
+            {key: value for key, value in params.items() if value is not None},
+            doseq=True,
+        )
+        with urlopen(
+            f"{self.base_url}{path}?{query}", timeout=self.timeout
+        ) as response:
+            return pd.DataFrame.from_records(json.load(response))
+
+    def _filters(self, active_days, relevant_hours):
+        return {
+            "days": ",".join(active_days) if active_days else None,
+            "hours": ",".join(map(str, relevant_hours)) if relevant_hours else None,
+        }
+
+    def get_stations(self, query=None, limit=None):
+        return self._get("/stations", q=query, limit=limit)
+
+    def get_nearby(self, lat, lon, count=5, radius_km=None):
+        return self._get("/nearby", lat=lat, lon=lon, k=count, radius=radius_km)
+
+    def get_routes(self, station_id):
+        return self._get("/routes", station=station_id)
+
+    def get_stops(self, route_ids, active_days=None, relevant_hours=None):
+        return self._get(
+            "/stops",
+            route=list(route_ids),
+            **self._filters(active_days, relevant_hours),
+        )
+
+    def get_shared(
+        self, station_ids, excluded=(), active_days=None, relevant_hours=None
+    ):
+        return self._get(
+            "/shared",
+            station=list(station_ids),
+            exclude=list(excluded),
+            **self._filters(active_days, relevant_hours),
+        )
+
+    def get_candidates(
+        self,
+        station_ids,
+        excluded=(),
+        active_days=None,
+        relevant_hours=None,
+        limit=20,
+        region=None,
+    ):
+        # region is (lat, lon, radius_km)
+        return self._get(
+            "/candidates",
+            station=list(station_ids),
+            exclude=list(excluded),
+            limit=limit,
+            near=f"{region[0]},{region[1]}" if region else None,
+            radius=region[2] if region else None,
+            **self._filters(active_days, relevant_hours),
+        )
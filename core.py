@@ -0,0 +1,867 @@
+import hashlib
+import logging
+import os
+import shutil
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextvars import copy_context
+from functools import wraps
+from pathlib import Path
+from time import perf_counter
+
+import numpy as np
+import pandas as pd
+
+from cache import LRUCache
+from ingest import read_feed
+from partitioned import PartitionedFeed, build_dataset, dataset_path, dataset_version
+from search import NameIndex
+from spans import rows, span, traced
+from spatial import PointGrid
+from sqlstore import SqlFeed, build_database, database_path, database_version
+from timetable import CompressedTimetable, time_to_seconds
+from timetable import trip_hashes as hash_trips
+
+FEED_PATH = "gtfs.zip"
+WEEKDAYS = [
+    "Monday",
+    "Tuesday",
+    "Wednesday",
+    "Thursday",
+    "Friday",
+    "Saturday",
+    "Sunday",
+]
+# the app is about trains, 2 is rail and 100-117 the extended railway types
+RAIL_ROUTE_TYPES = "2,100-117"
+ROUTE_TYPES = os.environ.get("COMMUTE_ROUTE_TYPES", RAIL_ROUTE_TYPES)
+# stations served for passengers by less than this share of the trips of a
+# route are ghost stops, they are dropped, only flagged or kept (off)
+GHOST_STOPS = os.environ.get("COMMUTE_GHOST_STOPS", "drop")
+GHOST_MIN_SHARE = float(os.environ.get("COMMUTE_GHOST_MIN_SHARE", 0.05))
+# arrow parses the tables in parallel with pyarrow, pandas reads with gtfs_kit
+INGEST = os.environ.get("COMMUTE_INGEST", "arrow")
+# the feed loads in a background thread, the stations are shown before that
+LAZY_FEED = os.environ.get("COMMUTE_LAZY_FEED", "1") != "0"
+COMPRESS_TIMETABLE = os.environ.get("COMMUTE_COMPRESS_TIMETABLE", "1") != "0"
+CACHE_MAX_BYTES = int(os.environ.get("COMMUTE_CACHE_MAX_BYTES", 512 * 1024 * 1024))
+# trips hashed at a time for a feed update, when the backend has no hashes
+TRIP_HASH_CHUNK = 20_000
+PIPELINE_WORKERS = int(os.environ.get("COMMUTE_PIPELINE_WORKERS", 8))
+# pandas keeps the feed in memory, sqlite queries a database and parquet reads
+# the stop times from a partitioned dataset, both are built next to the feed
+BACKEND = os.environ.get("COMMUTE_BACKEND", "pandas")
+
+logger = logging.getLogger(__name__)
+
+
+# Caching
+#####
+# any object with `get(key, default)`, `set(key, value)` and `key in cache`
+# can be plugged in with `set_cache`, the default is shared by the whole process
+_cache = LRUCache(CACHE_MAX_BYTES)
+_MISSING = object()
+
+
+def set_cache(cache):
+    global _cache
+    _cache = cache
+
+
+def get_cache():
+    return _cache
+
+
+def _freeze(value):
+    if isinstance(value, (pd.Series, pd.Index, list, tuple)):
+        return tuple(_freeze(item) for item in value)
+    if isinstance(value, (set, frozenset)):
+        return tuple(sorted(value))
+    if isinstance(value, np.ndarray):
+        # python scalars, an array of ids has the key of the same list
+        return _freeze(value.tolist())
+    return value
+
+
+def cached(function):
+    """Cache the result per feed version and arguments.
+
+    The cached dataframes are shared between callers and must not be modified.
+    """
+
+    def cache_key(feed, *args):
+        return (function.__name__, feed_version(feed), *map(_freeze, args))
+
+    @wraps(function)
+    def wrapper(feed, *args):
+        key = cache_key(feed, *args)
+        with span(function.__name__, rows(args[0]) if args else None) as current:
+            result = _cache.get(key, _MISSING)
+            current.cached = result is not _MISSING
+            if result is _MISSING:
+                result = function(feed, *args)
+                _cache.set(key, result)
+            current.output = result
+        return result
+
+    wrapper.cache_key = cache_key
+    wrapper.is_cached = lambda *args: cache_key(*args) in _cache
+    return wrapper
+
+
+# Feed
+#####
+def file_version(path):
+    digest = hashlib.sha1()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()[:12]
+
+
+def feed_version(feed):
+    # feeds which were not loaded through load_feed are told apart by identity
+    return getattr(feed, "version", None) or id(feed)
+
+
+def parse_route_types(value):
+    """`2,100-117` as a set of route types, `all` keeps every type as `None`."""
+    if value is None or value.strip().lower() == "all":
+        return None
+    route_types = set()
+    for part in value.split(","):
+        lower, _, upper = part.partition("-")
+        route_types.update(range(int(lower), int(upper or lower) + 1))
+    return route_types
+
+
+def load_feed(
+    path=FEED_PATH,
+    route_types=ROUTE_TYPES,
+    ghost_stops=GHOST_STOPS,
+    ghost_min_share=GHOST_MIN_SHARE,
+    compress=COMPRESS_TIMETABLE,
+    backend=BACKEND,
+    lazy=LAZY_FEED,
+):
+    if lazy:
+        return LazyFeed(
+            path,
+            path_version(path, route_types, ghost_stops, ghost_min_share),
+            lambda: load_feed(
+                path,
+                route_types,
+                ghost_stops,
+                ghost_min_share,
+                compress,
+                backend,
+                lazy=False,
+            ),
+        )
+
+    with span("load_feed"):
+        route_types = parse_route_types(route_types)
+        version = _version(path, route_types, ghost_stops, ghost_min_share)
+
+        if backend in _STORES:
+            store_path, store_version, build, open_store = _STORES[backend]
+            store = store_path(path, version)
+            if store_version(store) != version:
+                feed = _read_feed(path, route_types, ghost_stops, ghost_min_share)
+                feed.version = version
+                with span(f"build_{backend}"):
+                    build(feed, store)
+                logger.info("built %s", store)
+            with span(f"open_{backend}"):
+                return open_store(store)
+
+        feed = _read_feed(path, route_types, ghost_stops, ghost_min_share)
+        feed.version = version
+        if compress:
+            with span("compress_timetable"):
+                compress_timetable(feed)
+        return feed
+
+
+def _version(path, route_types, ghost_stops, ghost_min_share):
+    options = []
+    if route_types is not None:
+        options.append(",".join(map(str, sorted(route_types))))
+    if ghost_stops != "off":
+        options.append(f"{ghost_stops}:{ghost_min_share}")
+    version = file_version(path)
+    if options:
+        # results of a differently cleaned feed are not interchangeable
+        version += "-" + hashlib.sha1("|".join(options).encode()).hexdigest()[:6]
+    return version
+
+
+def path_version(
+    path=FEED_PATH,
+    route_types=ROUTE_TYPES,
+    ghost_stops=GHOST_STOPS,
+    ghost_min_share=GHOST_MIN_SHARE,
+):
+    """The version `load_feed` gives the feed file at `path`, without loading it."""
+    return _version(path, parse_route_types(route_types), ghost_stops, ghost_min_share)
+
+
+def snapshot_path(path, version):
+    return Path(path).with_name(f"{Path(path).stem}.{version}.stations.pkl")
+
+
+def remove_artifacts(path, version):
+    """Delete the database, dataset and stations snapshot of a feed version.
+
+    Only for versions no feed uses any more, the database backends open the
+    files again for every new thread or query.
+    """
+    for artifact in (
+        database_path(path, version),
+        dataset_path(path, version),
+        snapshot_path(path, version),
+    ):
+        if artifact.is_dir():
+            shutil.rmtree(artifact)
+        else:
+            artifact.unlink(missing_ok=True)
+
+
+class LazyFeed:
+    """A feed which loads in a background thread and is usable right away.
+
+    The version is known before the load and the stations come from a
+    snapshot of an earlier load of the same version. Any other attribute
+    waits for the load.
+    """
+
+    def __init__(self, path, version, load):
+        self.path = path
+        self.version = version
+        self.snapshot_path = snapshot_path(path, version)
+        self.stations = (
+            pd.read_pickle(self.snapshot_path) if self.snapshot_path.exists() else None
+        )
+        self._future = Future()
+        threading.Thread(
+            target=self._load, args=(load,), name="feed-loader", daemon=True
+        ).start()
+
+    def _load(self, load):
+        try:
+            feed = load()
+            if self.stations is None:
+                self._write_snapshot(feed)
+            self._future.set_result(feed)
+        except BaseException as error:
+            self._future.set_exception(error)
+
+    def _write_snapshot(self, feed):
+        # written next to the feed like the databases, read on the next start
+        try:
+            parse_stations.__wrapped__(feed).to_pickle(self.snapshot_path)
+        except OSError:
+            logger.warning("could not write %s", self.snapshot_path, exc_info=True)
+
+    @property
+    def loaded(self):
+        return self._future.done()
+
+    @property
+    def feed(self):
+        return self._future.result()
+
+    def __getattr__(self, name):
+        # only called for attributes the lazy feed does not have itself
+        if name.startswith("_"):
+            raise AttributeError(name)
+        return getattr(self.feed, name)
+
+
+def _loaded(feed):
+    return feed.feed if isinstance(feed, LazyFeed) else feed
+
+
+_STORES = {
+    "sqlite": (database_path, database_version, build_database, SqlFeed),
+    "parquet": (dataset_path, dataset_version, build_dataset, PartitionedFeed),
+}
+
+
+def _read_feed(path, route_types, ghost_stops, ghost_min_share):
+    with span("read_feed"):
+        if INGEST == "arrow":
+            feed = read_feed(path)
+        else:
+            # gtfs_kit pulls in geopandas and shapely, only needed once the feed
+            # is read
+            import gtfs_kit
+
+            feed = gtfs_kit.read_feed(path, dist_units="km")
+    if route_types is not None:
+        with span("prune_feed"):
+            prune_feed(feed, route_types)
+    if ghost_stops != "off":
+        with span("clean_ghost_stops"):
+            clean_ghost_stops(feed, ghost_min_share, drop=ghost_stops == "drop")
+    return feed
+
+
+def _table_bytes(table):
+    return int(table.memory_usage(deep=True).sum()) if table is not None else 0
+
+
+def feed_memory(feed):
+    """Bytes of the tables a loaded feed keeps in memory.
+
+    The stop times of the database backends are on disk and not counted.
+    """
+    feed = _loaded(feed)
+    tables = [value for value in vars(feed).values() if isinstance(value, pd.DataFrame)]
+    timetable = getattr(feed, "timetable", None)
+    return sum(_table_bytes(table) for table in tables) + (
+        timetable.memory_usage() if timetable is not None else 0
+    )
+
+
+def prune_feed(feed, route_types):
+    """Keep only the routes of `route_types` and what they use, in place.
+
+    Returns the rows (and with INFO logging the bytes) per table before and
+    after, which are also kept as `feed.pruning`.
+    """
+    tables = [
+        "routes",
+        "trips",
+        "stop_times",
+        "stops",
+        "calendar",
+        "calendar_dates",
+        "frequencies",
+        "transfers",
+        "shapes",
+    ]
+    measure = logger.isEnabledFor(logging.INFO)
+    report = {
+        name: {"rows_before": len(getattr(feed, name))}
+        | ({"bytes_before": _table_bytes(getattr(feed, name))} if measure else {})
+        for name in tables
+        if getattr(feed, name, None) is not None
+    }
+
+    feed.routes = feed.routes.loc[feed.routes["route_type"].isin(route_types)]
+    feed.trips = feed.trips.loc[feed.trips["route_id"].isin(feed.routes["route_id"])]
+    feed.stop_times = feed.stop_times.loc[
+        feed.stop_times["trip_id"].isin(feed.trips["trip_id"])
+    ]
+    # the used platforms and their stations
+    used_stops = feed.stops["stop_id"].isin(feed.stop_times["stop_id"].unique())
+    feed.stops = feed.stops.loc[
+        used_stops
+        | feed.stops["stop_id"].isin(feed.stops.loc[used_stops, "parent_station"])
+    ]
+    services = feed.trips["service_id"].unique()
+    for name in ("calendar", "calendar_dates"):
+        table = getattr(feed, name)
+        if table is not None:
+            setattr(feed, name, table.loc[table["service_id"].isin(services)])
+    if feed.frequencies is not None:
+        feed.frequencies = feed.frequencies.loc[
+            feed.frequencies["trip_id"].isin(feed.trips["trip_id"])
+        ]
+    if feed.transfers is not None:
+        feed.transfers = feed.transfers.loc[
+            feed.transfers["from_stop_id"].isin(feed.stops["stop_id"])
+            & feed.transfers["to_stop_id"].isin(feed.stops["stop_id"])
+        ]
+    if feed.shapes is not None and "shape_id" in feed.trips:
+        feed.shapes = feed.shapes.loc[
+            feed.shapes["shape_id"].isin(feed.trips["shape_id"])
+        ]
+
+    for name, counts in report.items():
+        table = getattr(feed, name)
+        counts["rows_after"] = len(table)
+        if measure:
+            counts["bytes_after"] = _table_bytes(table)
+
+    def total(key):
+        return sum(counts[key] for counts in report.values())
+
+    logger.info(
+        "kept %d route types: %d of %d rows",
+        len(route_types),
+        total("rows_after"),
+        total("rows_before"),
+    )
+    if measure:
+        logger.info(
+            "pruning saved %.1f of %.1f MB",
+            (total("bytes_before") - total("bytes_after")) / 1e6,
+            total("bytes_before") / 1e6,
+        )
+    feed.pruning = report
+    return report
+
+
+def compress_timetable(feed):
+    """Replace `feed.stop_times` with a `CompressedTimetable` as `feed.timetable`.
+
+    The stop times are then only available through `stop_times_of`.
+    """
+    feed.timetable = CompressedTimetable.from_stop_times(feed.stop_times)
+    if logger.isEnabledFor(logging.INFO):
+        logger.info(
+            "compressed %d stop times from %.1f to %.1f MB in %d patterns",
+            len(feed.stop_times),
+            _table_bytes(feed.stop_times) / 1e6,
+            feed.timetable.memory_usage() / 1e6,
+            len(feed.timetable.pattern_lengths),
+        )
+    feed.stop_times = None
+    return feed.timetable
+
+
+def stop_times_of(feed, trip_ids=None, times="text"):
+    """Stop times of `trip_ids` (all trips if `None`) from either representation.
+
+    `times="seconds"` adds `arrival_time_parsed` and `departure_time_parsed`.
+    """
+    feed = _loaded(feed)
+    if isinstance(feed, (SqlFeed, PartitionedFeed)):
+        return feed.stop_times_of(trip_ids, times)
+    timetable = getattr(feed, "timetable", None)
+    if timetable is not None:
+        return timetable.stop_times(trip_ids, times)
+    stop_times = feed.stop_times
+    if trip_ids is not None:
+        stop_times = stop_times.loc[stop_times["trip_id"].isin(trip_ids)]
+    if times == "seconds":
+        stop_times = stop_times.assign(
+            arrival_time_parsed=time_to_seconds(stop_times["arrival_time"]),
+            departure_time_parsed=time_to_seconds(stop_times["departure_time"]),
+        )
+    return stop_times
+
+
+def trip_hashes(feed, chunk_trips=TRIP_HASH_CHUNK):
+    """One hash per trip over its stop times, see `timetable.trip_hashes`.
+
+    The database backends store them when they are built, other feeds hash
+    their trips once, a chunk at a time so the stop times are never all
+    rebuilt at once.
+    """
+    feed = _loaded(feed)
+    hashes = getattr(feed, "trip_hashes", None)
+    if hashes is None:
+        trip_ids = feed.trips["trip_id"].to_numpy()
+        chunks = [
+            hash_trips(
+                stop_times_of(
+                    feed, trip_ids[start : start + chunk_trips], times="seconds"
+                )
+            )
+            for start in range(0, len(trip_ids), chunk_trips)
+        ]
+        hashes = pd.concat(chunks) if chunks else pd.Series(dtype=np.uint64)
+        feed.trip_hashes = hashes
+    return hashes
+
+
+def trips_at_stops(feed, stop_ids):
+    feed = _loaded(feed)
+    if isinstance(feed, (SqlFeed, PartitionedFeed)):
+        return feed.trips_at(stop_ids)
+    timetable = getattr(feed, "timetable", None)
+    if timetable is not None:
+        return timetable.trips_at(stop_ids)
+    return feed.stop_times.loc[feed.stop_times["stop_id"].isin(stop_ids)][
+        "trip_id"
+    ].unique()
+
+
+def score_stops(feed):
+    """How well every station is served for passengers by every route.
+
+    A stop counts as served when passengers can board or alight, platforms
+    are counted as their station. Returns per route and station the served
+    trips, their share of all trips of the route and the number of distinct
+    hours with a served departure.
+    """
+    stops = feed.stops.set_index("stop_id")["parent_station"]
+    stop_times = feed.stop_times
+    station = stop_times["stop_id"].map(stops)
+    served = (stop_times["pickup_type"].fillna(0) == 0) | (
+        stop_times["drop_off_type"].fillna(0) == 0
+    )
+    hours = time_to_seconds(stop_times["departure_time"]) // 3600
+    scores = (
+        pd.DataFrame(
+            {
+                "route_id": stop_times["trip_id"].map(
+                    feed.trips.set_index("trip_id")["route_id"]
+                ),
+                "parent_station": station.fillna(stop_times["stop_id"]),
+                "served": served,
+                "served_hour": np.where(served, hours, np.nan),
+            }
+        )
+        .groupby(["route_id", "parent_station"])
+        .agg(
+            served_trips=("served", "sum"),
+            service_hours=("served_hour", "nunique"),
+        )
+        .reset_index()
+    )
+    route_trips = feed.trips.groupby("route_id")["trip_id"].nunique()
+    return scores.assign(
+        served_share=scores["served_trips"] / scores["route_id"].map(route_trips)
+    )
+
+
+def clean_ghost_stops(feed, min_share=GHOST_MIN_SHARE, drop=True):
+    """Find the stations a route rarely or never serves for passengers.
+
+    They are kept as `feed.ghost_stops` and left out of `get_stops`, with
+    `drop` their stop times are removed from the feed instead.
+    """
+    scores = score_stops(feed)
+    ghost_stops = scores.loc[scores["served_share"] < min_share]
+    feed.ghost_stops = ghost_stops.reset_index(drop=True)
+    feed.ghost_stops_dropped = drop
+    logger.info(
+        "%d of %d route stations are ghost stops", len(ghost_stops), len(scores)
+    )
+    if drop and len(ghost_stops):
+        rows = len(feed.stop_times)
+        feed.stop_times = feed.stop_times.loc[~_is_ghost_stop(feed, feed.stop_times)]
+        logger.info("dropped %d ghost stop times", rows - len(feed.stop_times))
+    return feed.ghost_stops
+
+
+def _filters_ghost_stops(feed):
+    # dropped ghost stops can not show up in the results
+    return len(getattr(feed, "ghost_stops", ())) and not getattr(
+        feed, "ghost_stops_dropped", False
+    )
+
+
+def _is_ghost_stop(feed, stop_times):
+    # stop times need a route_id or trip_id and a parent_station or stop_id
+    if "route_id" in stop_times:
+        route_ids = stop_times["route_id"]
+    else:
+        route_ids = stop_times["trip_id"].map(
+            feed.trips.set_index("trip_id")["route_id"]
+        )
+    if "parent_station" in stop_times:
+        stations = stop_times["parent_station"]
+    else:
+        stations = stop_times["stop_id"].map(
+            feed.stops.set_index("stop_id")["parent_station"]
+        )
+    stations = stations.fillna(stop_times["stop_id"])
+    ghost_stops = pd.MultiIndex.from_frame(
+        feed.ghost_stops[["route_id", "parent_station"]]
+    )
+    return pd.MultiIndex.from_arrays([route_ids, stations]).isin(ghost_stops)
+
+
+@cached
+def parse_stations(feed):
+    if isinstance(feed, LazyFeed) and feed.stations is not None:
+        return feed.stations
+    return feed.stops.loc[feed.stops.stop_id.str.contains("Parent")].sort_values(
+        "stop_name"
+    )
+
+
+@cached
+def station_index(feed):
+    return NameIndex.from_frame(parse_stations(feed), "stop_id", "stop_name")
+
+
+@cached
+def station_grid(feed):
+    return PointGrid.from_frame(parse_stations(feed), "stop_id")
+
+
+# Queries
+#####
+@cached
+def get_routes(feed, station_id):
+    feed = _loaded(feed)
+    if isinstance(feed, SqlFeed):
+        return feed.get_routes(station_id)
+    platforms = feed.stops.loc[feed.stops["parent_station"] == station_id]
+    with span("trips_at_stops", len(platforms)) as current:
+        trip_ids = trips_at_stops(feed, platforms["stop_id"].values)
+        current.output = trip_ids
+    route_ids = feed.trips.loc[feed.trips["trip_id"].isin(trip_ids)][
+        "route_id"
+    ].unique()
+    all_routes = feed.routes.loc[feed.routes["route_id"].isin(route_ids)]
+    # EXT are special trains, not usually accessible
+    routes = all_routes.loc[all_routes["route_short_name"] != "EXT"]
+    return routes
+
+
+@cached
+def get_stops(feed, route_ids, active_days, relevant_hours):
+    feed = _loaded(feed)
+    if isinstance(feed, SqlFeed):
+        with span("query", len(route_ids)) as current:
+            stop_data = feed.get_stops(route_ids, active_days, relevant_hours)
+            current.output = stop_data
+        if _filters_ghost_stops(feed):
+            with span("ghost_stops", len(stop_data)) as current:
+                stop_data = stop_data.loc[~_is_ghost_stop(feed, stop_data)]
+                current.output = stop_data
+        return stop_data
+
+    # filter by weekdays
+    with span("calendar", len(feed.calendar)) as current:
+        query_string = ""
+        for i, weekday in enumerate(active_days):
+            query_string += f"{weekday.lower()} == 1"
+            if i < len(active_days) - 1:
+                query_string += " and "
+        active_services = feed.calendar.query(query_string)["service_id"]
+
+        route_trips = feed.trips.loc[
+            feed.trips["route_id"].isin(route_ids)
+            & feed.trips["service_id"].isin(active_services)
+        ]
+        current.output = route_trips
+
+    # with arrival and departure parsed to seconds
+    with span("stop_times", len(route_trips)) as current:
+        relevant_stops = stop_times_of(feed, route_trips["trip_id"], times="seconds")
+        current.output = relevant_stops
+
+    # pickup, dropoff type not 0 means no normal passenger transfer
+    # filter by arrival and departure time
+    with span("longest_trips", len(relevant_stops)) as current:
+        lower_bound, upper_bound = [hour * 3600 for hour in relevant_hours]
+        filtered_stops = relevant_stops.loc[
+            (
+                (relevant_stops["pickup_type"] == 0)
+                & (relevant_stops["drop_off_type"] == 0)
+            )
+            & (
+                (
+                    (relevant_stops["arrival_time_parsed"] > lower_bound)
+                    & (relevant_stops["arrival_time_parsed"] < upper_bound)
+                )
+                | (
+                    (relevant_stops["departure_time_parsed"] > lower_bound)
+                    & (relevant_stops["departure_time_parsed"] < upper_bound)
+                )
+            )
+        ]
+
+        stops_trips = pd.merge(
+            filtered_stops,
+            feed.trips[["trip_id", "route_id"]],
+            on="trip_id",
+            how="left",
+        )
+        # map the stops to the route
+        stops_route = pd.merge(
+            stops_trips,
+            feed.routes[["route_id", "route_short_name"]],
+            on="route_id",
+            how="left",
+        )
+
+        # only use longest trips
+        longest_trips = stops_route.loc[
+            stops_route.groupby(["route_id"])["stop_sequence"].idxmax()
+        ]
+        current.output = longest_trips
+    # stops_to_display = stops_route.loc[stops_route["trip_id"].isin(longest_trips["trip_id"])]
+
+    with span("longest_stop_times", len(longest_trips)) as current:
+        longest_trips_stop_times = stop_times_of(feed, longest_trips["trip_id"])
+        current.output = longest_trips_stop_times
+    # longest_trips_stations = feed.stops.loc[
+    #    feed.stops["stop_id"].isin(longest_trips_stop_times["stop_id"])
+    # ]
+
+    # TODO: consider all trip options, as some might have divergent routes
+    # dedupe stops per route
+    # deduped_stops = stops.sort_values(["stop_sequence"]).groupby("route_id").apply(lambda x: x.loc[x["stop_sequence"].idxmax()])
+    # print(deduped_stops)
+
+    # add all additional data which is needed
+    with span("merges", len(longest_trips_stop_times)) as current:
+        stop_data = pd.merge(longest_trips_stop_times, feed.trips, on="trip_id")
+        stop_data = pd.merge(stop_data, feed.routes, on="route_id")
+        stop_data = pd.merge(stop_data, feed.stops, on="stop_id")
+        current.output = stop_data
+    if _filters_ghost_stops(feed):
+        with span("ghost_stops", len(stop_data)) as current:
+            stop_data = stop_data.loc[~_is_ghost_stop(feed, stop_data)]
+            current.output = stop_data
+    return stop_data
+
+
+# Concurrent pipelines
+#####
+# the destinations are independent of each other, each one runs in its own thread
+_executor = None
+_executor_pid = None
+
+
+def _get_executor():
+    global _executor, _executor_pid
+    # a forked worker process can not use the threads of its parent
+    if _executor_pid != os.getpid():
+        _executor = ThreadPoolExecutor(PIPELINE_WORKERS, "pipeline")
+        _executor_pid = os.getpid()
+    return _executor
+
+
+def _timed(function, *args):
+    start = perf_counter()
+    result = function(*args)
+    return result, perf_counter() - start
+
+
+def run_concurrently(calls):
+    """Run `(function, *args)` calls in the pipeline threads.
+
+    Returns the results in order and the end-to-end and per-branch timings.
+    """
+    start = perf_counter()
+    # the spans of the branches go to the trace of the caller
+    futures = [
+        _get_executor().submit(copy_context().run, _timed, *call) for call in calls
+    ]
+    outcomes = [future.result() for future in futures]
+    durations = [duration for _, duration in outcomes]
+    timings = {"total": perf_counter() - start, "branches": durations}
+    logger.debug(
+        "%d branches in %.3f s (%s)",
+        len(calls),
+        timings["total"],
+        ", ".join(f"{duration:.3f} s" for duration in durations),
+    )
+    return [result for result, _ in outcomes], timings
+
+
+def get_routes_concurrently(feed, station_ids):
+    return run_concurrently(
+        [(get_routes, feed, station_id) for station_id in station_ids]
+    )
+
+
+def get_stops_concurrently(feed, route_id_sets, active_days, relevant_hours):
+    return run_concurrently(
+        [
+            (get_stops, feed, route_ids, active_days, relevant_hours)
+            for route_ids in route_id_sets
+        ]
+    )
+
+
+def _destination_stops(feed, station_id, excluded, active_days, relevant_hours):
+    routes = get_routes(feed, station_id)
+    return get_stops(
+        feed,
+        routes.loc[~routes["route_id"].isin(excluded)]["route_id"],
+        active_days,
+        relevant_hours,
+    )
+
+
+def destination_stops(feed, station_ids, excluded, active_days, relevant_hours):
+    # the whole routes and stops chain of every destination as one branch
+    return run_concurrently(
+        [
+            (
+                _destination_stops,
+                feed,
+                station_id,
+                excluded,
+                active_days,
+                relevant_hours,
+            )
+            for station_id in station_ids
+        ]
+    )
+
+
+@traced
+def find_shared(stops_a, stops_b):
+    return (
+        pd.merge(stops_a, stops_b, how="inner", on=["parent_station"])
+        .drop_duplicates("parent_station")
+        .rename(
+            columns={
+                "stop_id_x": "stop_id",
+                "stop_name_x": "stop_name",
+                "stop_lat_x": "stop_lat",
+                "stop_lon_x": "stop_lon",
+                "parent_station_x": "parent_station",
+            }
+        )
+    )
+
+
+def rank_candidates(destination_stops):
+    # stations reachable from every destination, ranked by the number of direct
+    # routes to the worst connected destination
+    route_counts = pd.concat(
+        [
+            stops.groupby("parent_station")["route_id"].nunique()
+            for stops in destination_stops
+        ],
+        axis=1,
+        join="inner",
+    )
+    ranking = pd.DataFrame(
+        {
+            "parent_station": route_counts.index,
+            "min_routes": route_counts.min(axis=1).values,
+            "total_routes": route_counts.sum(axis=1).values,
+        }
+    )
+    stations = destination_stops[0].drop_duplicates("parent_station")[
+        ["parent_station", "stop_name", "stop_lat", "stop_lon"]
+    ]
+    return ranking.merge(stations, on="parent_station").sort_values(
+        ["min_routes", "total_routes", "stop_name"],
+        ascending=[False, False, True],
+        ignore_index=True,
+    )
+
+
+@traced
+def route_details(selected_route, shared_stops):
+    selected_route = selected_route.sort_values(["stop_sequence", "route_id"])
+    chart_data = selected_route[["stop_sequence", "route_short_name", "stop_name"]]
+    chart_data = chart_data.assign(
+        shared=selected_route["parent_station"].isin(shared_stops)
+    )
+
+    time_data = selected_route[["stop_sequence", "route_short_name"]]
+    time_data = time_data.assign(
+        stop_sequence=time_data["stop_sequence"] + 0.5,
+        arrival_time_parsed=pd.to_timedelta(selected_route["arrival_time"]),
+        departure_time_parsed=pd.to_timedelta(selected_route["departure_time"]),
+    )
+
+    time_data["next_stop"] = ""
+    for idx in time_data.index:
+        if idx == time_data.idxmax().iloc[0]:
+            break
+        travel_time = (
+            time_data.iloc[idx + 1]["arrival_time_parsed"]
+            - time_data.iloc[idx]["departure_time_parsed"]
+        )
+        time_data.loc[idx, "next_stop"] = f"{travel_time.seconds // 60} min"
+
+    time_data = time_data.drop(["arrival_time_parsed", "departure_time_parsed"], axis=1)
+
+    return chart_data, time_data
@@ -0,0 +1,123 @@
+import csv
+import io
+import os
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+from timetable import STOP_TIMES_COLUMNS
+
+INGEST_WORKERS = int(os.environ.get("COMMUTE_INGEST_WORKERS", os.cpu_count() or 1))
+# only these columns of the large tables are parsed, the app uses no others
+COLUMNS = {"stop_times": STOP_TIMES_COLUMNS}
+BLOCK_SIZE = 16 << 20
+
+
+def _members(path, tables):
+    # (table name, opener) of every non-empty GTFS file, zipped or in a folder
+    path = Path(path)
+    if path.is_dir():
+        return [
+            (file.stem, lambda file=file: open(file, "rb"))
+            for file in sorted(path.glob("*.txt"))
+            if file.stem in tables and file.stat().st_size
+        ]
+    with zipfile.ZipFile(path) as archive:
+        names = [
+            info.filename
+            for info in archive.infolist()
+            if info.filename.endswith(".txt")
+            and Path(info.filename).stem in tables
+            and info.file_size
+        ]
+
+    def opener(name):
+        # every table gets its own handle, the threads do not share a position
+        archive = zipfile.ZipFile(path)
+        return archive.open(name)
+
+    return [(Path(name).stem, lambda name=name: opener(name)) for name in names]
+
+
+def _header(opener):
+    with opener() as file:
+        line = io.TextIOWrapper(file, encoding="utf-8-sig").readline()
+    return next(csv.reader([line]), [])
+
+
+def read_table(opener, string_columns, columns=None):
+    """Parse one GTFS file with the multi-threaded CSV reader of pyarrow.
+
+    Like gtfs_kit, ids and times are strings, other columns are inferred and
+    whitespace around column names is stripped.
+    """
+    import pyarrow as pa
+    import pyarrow.csv
+
+    header = _header(opener)
+    names = [name.strip() for name in header]
+    keep = [
+        raw for raw, name in zip(header, names) if columns is None or name in columns
+    ]
+    with opener() as file:
+        table = pyarrow.csv.read_csv(
+            file,
+            read_options=pyarrow.csv.ReadOptions(
+                use_threads=True, block_size=BLOCK_SIZE
+            ),
+            convert_options=pyarrow.csv.ConvertOptions(
+                column_types={
+                    raw: pa.string()
+                    for raw, name in zip(header, names)
+                    if name in string_columns
+                },
+                include_columns=keep,
+                strings_can_be_null=True,
+            ),
+        )
+    table = table.rename_columns([name.strip() for name in table.column_names])
+    # dates or times pyarrow recognized stay text like with pandas
+    for position, field in enumerate(table.schema):
+        if not (
+            pa.types.is_integer(field.type)
+            or pa.types.is_floating(field.type)
+            or pa.types.is_string(field.type)
+        ):
+            table = table.set_column(
+                position, field.name, table.column(position).cast(pa.string())
+            )
+    frame = table.to_pandas()
+    # missing text is NaN like with pandas, not None
+    for column in table.column_names:
+        if table.column(column).null_count and frame[column].dtype == object:
+            frame.loc[frame[column].isna(), column] = np.nan
+    return frame if len(frame) else None
+
+
+def read_feed(path, columns=COLUMNS, workers=INGEST_WORKERS):
+    """Read a GTFS zip or folder into a gtfs_kit feed, the tables in parallel.
+
+    The largest tables are started first, so they do not end up last on a
+    busy pool.
+    """
+    # gtfs_kit pulls in geopandas and shapely, only needed once the feed is read
+    import gtfs_kit
+    from gtfs_kit import constants
+
+    tables = set(constants.GTFS_REF["table"])
+    string_columns = {
+        column for column, dtype in constants.DTYPE.items() if dtype is str
+    }
+    members = _members(path, tables)
+    members.sort(key=lambda member: member[0] != "stop_times")
+    with ThreadPoolExecutor(max(workers, 1), "ingest") as executor:
+        frames = executor.map(
+            lambda member: read_table(
+                member[1], string_columns, columns.get(member[0])
+            ),
+            members,
+        )
+        feed_tables = dict(zip((name for name, _ in members), frames))
+    return gtfs_kit.Feed(dist_units="km", **feed_tables)
@@ -1,39 +1,82 @@
-import re
+import logging
+from functools import partial
 
-import folium
 import pandas as pd
 import streamlit as st
 from st_pages import add_page_title, show_pages_from_config
-from streamlit_folium import st_folium
 
 from processing import (
+    WEEKDAYS,
+    cache_warmer,
+    feed_version,
     find_shared,
-    get_routes,
+    get_routes_concurrently,
     get_stops,
+    get_stops_concurrently,
+    layer_cache,
     load_feed,
+    metrics_exporters,
     parse_stations,
+    prefetch_destinations,
+    record_selection,
+    station_grid,
+    station_index,
     route_details,
+    serve_network_tiles,
 )
 from rendering import (
+    DESTINATION_STYLES,
+    draw_destination_layers,
+    draw_network,
     draw_route_detail,
-    draw_routes,
     draw_stations,
     generate_main_legend,
     generate_sub_a_legend,
     generate_sub_b_legend,
+    layer_key,
+    new_map,
+    payload_size,
+    show_map,
 )
+from spans import start_trace, summarize
 
 MAP_CENTER = (46.848, 8.1336)
-COLORS = ["#ffffbf", "#91bfdb"]
+COLORS = [color for color, _ in DESTINATION_STYLES]
 COLOR_SHARED = "#fc8d59"
 
+logger = logging.getLogger(__name__)
+
 # Streamlit app
 #####
 add_page_title(page_title="Home", layout="wide")
 show_pages_from_config()
 
+# the processing and rendering stages of this rerun, for the debug sidebar
+trace = start_trace()
+
+metrics_exporters()
 feed = load_feed()
 stations = parse_stations(feed)
+station_names = station_index(feed)
+station_locations = station_grid(feed)
+network_tiles = serve_network_tiles(feed)
+layers = layer_cache()
+warmer = cache_warmer()
+
+with st.sidebar.expander("Cache"):
+    warmup_status = warmer.status()
+    st.progress(
+        warmup_status["done"] / max(warmup_status["total"], 1),
+        f"Warm-up {warmup_status['state']}: "
+        f"{warmup_status['done']}/{warmup_status['total']} stations",
+    )
+    st.caption(
+        f"Query cache hit rate {warmup_status['query_cache']['hit_rate']:.0%}, "
+        f"layer cache hit rate {warmup_status['layer_cache']['hit_rate']:.0%}"
+    )
+
+show_timings = st.sidebar.toggle("Show timings", key="show_timings")
+timings_container = st.sidebar.container()
 
 
 ## Filters
@@ -41,59 +84,101 @@ stations = parse_stations(feed)
 filter_container = st.container()
 filter_col1, filter_col2 = filter_container.columns(2)
 
+# a click next to the stations on the map picks the closest one as destination,
+# widget values can only be set before the widgets are created
+snapped_station = st.session_state.pop("snapped_station", None)
+if snapped_station is not None:
+    if st.session_state.get("destination_a") is None:
+        st.session_state["destination_a"] = snapped_station
+    else:
+        st.session_state["destination_b"] = snapped_station
+
 # TODO restricted to two for now, have it variable to min two and higher max
 selected_city_a = filter_col1.selectbox(
     "Destination A",
     stations["stop_id"],
     None,
-    format_func=lambda id: stations.loc[stations["stop_id"] == id]["stop_name"].iloc[0],
+    format_func=station_names.name,
+    key="destination_a",
 )
 selected_city_b = filter_col1.selectbox(
     "Destination B",
     stations["stop_id"],
     None,
-    format_func=lambda id: stations.loc[stations["stop_id"] == id]["stop_name"].iloc[0],
+    format_func=station_names.name,
+    key="destination_b",
 )
 
-routes_a = get_routes(feed, selected_city_a)
-routes_b = get_routes(feed, selected_city_b)
+record_selection("a", selected_city_a)
+record_selection("b", selected_city_b)
+
+# both destinations are processed at the same time
+(routes_a, routes_b), _ = get_routes_concurrently(
+    feed, [selected_city_a, selected_city_b]
+)
 all_routes = (
     pd.concat([routes_a, routes_b])
     .drop_duplicates(subset="route_id")
     .sort_values("route_short_name")
 )
 
+route_names = dict(zip(all_routes["route_id"], all_routes["route_short_name"]))
 route_exclusion = filter_col2.multiselect(
     "Exclude lines (optional)",
     all_routes["route_id"],
-    format_func=lambda id: all_routes.loc[all_routes["route_id"] == id][
-        "route_short_name"
-    ].iloc[0],
+    format_func=route_names.get,
 )
 active_weekdays = filter_col2.multiselect(
     "Active weekdays",
-    ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"],
-    ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday"],
+    WEEKDAYS,
+    WEEKDAYS[:5],
 )
 relevant_hours = filter_col2.slider("Relevant hours", 0, 23, (6, 22), 1)
 
 if selected_city_a is not None and selected_city_a == selected_city_b:
     st.error("Same cities selected")
 
-stops_a = get_stops(
+(stops_a, stops_b), _ = get_stops_concurrently(
     feed,
-    routes_a.loc[~routes_a["route_id"].isin(route_exclusion)]["route_id"],
+    [
+        routes_a.loc[~routes_a["route_id"].isin(route_exclusion)]["route_id"],
+        routes_b.loc[~routes_b["route_id"].isin(route_exclusion)]["route_id"],
+    ],
     active_weekdays,
     relevant_hours,
 )
-stops_b = get_stops(
+
+shared_stops = find_shared(stops_a, stops_b)
+
+prefetch_destinations(
     feed,
-    routes_b.loc[~routes_b["route_id"].isin(route_exclusion)]["route_id"],
+    selected_city_a,
+    stops_a,
+    selected_city_b,
+    route_exclusion,
     active_weekdays,
     relevant_hours,
 )
 
-shared_stops = find_shared(stops_a, stops_b)
+# rendered layers only depend on the station and the filters relevant to it
+layer_key_a = partial(
+    layer_key,
+    feed_version(feed),
+    selected_city_a,
+    active_weekdays,
+    relevant_hours,
+    routes_a.loc[routes_a["route_id"].isin(route_exclusion)]["route_id"],
+)
+layer_key_b = partial(
+    layer_key,
+    feed_version(feed),
+    selected_city_b,
+    active_weekdays,
+    relevant_hours,
+    routes_b.loc[routes_b["route_id"].isin(route_exclusion)]["route_id"],
+)
+layers_a = draw_destination_layers(layers, layer_key_a, stops_a, *DESTINATION_STYLES[0])
+layers_b = draw_destination_layers(layers, layer_key_b, stops_b, *DESTINATION_STYLES[1])
 
 st.markdown("""---""")
 ## Content
@@ -102,16 +187,12 @@ map_container = st.container()
 
 # with does not create a scope
 with map_container:
-    map_main = folium.Map(tiles="cartodbpositron")
+    map_main = new_map()
 
     # TODO if there are 100% shared routes, highlight
     COLOR_A = COLORS[0]
     COLOR_B = COLORS[1]
 
-    routes_a_layer = draw_routes(stops_a, "#808080", "single")
-    routes_b_layer = draw_routes(stops_b, "#808080", "single")
-    stations_a_layer = draw_stations(stops_a, COLOR_A)
-    stations_b_layer = draw_stations(stops_b, COLOR_B)
     stations_shared_layer = draw_stations(shared_stops, COLOR_SHARED, "square")
 
     # if start is in shared use shared color
@@ -135,20 +216,25 @@ with map_container:
         "star",
     )
 
-    routes_a_layer.add_to(map_main)
-    routes_b_layer.add_to(map_main)
-    stations_a_layer.add_to(map_main)
-    stations_b_layer.add_to(map_main)
+    if network_tiles is not None:
+        draw_network(
+            network_tiles,
+            all_routes.loc[~all_routes["route_id"].isin(route_exclusion)]["route_id"],
+        ).add_to(map_main)
+    layers_a["routes"].add_to(map_main)
+    layers_b["routes"].add_to(map_main)
+    layers_a["stations"].add_to(map_main)
+    layers_b["stations"].add_to(map_main)
     stations_shared_layer.add_to(map_main)
     start_a.add_to(map_main)
     start_b.add_to(map_main)
 
     map_main.get_root().add_child(generate_main_legend())
 
-    selection = st_folium(
+    selection = show_map(
         map_main,
         height=800,
-        returned_objects=["last_object_clicked_tooltip"],
+        returned_objects=["last_active_drawing", "last_clicked", "last_object_clicked"],
         zoom=8,
         center=MAP_CENTER,
         use_container_width=True,
@@ -157,6 +243,23 @@ with map_container:
 
     st.markdown(f"Destination A and B have {len(shared_stops)} shared stations.")
 
+    # a click on a route or station also sets the object click to the same
+    # position, only clicks next to them pick a station
+    clicked = selection["last_clicked"]
+    if (
+        clicked
+        and clicked != st.session_state.get("last_clicked")
+        and clicked != selection["last_object_clicked"]
+    ):
+        st.session_state["last_clicked"] = clicked
+        nearest, _ = station_locations.nearest(clicked["lat"], clicked["lng"])
+        st.session_state["snapped_station"] = nearest[0]
+        st.rerun()
+    st.session_state["last_clicked"] = clicked
+
+    if logger.isEnabledFor(logging.INFO):
+        logger.info("main map payload: %d bytes", payload_size(map_main))
+
 
 station_distance_container = st.container()
 with station_distance_container:
@@ -164,12 +267,15 @@ with station_distance_container:
     # after selected route
     # display every station and how long it takes to get from each one
     # some kind of graph
-    if selection["last_object_clicked_tooltip"]:
-        id_match = re.match(r"\[(.+)\]", selection["last_object_clicked_tooltip"])
-        if id_match:
+    if selection["last_active_drawing"]:
+        # stations have no route id
+        route_id = (
+            selection["last_active_drawing"].get("properties", {}).get("route_id")
+        )
+        if route_id:
             selected_route = get_stops(
                 feed,
-                [id_match[1]],
+                [route_id],
                 active_weekdays,
                 relevant_hours,
             )
@@ -192,9 +298,7 @@ mini_a, mini_b = mini_map_container.columns(2)
 
 with mini_a:
     st.markdown("## Routes and stations of destination A")
-    map_a = folium.Map(tiles="cartodbpositron")
-    routes_a_layer = draw_routes(stops_a, "plasma")
-    stations_a_layer = draw_stations(stops_a, "#ffffbf")
+    map_a = new_map()
     start_a = draw_stations(
         stops_a.loc[stops_a["parent_station"] == selected_city_a].drop_duplicates(
             "parent_station"
@@ -203,12 +307,14 @@ with mini_a:
         "star",
     )
 
-    routes_a_layer.add_to(map_a)
-    stations_a_layer.add_to(map_a)
+    if network_tiles is not None:
+        draw_network(network_tiles, stops_a["route_id"].unique()).add_to(map_a)
+    layers_a["mini_routes"].add_to(map_a)
+    layers_a["mini_stations"].add_to(map_a)
     start_a.add_to(map_a)
 
     map_a.get_root().add_child(generate_sub_a_legend())
-    st_folium(
+    show_map(
         map_a,
         height=400,
         zoom=8,
@@ -220,9 +326,7 @@ with mini_a:
 
 with mini_b:
     st.markdown("## Routes and stations of destination B")
-    map_b = folium.Map(tiles="cartodbpositron")
-    routes_b_layer = draw_routes(stops_b, "viridis")
-    stations_b_layer = draw_stations(stops_b, "#91bfdb")
+    map_b = new_map()
     start_b = draw_stations(
         stops_b.loc[stops_b["parent_station"] == selected_city_b].drop_duplicates(
             "parent_station"
@@ -231,12 +335,14 @@ with mini_b:
         "star",
     )
 
-    routes_b_layer.add_to(map_b)
-    stations_b_layer.add_to(map_b)
+    if network_tiles is not None:
+        draw_network(network_tiles, stops_b["route_id"].unique()).add_to(map_b)
+    layers_b["mini_routes"].add_to(map_b)
+    layers_b["mini_stations"].add_to(map_b)
     start_b.add_to(map_b)
 
     map_b.get_root().add_child(generate_sub_b_legend())
-    st_folium(
+    show_map(
         map_b,
         height=400,
         zoom=8,
@@ -245,3 +351,11 @@ with mini_b:
         key="mini_map_b",
         returned_objects=[],
     )
+
+if show_timings:
+    # cached results only show up as hits, their stages did not run
+    timings_container.dataframe(
+        summarize(trace)[["name", "ms", "rows_in", "rows_out", "cached"]],
+        hide_index=True,
+        use_container_width=True,
+    )
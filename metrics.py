@@ -0,0 +1,323 @@
+import logging
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import spans
+
+# a local port to serve /metrics on or a file to write them to, both are off
+# unless set
+METRICS_PORT = os.environ.get("COMMUTE_METRICS_PORT")
+METRICS_FILE = os.environ.get("COMMUTE_METRICS_FILE")
+METRICS_INTERVAL = float(os.environ.get("COMMUTE_METRICS_INTERVAL", 15))
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+# seconds, from a cache hit to a cold load of a large feed
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+# the cache label of a span, the cached functions go by their own name
+CACHES = {"layer": "layers"}
+
+logger = logging.getLogger(__name__)
+
+
+def _escape(value):
+    return str(value).replace("\\", r"\\").replace('"', r"\"").replace("\n", r"\n")
+
+
+def _labels(names, values):
+    if not names:
+        return ""
+    return (
+        "{"
+        + ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+        + "}"
+    )
+
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """A counter or gauge with one value per combination of label values."""
+
+    def __init__(self, name, help, kind, labels=()):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def set(self, value, *label_values):
+        with self._lock:
+            self._values[label_values] = value
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        return [
+            f"{self.name}{_labels(self.labels, label_values)} {_number(value)}"
+            for label_values, value in sorted(values.items())
+        ]
+
+
+class Histogram(Metric):
+    def __init__(self, name, help, labels=(), buckets=BUCKETS):
+        super().__init__(name, help, "histogram", labels)
+        self.buckets = (*buckets, float("inf"))
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            counts, total = self._values.get(
+                label_values, ([0] * len(self.buckets), 0.0)
+            )
+            for position, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[position] += 1
+                    break
+            self._values[label_values] = (counts, total + value)
+
+    def samples(self):
+        with self._lock:
+            values = {
+                key: (list(counts), total)
+                for key, (counts, total) in self._values.items()
+            }
+        lines = []
+        for label_values, (counts, total) in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                labels = _labels((*self.labels, "le"), (*label_values, _number(bound)))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = _labels(self.labels, label_values)
+            lines.append(f"{self.name}_sum{labels} {_number(total)}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Registry:
+    """Metrics in the Prometheus text format.
+
+    Collectors are called before every render, for values which are read
+    rather than counted.
+    """
+
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self.add(Metric(name, help, "counter", labels))
+
+    def gauge(self, name, help, labels=()):
+        return self.add(Metric(name, help, "gauge", labels))
+
+    def histogram(self, name, help, labels=(), buckets=BUCKETS):
+        return self.add(Histogram(name, help, labels, buckets))
+
+    def render(self):
+        for collect in self.collectors:
+            try:
+                collect()
+            except Exception:
+                logger.warning("collecting metrics failed", exc_info=True)
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+STAGE_SECONDS = REGISTRY.histogram(
+    "commute_stage_duration_seconds",
+    "Duration of the processing and rendering stages, cache hits included.",
+    ("stage",),
+)
+CACHE_REQUESTS = REGISTRY.counter(
+    "commute_cache_requests_total",
+    "Lookups of the cached queries and rendered layers.",
+    ("cache", "result"),
+)
+CACHE_EVICTIONS = REGISTRY.counter(
+    "commute_cache_evictions_total",
+    "Entries evicted to stay within the memory budget.",
+    ("cache",),
+)
+CACHE_BYTES = REGISTRY.gauge(
+    "commute_cache_bytes", "Estimated size of the cached entries.", ("cache",)
+)
+CACHE_ENTRIES = REGISTRY.gauge(
+    "commute_cache_entries", "Number of cached entries.", ("cache",)
+)
+FEED_LOAD_SECONDS = REGISTRY.gauge(
+    "commute_feed_load_seconds", "Duration of the last feed load."
+)
+FEED_MEMORY = REGISTRY.gauge(
+    "commute_feed_memory_bytes",
+    "Memory of the tables of the loaded feed.",
+    ("version",),
+)
+PROCESS_MEMORY = REGISTRY.gauge(
+    "process_resident_memory_bytes", "Resident memory of the process."
+)
+
+
+def _resident_bytes():
+    with open("/proc/self/status") as status:
+        for line in status:
+            if line.startswith("VmRSS:"):
+                return int(line.split()[1]) * 1024
+    return None
+
+
+def record_span(record):
+    # stages are named by their path, a cached function called by another
+    # one still counts for its cache
+    STAGE_SECONDS.observe(record["ms"] / 1000, record["name"])
+    if record["cached"] is not None:
+        name = record["name"].rsplit(".", 1)[-1]
+        CACHE_REQUESTS.inc(
+            CACHES.get(name, name), "hit" if record["cached"] else "miss"
+        )
+    if record["name"] == "load_feed":
+        FEED_LOAD_SECONDS.set(record["ms"] / 1000)
+
+
+def _evicted_query(key):
+    # the query cache keys start with the function name
+    CACHE_EVICTIONS.inc(CACHES.get(key[0], key[0]))
+
+
+def install(query_cache, layer_cache=None, feed=None):
+    """Count the spans and evictions and read the cache sizes and feed memory.
+
+    The feed memory is measured once, after the feed is loaded.
+    """
+    spans.add_listener(record_span)
+    query_cache.on_evict = _evicted_query
+    caches = {"query": query_cache}
+    if layer_cache is not None:
+        layer_cache.on_evict = lambda key: CACHE_EVICTIONS.inc("layers")
+        caches["layers"] = layer_cache
+
+    def collect():
+        for name, cache in caches.items():
+            stats = cache.stats()
+            CACHE_BYTES.set(stats["bytes"], name)
+            CACHE_ENTRIES.set(stats["entries"], name)
+        resident = _resident_bytes()
+        if resident is not None:
+            PROCESS_MEMORY.set(resident)
+
+    REGISTRY.collectors.append(collect)
+    if feed is not None:
+        track_feed(feed)
+
+
+def track_feed(feed):
+    import core
+
+    def measure():
+        # waits for a lazy feed
+        FEED_MEMORY.set(core.feed_memory(feed), core.feed_version(feed))
+
+    threading.Thread(target=measure, name="feed-memory", daemon=True).start()
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    registry = REGISTRY
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        content = self.registry.render().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+class MetricsServer:
+    """Serves /metrics for Prometheus to scrape."""
+
+    def __init__(self, registry=REGISTRY, host="127.0.0.1", port=0):
+        handler = type("Handler", (MetricsRequestHandler,), {"registry": registry})
+        self.httpd = ThreadingHTTPServer((host, port), handler)
+        self.httpd.daemon_threads = True
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/metrics"
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+
+
+class FileExporter:
+    """Writes the metrics to a file every `interval` seconds.
+
+    The file is replaced in one step, for the textfile collector of the node
+    exporter.
+    """
+
+    def __init__(self, path, registry=REGISTRY, interval=METRICS_INTERVAL):
+        self.path = Path(path)
+        self.registry = registry
+        self.interval = interval
+        self._stop = threading.Event()
+
+    def write(self):
+        temporary = self.path.with_name(f".{self.path.name}.tmp")
+        temporary.write_text(self.registry.render())
+        os.replace(temporary, self.path)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.write()
+            except OSError:
+                logger.warning("could not write %s", self.path, exc_info=True)
+
+    def start(self):
+        threading.Thread(target=self._run, name="metrics-file", daemon=True).start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        self.write()
+
+
+def start_exporters(port=METRICS_PORT, path=METRICS_FILE):
+    """The exporters which are configured, none by default."""
+    exporters = []
+    if port:
+        server = MetricsServer(port=int(port)).start()
+        logger.info("serving metrics on %s", server.url)
+        exporters.append(server)
+    if path:
+        exporters.append(FileExporter(path).start())
+    return exporters
@@ -0,0 +1,78 @@
+import numpy as np
+
+# the 256 colors of the matplotlib colormaps the maps use, as packed hex
+COLORMAPS = {
+    "plasma": (
+        "0d088710078813078916078a19068c1b068d1d068e20068f220690240691"
+        "2605912805922a05932c05942e05952f0596310597330597350498370499"
+        "38049a3a049a3c049b3e049c3f049c41049d43039e44039e46039f48039f"
+        "4903a04b03a14c02a14e02a25002a25102a35302a35502a45601a45801a4"
+        "5901a55b01a55c01a65e01a66001a66100a76300a76400a76600a76700a8"
+        "6900a86a00a86c00a86e00a86f00a87100a87201a87401a87501a87701a8"
+        "7801a87a02a87b02a87d03a87e03a88004a88104a78305a78405a78606a6"
+        "8707a68808a68a09a58b0aa58d0ba58e0ca48f0da4910ea3920fa39410a2"
+        "9511a19613a19814a099159f9a169f9c179e9d189d9e199da01a9ca11b9b"
+        "a21d9aa31e9aa51f99a62098a72197a82296aa2395ab2494ac2694ad2793"
+        "ae2892b02991b12a90b22b8fb32c8eb42e8db52f8cb6308bb7318ab83289"
+        "ba3388bb3488bc3587bd3786be3885bf3984c03a83c13b82c23c81c33d80"
+        "c43e7fc5407ec6417dc7427cc8437bc9447aca457acb4679cc4778cc4977"
+        "cd4a76ce4b75cf4c74d04d73d14e72d24f71d35171d45270d5536fd5546e"
+        "d6556dd7566cd8576bd9586ada5a6ada5b69db5c68dc5d67dd5e66de5f65"
+        "de6164df6263e06363e16462e26561e26660e3685fe4695ee56a5de56b5d"
+        "e66c5ce76e5be76f5ae87059e97158e97257ea7457eb7556eb7655ec7754"
+        "ed7953ed7a52ee7b51ef7c51ef7e50f07f4ff0804ef1814df1834cf2844b"
+        "f3854bf3874af48849f48948f58b47f58c46f68d45f68f44f79044f79143"
+        "f79342f89441f89540f9973ff9983ef99a3efa9b3dfa9c3cfa9e3bfb9f3a"
+        "fba139fba238fca338fca537fca636fca835fca934fdab33fdac33fdae32"
+        "fdaf31fdb130fdb22ffdb42ffdb52efeb72dfeb82cfeba2cfebb2bfebd2a"
+        "febe2afec029fdc229fdc328fdc527fdc627fdc827fdca26fdcb26fccd25"
+        "fcce25fcd025fcd225fbd324fbd524fbd724fad824fada24f9dc24f9dd25"
+        "f8df25f8e125f7e225f7e425f6e626f6e826f5e926f5eb27f4ed27f3ee27"
+        "f3f027f2f227f1f426f1f525f0f724f0f921"
+    ),
+    "viridis": (
+        "44015444025645045745055946075a46085c460a5d460b5e470d60470e61"
+        "47106347116447136548146748166848176948186a481a6c481b6d481c6e"
+        "481d6f481f70482071482173482374482475482576482677482878482979"
+        "472a7a472c7a472d7b472e7c472f7d46307e46327e46337f463480453581"
+        "453781453882443983443a83443b84433d84433e85423f85424086424186"
+        "4142874144874045884046883f47883f48893e49893e4a893e4c8a3d4d8a"
+        "3d4e8a3c4f8a3c508b3b518b3b528b3a538b3a548c39558c39568c38588c"
+        "38598c375a8c375b8d365c8d365d8d355e8d355f8d34608d34618d33628d"
+        "33638d32648e32658e31668e31678e31688e30698e306a8e2f6b8e2f6c8e"
+        "2e6d8e2e6e8e2e6f8e2d708e2d718e2c718e2c728e2c738e2b748e2b758e"
+        "2a768e2a778e2a788e29798e297a8e297b8e287c8e287d8e277e8e277f8e"
+        "27808e26818e26828e26828e25838e25848e25858e24868e24878e23888e"
+        "23898e238a8d228b8d228c8d228d8d218e8d218f8d21908d21918c20928c"
+        "20928c20938c1f948c1f958b1f968b1f978b1f988b1f998a1f9a8a1e9b8a"
+        "1e9c891e9d891f9e891f9f881fa0881fa1881fa1871fa28720a38620a486"
+        "21a58521a68522a78522a88423a98324aa8325ab8225ac8226ad8127ad81"
+        "28ae8029af7f2ab07f2cb17e2db27d2eb37c2fb47c31b57b32b67a34b679"
+        "35b77937b87838b9773aba763bbb753dbc743fbc7340bd7242be7144bf70"
+        "46c06f48c16e4ac16d4cc26c4ec36b50c46a52c56954c56856c66758c765"
+        "5ac8645cc8635ec96260ca6063cb5f65cb5e67cc5c69cd5b6ccd5a6ece58"
+        "70cf5773d05675d05477d1537ad1517cd2507fd34e81d34d84d44b86d549"
+        "89d5488bd6468ed64590d74393d74195d84098d83e9bd93c9dd93ba0da39"
+        "a2da37a5db36a8db34aadc32addc30b0dd2fb2dd2db5de2bb8de29bade28"
+        "bddf26c0df25c2df23c5e021c8e020cae11fcde11dd0e11cd2e21bd5e21a"
+        "d8e219dae319dde318dfe318e2e418e5e419e7e419eae51aece51befe51c"
+        "f1e51df4e61ef6e620f8e621fbe723fde725"
+    ),
+}
+
+
+def color_palette(name, n_colors):
+    """`n_colors` hex colors spread over a colormap, like seaborn.color_palette.
+
+    The ends of the colormap are left out. Colormaps other than `COLORMAPS`
+    come from seaborn, which is only imported for them.
+    """
+    if name not in COLORMAPS:
+        import seaborn
+
+        return seaborn.color_palette(name, n_colors=n_colors).as_hex()
+    packed = COLORMAPS[name]
+    count = len(packed) // 6
+    bins = np.linspace(0, 1, int(n_colors) + 2)[1:-1]
+    indices = np.minimum((bins * count).astype(int), count - 1)
+    return [f"#{packed[index * 6 : index * 6 + 6]}" for index in indices]
@@ -0,0 +1,205 @@
+import json
+import os
+import shutil
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from timetable import time_to_seconds, trip_hashes
+
+# the routes are hashed into this many partitions of the stop times
+PARTITIONS = int(os.environ.get("COMMUTE_PARTITIONS", 32))
+ROW_GROUP_ROWS = 64 * 1024
+TABLES = ["routes", "trips", "stops", "calendar", "calendar_dates", "ghost_stops"]
+# added to the stored stop times, only used to find and order the rows
+STORAGE_COLUMNS = ["partition", "route_id", "row"]
+
+
+def dataset_path(feed_path, version):
+    # one directory per feed version, a feed update removes the old one once
+    # nothing uses that feed any more
+    return Path(feed_path).with_name(f"{Path(feed_path).stem}.{version}.parquet")
+
+
+def route_partitions(route_ids, partitions=PARTITIONS):
+    # the hash of pandas is stable across processes, unlike hash()
+    hashes = pd.util.hash_array(np.asarray(route_ids, dtype=object))
+    return (hashes % np.uint64(partitions)).astype(np.int32)
+
+
+def build_dataset(feed, path, partitions=PARTITIONS):
+    """Write a loaded feed with the stop times partitioned by route.
+
+    The stop times are sorted by route in every partition, so the statistics
+    of a row group tell which routes it holds.
+    """
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+
+    path = Path(path)
+    temporary = path.with_suffix(".tmp")
+    shutil.rmtree(temporary, ignore_errors=True)
+    temporary.mkdir(parents=True)
+    for name in TABLES:
+        table = getattr(feed, name, None)
+        if table is not None:
+            table.to_parquet(temporary / f"{name}.parquet", index=False)
+
+    stop_times = feed.stop_times.reset_index(drop=True)
+    route_ids = stop_times["trip_id"].map(feed.trips.set_index("trip_id")["route_id"])
+    stop_times = stop_times.assign(
+        arrival_seconds=time_to_seconds(stop_times["arrival_time"]),
+        departure_seconds=time_to_seconds(stop_times["departure_time"]),
+        partition=route_partitions(route_ids, partitions),
+        route_id=route_ids,
+        row=np.arange(len(stop_times)),
+    ).sort_values(["partition", "route_id", "row"], kind="stable")
+    # hashed now, a feed update compares them without reading the stop times
+    trip_hashes(stop_times, ("arrival_seconds", "departure_seconds")).rename_axis(
+        "trip_id"
+    ).reset_index().to_parquet(temporary / "trip_hashes.parquet", index=False)
+    # which routes call at a stop, small enough to keep in memory
+    stop_times[["stop_id", "route_id"]].drop_duplicates().to_parquet(
+        temporary / "stop_routes.parquet", index=False
+    )
+    ds.write_dataset(
+        pa.Table.from_pandas(stop_times, preserve_index=False),
+        temporary / "stop_times",
+        format="parquet",
+        partitioning=ds.partitioning(
+            pa.schema([("partition", pa.int32())]), flavor="hive"
+        ),
+        min_rows_per_group=ROW_GROUP_ROWS,
+        max_rows_per_group=ROW_GROUP_ROWS,
+    )
+    # written last, a directory without it is incomplete
+    (temporary / "metadata.json").write_text(
+        json.dumps(
+            {
+                "version": str(feed.version),
+                "partitions": partitions,
+                "ghost_stops_dropped": getattr(feed, "ghost_stops_dropped", False),
+            }
+        )
+    )
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(temporary, path)
+    return path
+
+
+def dataset_version(path):
+    metadata = Path(path) / "metadata.json"
+    if not metadata.exists():
+        return None
+    return json.loads(metadata.read_text())["version"]
+
+
+class PartitionedFeed:
+    """A feed with the stop times read on demand from a partitioned dataset.
+
+    Everything but the stop times is kept in memory. Reads only touch the
+    partitions and row groups of the routes of the asked for trips and only
+    the needed columns.
+    """
+
+    def __init__(self, path):
+        import pyarrow.dataset as ds
+
+        self.path = Path(path)
+        metadata = json.loads((self.path / "metadata.json").read_text())
+        self.version = metadata["version"]
+        self.partitions = metadata["partitions"]
+        self.ghost_stops_dropped = metadata.get("ghost_stops_dropped", False)
+        for name in TABLES:
+            table = self.path / f"{name}.parquet"
+            setattr(self, name, pd.read_parquet(table) if table.exists() else None)
+        if self.ghost_stops is None:
+            self.ghost_stops = pd.DataFrame(columns=["route_id", "parent_station"])
+        # missing in datasets built before the hashes were stored
+        hashes = self.path / "trip_hashes.parquet"
+        self.trip_hashes = (
+            pd.read_parquet(hashes).set_index("trip_id")["hash"]
+            if hashes.exists()
+            else None
+        )
+        self._trip_routes = self.trips.set_index("trip_id")["route_id"]
+        self._stop_routes = pd.read_parquet(self.path / "stop_routes.parquet")
+        self.dataset = ds.dataset(
+            self.path / "stop_times", format="parquet", partitioning="hive"
+        )
+        self.columns = [
+            column
+            for column in self.dataset.schema.names
+            if column not in STORAGE_COLUMNS + ["arrival_seconds", "departure_seconds"]
+        ]
+
+    @staticmethod
+    def _strings(values):
+        import pyarrow as pa
+
+        # typed, an empty list would not match the column type
+        return pa.array(list(values), pa.string())
+
+    @property
+    def stop_times(self):
+        return self.stop_times_of()
+
+    def _read(self, columns, condition=None):
+        table = self.dataset.to_table(columns=[*columns, "row"], filter=condition)
+        return (
+            table.to_pandas()
+            .sort_values("row", kind="stable")
+            .drop(columns="row")
+            .reset_index(drop=True)
+        )
+
+    def _routes_condition(self, route_ids):
+        import pyarrow as pa
+        import pyarrow.dataset as ds
+
+        # the partitions and the route statistics skip most of the files
+        partitions = pa.array(
+            np.unique(route_partitions(route_ids, self.partitions)), pa.int32()
+        )
+        return ds.field("partition").isin(partitions) & ds.field("route_id").isin(
+            self._strings(route_ids)
+        )
+
+    def stop_times_of(self, trip_ids=None, times="text"):
+        import pyarrow.dataset as ds
+
+        columns = [
+            column
+            for column in self.columns
+            if times == "text" or column not in ("arrival_time", "departure_time")
+        ]
+        if times == "seconds":
+            columns += ["arrival_seconds", "departure_seconds"]
+        condition = None
+        if trip_ids is not None:
+            trip_ids = pd.unique(pd.Series(trip_ids, dtype=object))
+            condition = self._routes_condition(
+                self._trip_routes.reindex(trip_ids).dropna().unique()
+            ) & ds.field("trip_id").isin(self._strings(trip_ids))
+        stop_times = self._read(columns, condition)
+        if times == "seconds":
+            stop_times = stop_times.rename(
+                columns={
+                    "arrival_seconds": "arrival_time_parsed",
+                    "departure_seconds": "departure_time_parsed",
+                }
+            )
+        return stop_times
+
+    def trips_at(self, stop_ids):
+        import pyarrow.dataset as ds
+
+        stop_ids = list(stop_ids)
+        route_ids = self._stop_routes.loc[
+            self._stop_routes["stop_id"].isin(stop_ids), "route_id"
+        ].unique()
+        condition = self._routes_condition(route_ids) & ds.field("stop_id").isin(
+            self._strings(stop_ids)
+        )
+        return self._read(["trip_id"], condition)["trip_id"].unique()
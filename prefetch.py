@@ -0,0 +1,104 @@
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import core
+from warmup import DEFAULT_STATIONS
+
+logger = logging.getLogger(__name__)
+
+PREFETCH_WORKERS = int(os.environ.get("COMMUTE_PREFETCH_WORKERS", 2))
+PREFETCH_COUNT = int(os.environ.get("COMMUTE_PREFETCH_COUNT", 8))
+
+
+def likely_destinations(index, station_a, stops_a, usage=None, count=PREFETCH_COUNT):
+    """Station ids which are likely picked as destination B after `station_a`.
+
+    Previously picked stations first, then the big hubs, then the stations
+    most of the lines of A call at.
+    """
+    on_lines = (
+        stops_a.groupby("parent_station")["route_id"]
+        .nunique()
+        .sort_values(ascending=False, kind="stable")
+        .index
+    )
+    candidates = (
+        (usage.top(count + 1) if usage else [])
+        + [index.resolve(name) for name in DEFAULT_STATIONS]
+        + list(on_lines)
+    )
+
+    station_ids = []
+    for station_id in candidates:
+        if station_id != station_a and station_id in index:
+            if station_id not in station_ids:
+                station_ids.append(station_id)
+        if len(station_ids) == count:
+            break
+    return station_ids
+
+
+class PrefetchJob:
+    """The prefetches of one selection, cancelled as a whole."""
+
+    def __init__(self, key):
+        self.key = key
+        self.futures = []
+        self._cancelled = threading.Event()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def cancel(self):
+        # queued prefetches are dropped, running ones stop at the next step
+        self._cancelled.set()
+        for future in self.futures:
+            future.cancel()
+
+    def status(self):
+        done = [future for future in self.futures if future.done()]
+        return {
+            "total": len(self.futures),
+            "done": len(done),
+            "cancelled": sum(future.cancelled() for future in done),
+        }
+
+
+class Prefetcher:
+    """Computes the stops of likely next destinations on a small thread pool."""
+
+    def __init__(self, workers=PREFETCH_WORKERS):
+        # shared by all sessions, the pool bounds the background work
+        self._executor = ThreadPoolExecutor(workers, "prefetch")
+
+    def submit(self, feed, station_ids, excluded, active_days, relevant_hours):
+        job = PrefetchJob(
+            (tuple(station_ids), tuple(excluded), tuple(active_days), relevant_hours)
+        )
+        for station_id in station_ids:
+            job.futures.append(
+                self._executor.submit(
+                    self._prefetch,
+                    job,
+                    feed,
+                    station_id,
+                    excluded,
+                    active_days,
+                    relevant_hours,
+                )
+            )
+        return job
+
+    def _prefetch(self, job, feed, station_id, excluded, active_days, relevant_hours):
+        if job.cancelled:
+            return
+        routes = core.get_routes(feed, station_id)
+        if job.cancelled:
+            return
+        route_ids = routes.loc[~routes["route_id"].isin(excluded)]["route_id"]
+        if not core.get_stops.is_cached(feed, route_ids, active_days, relevant_hours):
+            core.get_stops(feed, route_ids, active_days, relevant_hours)
+            logger.debug("prefetched %s", station_id)
@@ -1,155 +1,163 @@
-import gtfs_kit
-import pandas as pd
-import streamlit as st
+from functools import wraps
+from pathlib import Path
 
+import streamlit as st
 
-@st.cache_data(show_spinner="Loading initial data...")
-def load_feed():
-    feed = gtfs_kit.read_feed("gtfs.zip", dist_units="km")
-    # TODO maybe clean some stations
-    return feed
-
-
-@st.cache_data(show_spinner="Loading initial data...")
-def parse_stations(_feed):
-    return _feed.stops.loc[_feed.stops.stop_id.str.contains("Parent")].sort_values(
-        "stop_name"
-    )
-
-
-@st.cache_data(show_spinner="Finding routes...")
-def get_routes(_feed, station_id):
-    platforms = _feed.stops.loc[_feed.stops["parent_station"] == station_id]
-    all_stop_times = _feed.stop_times.loc[
-        _feed.stop_times["stop_id"].isin(platforms["stop_id"].values)
-    ]
-    route_ids = _feed.trips.loc[
-        _feed.trips["trip_id"].isin(all_stop_times["trip_id"].unique())
-    ]["route_id"].unique()
-    all_routes = _feed.routes.loc[_feed.routes["route_id"].isin(route_ids)]
-    # EXT are special trains, not usually accessible
-    routes = all_routes.loc[all_routes["route_short_name"] != "EXT"]
-    return routes
-
-
-@st.cache_data(show_spinner="Finding stops...")
-def get_stops(_feed, route_ids, active_days, relevant_hours):
-    # filter by weekdays
-    query_string = ""
-    for i, weekday in enumerate(active_days):
-        query_string += f"{weekday.lower()} == 1"
-        if i < len(active_days) - 1:
-            query_string += " and "
-    active_services = _feed.calendar.query(query_string)["service_id"]
-
-    route_trips = _feed.trips.loc[
-        _feed.trips["route_id"].isin(route_ids)
-        & _feed.trips["service_id"].isin(active_services)
-    ]
-
-    relevant_stops = _feed.stop_times.loc[
-        _feed.stop_times["trip_id"].isin(route_trips["trip_id"])
-    ]
-
-    # parse arrival and departure to timedeltas
-    relevant_stops = relevant_stops.assign(
-        arrival_time_parsed=pd.to_timedelta(relevant_stops["arrival_time"]),
-        departure_time_parsed=pd.to_timedelta(relevant_stops["departure_time"]),
-    )
-
-    # pickup, dropoff type not 0 means no normal passenger transfer
-    # filter by arrival and departure time
-    lower_bound, upper_bound = [pd.Timedelta(x, unit="h") for x in relevant_hours]
-    filtered_stops = relevant_stops.loc[
-        ((relevant_stops["pickup_type"] == 0) & (relevant_stops["drop_off_type"] == 0))
-        & (
-            (
-                (relevant_stops["arrival_time_parsed"] > lower_bound)
-                & (relevant_stops["arrival_time_parsed"] < upper_bound)
-            )
-            | (
-                (relevant_stops["departure_time_parsed"] > lower_bound)
-                & (relevant_stops["departure_time_parsed"] < upper_bound)
-            )
-        )
-    ]
-
-    stops_trips = pd.merge(
-        filtered_stops, _feed.trips[["trip_id", "route_id"]], on="trip_id", how="left"
-    )
-    # map the stops to the route
-    stops_route = pd.merge(
-        stops_trips,
-        _feed.routes[["route_id", "route_short_name"]],
-        on="route_id",
-        how="left",
-    )
-
-    # only use longest trips
-    longest_trips = stops_route.loc[
-        stops_route.groupby(["route_id"])["stop_sequence"].idxmax()
-    ]
-    # stops_to_display = stops_route.loc[stops_route["trip_id"].isin(longest_trips["trip_id"])]
-
-    longest_trips_stop_times = _feed.stop_times.loc[
-        _feed.stop_times["trip_id"].isin(longest_trips["trip_id"])
-    ]
-    # longest_trips_stations = _feed.stops.loc[
-    #    _feed.stops["stop_id"].isin(longest_trips_stop_times["stop_id"])
-    # ]
-
-    # TODO: consider all trip options, as some might have divergent routes
-    # dedupe stops per route
-    # deduped_stops = stops.sort_values(["stop_sequence"]).groupby("route_id").apply(lambda x: x.loc[x["stop_sequence"].idxmax()])
-    # print(deduped_stops)
-
-    # add all additional data which is needed
-    stop_data = pd.merge(longest_trips_stop_times, _feed.trips, on="trip_id")
-    stop_data = pd.merge(stop_data, _feed.routes, on="route_id")
-    stop_data = pd.merge(stop_data, _feed.stops, on="stop_id")
-    return stop_data
-
-
-def find_shared(_stops_a, _stops_b):
-    return (
-        pd.merge(_stops_a, _stops_b, how="inner", on=["parent_station"])
-        .drop_duplicates("parent_station")
-        .rename(
-            columns={
-                "stop_id_x": "stop_id",
-                "stop_name_x": "stop_name",
-                "stop_lat_x": "stop_lat",
-                "stop_lon_x": "stop_lon",
-                "parent_station_x": "parent_station",
-            }
+import core
+import metrics
+import tiles
+from cache import LRUCache
+from prefetch import Prefetcher, likely_destinations
+from rendering import LAYER_CACHE_MAX_BYTES
+from updates import FeedUpdate, LiveFeed
+from warmup import CacheWarmer, UsageCounter, warmup_stations
+from core import (  # noqa: F401
+    FEED_PATH,
+    WEEKDAYS,
+    feed_version,
+    find_shared,
+    rank_candidates,
+    route_details,
+)
+
+# Streamlit adapter over core, the caching itself is done by core
+#####
+
+
+def _with_spinner(text, function):
+    # like st.cache_data, only show the spinner when the result is computed
+    @wraps(function)
+    def wrapper(*args):
+        if function.is_cached(*args):
+            return function(*args)
+        with st.spinner(text):
+            return function(*args)
+
+    return wrapper
+
+
+@st.cache_resource(show_spinner="Loading initial data...")
+def live_feed(path=FEED_PATH):
+    # a changed feed file is swapped in without a restart, cached results
+    # and map layers of untouched routes and stations stay valid
+    return LiveFeed(path, [(layer_cache(), FeedUpdate.keeps_layer)]).watch()
+
+
+def load_feed(path=FEED_PATH):
+    return live_feed(path).feed
+
+
+parse_stations = _with_spinner("Loading initial data...", core.parse_stations)
+station_index = _with_spinner("Loading initial data...", core.station_index)
+station_grid = _with_spinner("Loading initial data...", core.station_grid)
+get_routes = _with_spinner("Finding routes...", core.get_routes)
+get_stops = _with_spinner("Finding stops...", core.get_stops)
+
+
+def get_routes_concurrently(feed, station_ids):
+    if all(core.get_routes.is_cached(feed, station_id) for station_id in station_ids):
+        return core.get_routes_concurrently(feed, station_ids)
+    with st.spinner("Finding routes..."):
+        return core.get_routes_concurrently(feed, station_ids)
+
+
+def get_stops_concurrently(feed, route_id_sets, active_days, relevant_hours):
+    if all(
+        core.get_stops.is_cached(feed, route_ids, active_days, relevant_hours)
+        for route_ids in route_id_sets
+    ):
+        return core.get_stops_concurrently(
+            feed, route_id_sets, active_days, relevant_hours
         )
-    )
-
-
-def route_details(_selected_route, shared_stops):
-    selected_route = _selected_route.sort_values(["stop_sequence", "route_id"])
-    chart_data = selected_route[["stop_sequence", "route_short_name", "stop_name"]]
-    chart_data = chart_data.assign(
-        shared=selected_route["parent_station"].isin(shared_stops)
-    )
-
-    time_data = selected_route[["stop_sequence", "route_short_name"]]
-    time_data = time_data.assign(
-        stop_sequence=time_data["stop_sequence"] + 0.5,
-        arrival_time_parsed=pd.to_timedelta(selected_route["arrival_time"]),
-        departure_time_parsed=pd.to_timedelta(selected_route["departure_time"]),
-    )
-
-    time_data["next_stop"] = ""
-    for idx in time_data.index:
-        if idx == time_data.idxmax().iloc[0]:
-            break
-        travel_time = (
-            time_data.iloc[idx + 1]["arrival_time_parsed"]
-            - time_data.iloc[idx]["departure_time_parsed"]
+    with st.spinner("Finding stops..."):
+        return core.get_stops_concurrently(
+            feed, route_id_sets, active_days, relevant_hours
         )
-        time_data.loc[idx, "next_stop"] = f"{travel_time.seconds // 60} min"
 
-    time_data = time_data.drop(["arrival_time_parsed", "departure_time_parsed"], axis=1)
 
-    return chart_data, time_data
+@st.cache_resource
+def layer_cache():
+    # shared by all sessions, holds serialized map layers
+    return LRUCache(LAYER_CACHE_MAX_BYTES)
+
+
+@st.cache_resource
+def metrics_exporters():
+    # off unless COMMUTE_METRICS_PORT or COMMUTE_METRICS_FILE is set, installed
+    # before the feed loads so the load is measured
+    if not (metrics.METRICS_PORT or metrics.METRICS_FILE):
+        return []
+    metrics.install(core.get_cache(), layer_cache())
+    metrics.track_feed(load_feed())
+    return metrics.start_exporters()
+
+
+@st.cache_resource
+def _tile_server(version):
+    # one per build of the tiles, a rebuild is served without a restart
+    return tiles.TileServer().start()
+
+
+def serve_network_tiles(feed):
+    # built with `python tiles.py build`, the maps work without it
+    metadata = tiles.read_metadata()
+    if metadata is None or not (Path(tiles.TILES_DIR) / tiles.VECTORGRID_FILE).exists():
+        return None
+    # tiles of another feed would show routes which changed or are gone, they
+    # are left out until they are rebuilt from the current feed
+    if metadata["version"] != core.feed_version(feed):
+        return None
+    return _tile_server(metadata["version"])
+
+
+@st.cache_resource
+def usage_counter():
+    return UsageCounter()
+
+
+def record_selection(slot, station_id):
+    # count a station when it gets picked, not on every rerun
+    state_key = f"recorded_selection_{slot}"
+    if station_id is not None and st.session_state.get(state_key) != station_id:
+        usage_counter().record(station_id)
+    st.session_state[state_key] = station_id
+
+
+@st.cache_resource
+def cache_warmer():
+    # runs once per process in a background thread, the first render does not wait
+    live = live_feed()
+    station_ids = warmup_stations(core.station_index(live.feed), usage_counter())
+    warmer = CacheWarmer(live.feed, station_ids, layer_cache())
+    # an updated feed is warmed again, without it the warmer keeps the old one
+    live.listeners.append(lambda feed, update: warmer.set_feed(feed))
+    return warmer.start()
+
+
+@st.cache_resource
+def prefetcher():
+    return Prefetcher()
+
+
+def prefetch_destinations(
+    feed, station_a, stops_a, station_b, excluded, active_days, relevant_hours
+):
+    # while B is not picked yet, compute the stops of the likely picks in the
+    # background, a changed selection or filter cancels the previous prefetch
+    job = st.session_state.get("prefetch_job")
+    if station_a is None or station_b is not None:
+        key = None
+    else:
+        station_ids = likely_destinations(
+            core.station_index(feed), station_a, stops_a, usage_counter()
+        )
+        key = (tuple(station_ids), tuple(excluded), tuple(active_days), relevant_hours)
+    if job is not None and job.key != key:
+        job.cancel()
+        job = None
+    if job is None and key is not None:
+        job = prefetcher().submit(
+            feed, station_ids, excluded, active_days, relevant_hours
+        )
+    st.session_state["prefetch_job"] = job
+    return job
@@ -1,28 +1,209 @@
-import altair
-import folium
-import seaborn
-from branca.element import MacroElement, Template
+import json
+from functools import cache
 from uuid import uuid4
 
+import numpy as np
 
+from core import WEEKDAYS
+from palette import color_palette
+from spans import span, traced
+
+# folium, branca, altair and streamlit_folium are imported where they are
+# used, they take longer to import than the first render of the app
+
+
+# station color and route palette of destination A and B
+DESTINATION_STYLES = [("#ffffbf", "plasma"), ("#91bfdb", "viridis")]
+ROUTE_COLOR = "#808080"
+# 1e-5 degrees are about a meter, enough for station positions
+COORDINATE_PRECISION = 5
+# the cache of serialized map layers shared by the sessions of a worker
+LAYER_CACHE_MAX_BYTES = 256 * 1024 * 1024
+COMPACT_LAYER_TEMPLATE = """
+        {% macro script(this, kwargs) %}
+        var {{ this.get_name() }}_names = {{ this.names }};
+        var {{ this.get_name() }} = L.geoJson({{ this.data }}, {
+            style: function(feature) {
+                return Object.assign({}, {{ this.style }}, feature.properties.style);
+            },
+            pointToLayer: function(feature, latlng) {
+                return L.circleMarker(latlng, {{ this.style }});
+            }
+        });
+        {{ this.get_name() }}.bindTooltip(function(layer) {
+            let div = L.DomUtil.create("div");
+            let properties = layer.feature.properties;
+            let names = properties.names.map(i => {{ this.get_name() }}_names[i]);
+            div.innerHTML = (properties.label ? [properties.label] : []).concat(names).join("<br/>");
+            return div;
+        }, {"sticky": true});
+        {% endmacro %}
+        """
+
+
+@cache
+def _compact_layer_class():
+    from branca.element import Template
+    from folium.map import Layer
+
+    class CompactLayer(Layer):
+        """GeoJSON layer which sends every stop name only once.
+
+        Features reference the names by their index in a lookup table,
+        the tooltips are assembled on the client.
+        """
+
+        _template = Template(COMPACT_LAYER_TEMPLATE)
+
+        def __init__(self, data, names, style, name=None):
+            super().__init__(name=name)
+            self._name = "CompactLayer"
+            # kept serialized, so the layer can be cached as a plain string fragment
+            self.data = data if isinstance(data, str) else _to_json(data)
+            self.names = names if isinstance(names, str) else _to_json(names)
+            self.style = style if isinstance(style, str) else _to_json(style)
+
+        def to_fragment(self):
+            return (self.layer_name, self.data, self.names, self.style)
+
+        @classmethod
+        def from_fragment(cls, fragment):
+            name, data, names, style = fragment
+            return cls(data, names, style, name=name)
+
+    return CompactLayer
+
+
+def __getattr__(name):
+    # the layer class is only defined once folium is imported
+    if name == "CompactLayer":
+        return _compact_layer_class()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def _to_json(value):
+    return json.dumps(value, separators=(",", ":"))
+
+
+def _name_lookup(stop_data):
+    names, indices = np.unique(stop_data["stop_name"].astype(str), return_inverse=True)
+    return names.tolist(), indices
+
+
+def _coordinates(rows):
+    return rows[["stop_lon", "stop_lat"]].round(COORDINATE_PRECISION).values.tolist()
+
+
+def layer_key(
+    feed_version, station_id, active_days, relevant_hours, excluded_route_ids, style
+):
+    weekday_mask = sum(
+        1 << i for i, weekday in enumerate(WEEKDAYS) if weekday in active_days
+    )
+    return (
+        feed_version,
+        station_id,
+        weekday_mask,
+        tuple(relevant_hours),
+        tuple(sorted(excluded_route_ids)),
+        style,
+    )
+
+
+def cached_layer(layer_cache, key, draw, *args):
+    # only compact layers are cached, the fragment is a handful of strings
+    with span("layer") as current:
+        fragment = layer_cache.get(key)
+        current.cached = fragment is not None
+        if fragment is None:
+            layer = draw(*args)
+            if not isinstance(layer, _compact_layer_class()):
+                return layer
+            fragment = layer.to_fragment()
+            layer_cache.set(key, fragment)
+        return _compact_layer_class().from_fragment(fragment)
+
+
+def draw_destination_layers(layer_cache, key, stops, color, palette):
+    # the main map draws all routes in one color, the mini map with a palette
+    return {
+        "routes": cached_layer(
+            layer_cache,
+            key(("routes", ROUTE_COLOR, "single")),
+            draw_routes,
+            stops,
+            ROUTE_COLOR,
+            "single",
+        ),
+        "stations": cached_layer(
+            layer_cache, key(("stations", color)), draw_stations, stops, color
+        ),
+        "mini_routes": cached_layer(
+            layer_cache, key(("routes", palette)), draw_routes, stops, palette
+        ),
+        "mini_stations": cached_layer(
+            layer_cache, key(("stations", color)), draw_stations, stops, color
+        ),
+    }
+
+
+def new_map():
+    import folium
+
+    return folium.Map(tiles="cartodbpositron")
+
+
+@traced
+def show_map(folium_map, **kwargs):
+    from streamlit_folium import st_folium
+
+    return st_folium(folium_map, **kwargs)
+
+
+@traced
+def payload_size(folium_map):
+    return len(folium_map.get_root().render().encode())
+
+
+@traced
 def draw_stations(stations, color, shape="circle"):
+    import folium
+    import folium.plugins
+
+    # stations are repeated for every route which serves them
+    stations = stations.drop_duplicates("stop_id")
+
+    if shape == "circle":
+        names, indices = _name_lookup(stations)
+        features = [
+            {
+                "type": "Feature",
+                "geometry": {"type": "Point", "coordinates": coordinates},
+                "properties": {"names": [int(index)]},
+            }
+            for coordinates, index in zip(_coordinates(stations), indices)
+        ]
+        style = {
+            "radius": 3,
+            "fill": True,
+            "fillColor": color,
+            "color": "#000000",
+            "weight": 1,
+            "fillOpacity": 1,
+        }
+        return _compact_layer_class()(
+            {"type": "FeatureCollection", "features": features},
+            names,
+            style,
+            name=f"Stops {uuid4()}",
+        )
+
     marker_layer = folium.FeatureGroup(name=f"Stops {uuid4()}")
 
     for row in stations.to_dict(orient="records"):
         location = [row["stop_lat"], row["stop_lon"]]
         tooltip = row["stop_name"]
-        if shape == "circle":
-            folium.CircleMarker(
-                location=location,
-                tooltip=tooltip,
-                radius=3,
-                fill=True,
-                fillColor=color,
-                color="#000000",
-                weight=1,
-                fillOpacity=1,
-            ).add_to(marker_layer)
-        elif shape == "square":
+        if shape == "square":
             icon = folium.plugins.BeautifyIcon(
                 icon_shape="rectangle-dot",
                 icon_size=[10, 10],
@@ -53,30 +234,83 @@ def draw_stations(stations, color, shape="circle"):
     return marker_layer
 
 
+@traced
 def draw_routes(stop_data, color_name, COLOR_TYPE="colormap"):
-    path_layer = folium.FeatureGroup(name="Paths")
-    grouped = stop_data.sort_values(["trip_id", "stop_sequence"]).groupby("trip_id")
+    stop_data = stop_data.sort_values(["trip_id", "stop_sequence"])
+    names, indices = _name_lookup(stop_data)
+    grouped = stop_data.assign(name_index=indices).groupby("trip_id")
     if COLOR_TYPE == "colormap":
-        colors = seaborn.color_palette(color_name, n_colors=grouped.ngroups).as_hex()
-    idx = 0
-    for name, group in grouped:
-        stop_coords = []
-        tooltip_content = f"<span style='display: none'>[{group.iloc[0]['route_id']}]</span>{group.iloc[0]['route_short_name']}"
-
-        for row_index, row in group.iterrows():
-            stop_coords.append(row[["stop_lat", "stop_lon"]].values)
-            tooltip_content += f"<br/>{row['stop_name']}"
-
-            color = colors[idx] if COLOR_TYPE == "colormap" else color_name
-            folium.PolyLine(stop_coords, tooltip=tooltip_content, color=color).add_to(
-                path_layer
-            )
-        idx += 1
+        colors = color_palette(color_name, grouped.ngroups)
+    else:
+        colors = [color_name] * grouped.ngroups
 
-    return path_layer
+    features = []
+    for color, (name, group) in zip(colors, grouped):
+        if len(group) < 2:
+            continue
+        features.append(
+            {
+                "type": "Feature",
+                "geometry": {"type": "LineString", "coordinates": _coordinates(group)},
+                "properties": {
+                    "route_id": group.iloc[0]["route_id"],
+                    "label": group.iloc[0]["route_short_name"],
+                    "names": group["name_index"].tolist(),
+                    "style": {"color": color},
+                },
+            }
+        )
+
+    return _compact_layer_class()(
+        {"type": "FeatureCollection", "features": features},
+        names,
+        {"weight": 3, "opacity": 1},
+        name="Paths",
+    )
 
 
+def draw_network(tile_server, highlighted_route_ids, color="#808080"):
+    from folium.plugins import VectorGridProtobuf
+
+    # the whole network comes from the local tile server, only the highlighted
+    # route ids are shipped to the client and styled there, the style function
+    # runs for every feature of every tile and looks them up in a set
+    options = f"""{{
+        "maxNativeZoom": {tile_server.metadata["maxzoom"]},
+        "interactive": false,
+        "rendererFactory": L.canvas.tile,
+        "vectorTileLayerStyles": {{
+            "routes": (function() {{
+                var highlighted = new Set({json.dumps(sorted(highlighted_route_ids))});
+                return function(properties, zoom) {{
+                    if (highlighted.has(properties.route_id)) {{
+                        return {{"weight": 3, "color": "{color}", "opacity": 1}};
+                    }}
+                    return {{"weight": 1, "color": "#c8c8c8", "opacity": 0.8}};
+                }};
+            }})(),
+            "stations": function(properties, zoom) {{
+                return {{
+                    "radius": zoom < 9 ? 1 : 2,
+                    "fill": true,
+                    "fillColor": "#ffffff",
+                    "fillOpacity": 1,
+                    "color": "#a0a0a0",
+                    "weight": 1
+                }};
+            }}
+        }}
+    }}"""
+    layer = VectorGridProtobuf(tile_server.url, "Network", options)
+    # the script comes from the tile server as well, the maps work offline
+    layer.default_js = [("vectorGrid", tile_server.script_url)]
+    return layer
+
+
+@traced
 def draw_route_detail(chart_data, time_data):
+    import altair
+
     scale = altair.Scale(domain=[0.8, chart_data["stop_sequence"].max() + 0.2])
     time_annotations = (
         altair.Chart(time_data)
@@ -214,6 +448,14 @@ LEGEND_BOTTOM = f"""
 """
 
 
+def _legend(template):
+    from branca.element import MacroElement, Template
+
+    macro = MacroElement()
+    macro._template = Template(template)
+    return macro
+
+
 def generate_main_legend():
     # referenced from https://nbviewer.org/gist/talbertc-usgs/18f8901fc98f109f2b71156cf3ac81cd
     template = f"""
@@ -237,10 +479,7 @@ def generate_main_legend():
     {LEGEND_BOTTOM}
     """
 
-    macro = MacroElement()
-    macro._template = Template(template)
-
-    return macro
+    return _legend(template)
 
 
 def generate_sub_a_legend():
@@ -259,10 +498,7 @@ def generate_sub_a_legend():
     {LEGEND_BOTTOM}
     """
 
-    macro = MacroElement()
-    macro._template = Template(template)
-
-    return macro
+    return _legend(template)
 
 
 def generate_sub_b_legend():
@@ -281,7 +517,4 @@ def generate_sub_b_legend():
     {LEGEND_BOTTOM}
     """
 
-    macro = MacroElement()
-    macro._template = Template(template)
-
-    return macro
+    return _legend(template)
@@ -0,0 +1,177 @@
+import heapq
+import re
+import sys
+import unicodedata
+from bisect import bisect_left
+from collections import defaultdict
+
+import numpy as np
+
+GERMAN_UMLAUTS = str.maketrans({"ä": "ae", "ö": "oe", "ü": "ue"})
+SEPARATORS = re.compile(r"[^\w]+")
+
+
+def _strip_accents(text):
+    return "".join(
+        char
+        for char in unicodedata.normalize("NFKD", text)
+        if not unicodedata.combining(char)
+    )
+
+
+def fold(text):
+    """Spellings of a text used for matching, `Zürich` as `zuerich` and `zurich`."""
+    text = text.casefold()
+    spellings = {
+        SEPARATORS.sub(" ", _strip_accents(spelling)).strip()
+        for spelling in (text.translate(GERMAN_UMLAUTS), text)
+    }
+    return sorted(spellings)
+
+
+def _trigrams(word):
+    padded = f" {word} "
+    return {padded[i : i + 3] for i in range(len(padded) - 2)}
+
+
+class NameIndex:
+    """Id to name lookup and typeahead search over names.
+
+    Searching matches every word of the query as a prefix of a word of the
+    name (`zue hb` finds `Zürich HB`), if that finds too little names with
+    the most shared trigrams are added, which tolerates typos.
+    """
+
+    def __init__(self, ids, names):
+        self.ids = np.asarray(ids)
+        self.names = np.asarray(names)
+        self._positions = {id: position for position, id in enumerate(self.ids)}
+        self._exact = {}
+        self._name_words = []
+        self._short_queries = {}
+        words = set()
+        trigrams = defaultdict(set)
+        for position, name in enumerate(self.names):
+            self._name_words.append(
+                {word for spelling in fold(name) for word in spelling.split()}
+            )
+            for spelling in fold(name):
+                self._exact.setdefault(spelling, position)
+                for word in spelling.split():
+                    words.add((word, position))
+                    for trigram in _trigrams(word):
+                        trigrams[trigram].add(position)
+        self._words = sorted(words)
+        self._trigrams = {
+            trigram: np.fromiter(positions, np.int32, len(positions))
+            for trigram, positions in trigrams.items()
+        }
+        self._lengths = np.char.str_len(self.names.astype(str))
+
+    @classmethod
+    def from_frame(cls, frame, id_column, name_column):
+        return cls(frame[id_column].to_numpy(), frame[name_column].to_numpy())
+
+    def __len__(self):
+        return len(self.ids)
+
+    def memory_usage(self, deep=True):
+        # like pandas, `deep` adds the strings, of the arrays and the lookups
+        lookups = (
+            self._positions,
+            self._exact,
+            self._name_words,
+            self._words,
+            self._trigrams,
+        )
+        size = self.ids.nbytes + self.names.nbytes + self._lengths.nbytes
+        size += sum(map(sys.getsizeof, lookups))
+        size += sum(map(sys.getsizeof, self._name_words))
+        size += sum(map(sys.getsizeof, self._words))
+        size += sum(positions.nbytes for positions in self._trigrams.values())
+        if deep:
+            for array in (self.ids, self.names):
+                if array.dtype == object:
+                    size += sum(map(sys.getsizeof, array))
+            size += sum(map(sys.getsizeof, self._exact))
+            size += sum(sys.getsizeof(word) for word, _ in self._words)
+            size += sum(
+                sys.getsizeof(word) for words in self._name_words for word in words
+            )
+            size += sum(map(sys.getsizeof, self._trigrams))
+        return int(size)
+
+    def __contains__(self, id):
+        return id in self._positions
+
+    def name(self, id):
+        return self.names[self._positions[id]]
+
+    def resolve(self, text):
+        """Id for an id or an exactly matching name, `None` if unknown."""
+        if text in self._positions:
+            return text
+        for spelling in fold(text):
+            if spelling in self._exact:
+                return self.ids[self._exact[spelling]]
+        return None
+
+    def _word_prefix(self, word):
+        positions = set()
+        for index in range(bisect_left(self._words, (word,)), len(self._words)):
+            indexed, position = self._words[index]
+            if not indexed.startswith(word):
+                break
+            positions.add(position)
+        return positions
+
+    def search(self, query, limit=10):
+        # short queries match a large part of the names, their results are kept
+        if len(query) <= 2:
+            if (query, limit) not in self._short_queries:
+                self._short_queries[query, limit] = self._search(query, limit)
+            return self._short_queries[query, limit]
+        return self._search(query, limit)
+
+    def _search(self, query, limit):
+        matches = set()
+        spellings = fold(query)
+        for spelling in spellings:
+            words = spelling.split()
+            if not words:
+                continue
+            # the longest word has the fewest matches, the rest only filter them
+            words.sort(key=len, reverse=True)
+            matches |= {
+                position
+                for position in self._word_prefix(words[0])
+                if all(
+                    any(
+                        name_word.startswith(word)
+                        for name_word in self._name_words[position]
+                    )
+                    for word in words[1:]
+                )
+            }
+        ranked = heapq.nsmallest(
+            limit, matches, key=lambda position: (len(self.names[position]), position)
+        )
+
+        if not ranked:
+            query_trigrams = [
+                set().union(*map(_trigrams, spelling.split())) for spelling in spellings
+            ]
+            postings = [
+                self._trigrams[trigram]
+                for trigram in set().union(*query_trigrams)
+                if trigram in self._trigrams
+            ]
+            if postings:
+                overlap = np.bincount(np.concatenate(postings), minlength=len(self))
+                # at least half of the trigrams of the query have to match
+                minimum = max(min(map(len, query_trigrams)) // 2, 1)
+                candidates = np.flatnonzero(overlap >= minimum)
+                order = np.lexsort((self._lengths[candidates], -overlap[candidates]))
+                ranked = candidates[order[:limit]].tolist()
+
+        return [self.ids[position] for position in ranked[:limit]]
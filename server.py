@@ -0,0 +1,295 @@
+import argparse
+import json
+import logging
+from functools import reduce
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pandas as pd
+
+import core
+import metrics
+from updates import LiveFeed
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_DAYS = core.WEEKDAYS[:5]
+DEFAULT_HOURS = (6, 22)
+STATION_COLUMNS = ["stop_id", "stop_name", "stop_lat", "stop_lon", "parent_station"]
+ARROW_STREAM = "application/vnd.apache.arrow.stream"
+
+
+class BadRequest(ValueError):
+    pass
+
+
+class QueryService:
+    """Keeps the feed resident and answers the triangulation queries."""
+
+    def __init__(self, feed_path=core.FEED_PATH):
+        # a new feed file is swapped in by `reload` or the watcher
+        self.live = LiveFeed(feed_path)
+
+    @property
+    def feed(self):
+        return self.live.feed
+
+    def reload(self):
+        # None if the feed file did not change
+        if self.live.update() is None:
+            return None
+        return self.live.last_update
+
+    def _stations(self, feed, station_ids=None):
+        stations = core.parse_stations(feed)[
+            ["stop_id", "stop_name", "stop_lat", "stop_lon"]
+        ]
+        if station_ids is None:
+            return stations.reset_index(drop=True)
+        return stations.set_index("stop_id", drop=False).loc[station_ids]
+
+    def get_stations(self, query=None, limit=10):
+        feed = self.feed
+        if query is None:
+            return self._stations(feed)
+        station_ids = core.station_index(feed).search(query, limit)
+        return self._stations(feed, station_ids).reset_index(drop=True)
+
+    def get_nearby(self, lat, lon, count=5, radius_km=None):
+        feed = self.feed
+        grid = core.station_grid(feed)
+        if radius_km is None:
+            station_ids, distances = grid.nearest(lat, lon, count)
+        else:
+            station_ids, distances = grid.within(lat, lon, radius_km)
+        stations = self._stations(feed, station_ids)
+        return stations.assign(distance_km=distances).reset_index(drop=True)
+
+    def get_routes(self, station_id):
+        return core.get_routes(self.feed, station_id)
+
+    def get_stops(self, route_ids, active_days, relevant_hours):
+        return core.get_stops(self.feed, route_ids, active_days, relevant_hours)
+
+    def destination_stops(self, station_ids, excluded, active_days, relevant_hours):
+        stops, _ = core.destination_stops(
+            self.feed, station_ids, excluded, active_days, relevant_hours
+        )
+        return stops
+
+    def get_shared(self, station_ids, excluded, active_days, relevant_hours):
+        stops = self.destination_stops(
+            station_ids, excluded, active_days, relevant_hours
+        )
+        shared = reduce(
+            lambda left, right: left & right,
+            [set(destination["parent_station"]) for destination in stops],
+        )
+        return (
+            stops[0]
+            .loc[stops[0]["parent_station"].isin(shared)]
+            .drop_duplicates("parent_station")[STATION_COLUMNS]
+        )
+
+    def get_candidates(
+        self, station_ids, excluded, active_days, relevant_hours, region=None
+    ):
+        candidates = core.rank_candidates(
+            self.destination_stops(station_ids, excluded, active_days, relevant_hours)
+        )
+        if region is None:
+            return candidates
+        # only stations within radius_km of (lat, lon)
+        inside, _ = core.station_grid(self.feed).within(*region)
+        return candidates.loc[candidates["parent_station"].isin(inside)].reset_index(
+            drop=True
+        )
+
+
+def _days(params):
+    if "days" not in params:
+        return DEFAULT_DAYS
+    days = [day.strip().capitalize() for day in params["days"][0].split(",")]
+    unknown = [day for day in days if day not in core.WEEKDAYS]
+    if unknown:
+        raise BadRequest(f"days must be weekday names, not {', '.join(unknown)}")
+    return days
+
+
+def _hours(params):
+    if "hours" not in params:
+        return DEFAULT_HOURS
+    try:
+        lower, upper = (int(hour) for hour in params["hours"][0].split(","))
+    except ValueError:
+        raise BadRequest("hours must be two comma separated integers")
+    return (lower, upper)
+
+
+def _number(params, name, default=None):
+    if name not in params:
+        if default is None:
+            raise BadRequest(f"'{name}' parameter required")
+        return default
+    try:
+        return float(params[name][0])
+    except ValueError:
+        raise BadRequest(f"{name} must be a number")
+
+
+def _integer(params, name, default):
+    if name not in params:
+        return default
+    try:
+        value = int(params[name][0])
+    except ValueError:
+        raise BadRequest(f"{name} must be an integer")
+    if value < 1:
+        raise BadRequest(f"{name} must be positive")
+    return value
+
+
+def _region(params):
+    if "near" not in params:
+        return None
+    try:
+        lat, lon = (float(value) for value in params["near"][0].split(","))
+    except ValueError:
+        raise BadRequest("near must be a comma separated latitude and longitude")
+    return (lat, lon, _number(params, "radius"))
+
+
+def _required(params, name, minimum=1):
+    values = params.get(name, [])
+    if len(values) < minimum:
+        raise BadRequest(f"at least {minimum} '{name}' parameter(s) required")
+    return values
+
+
+def handle_query(service, path, params):
+    if path == "/health":
+        return {"status": "ok"}
+    if path == "/stations":
+        if "q" not in params:
+            return service.get_stations()
+        return service.get_stations(params["q"][0], _integer(params, "limit", 10))
+    if path == "/nearby":
+        return service.get_nearby(
+            _number(params, "lat"),
+            _number(params, "lon"),
+            _integer(params, "k", 5),
+            _number(params, "radius") if "radius" in params else None,
+        )
+    if path == "/routes":
+        return service.get_routes(_required(params, "station")[0])
+    if path == "/stops":
+        return service.get_stops(
+            _required(params, "route"), _days(params), _hours(params)
+        )
+
+    if path in ("/shared", "/candidates"):
+        limit = _integer(params, "limit", 20)
+        args = (
+            _required(params, "station", minimum=2),
+            params.get("exclude", []),
+            _days(params),
+            _hours(params),
+        )
+        if path == "/shared":
+            return service.get_shared(*args)
+        candidates = service.get_candidates(*args, _region(params))
+        return candidates.head(limit)
+
+    return None
+
+
+class QueryRequestHandler(BaseHTTPRequestHandler):
+    service = None
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == "/metrics":
+            return self._send(metrics.REGISTRY.render().encode(), metrics.CONTENT_TYPE)
+        try:
+            result = handle_query(self.service, url.path, parse_qs(url.query))
+        except BadRequest as error:
+            return self._send_json({"error": str(error)}, 400)
+        except Exception:
+            logger.exception("query %s failed", self.path)
+            return self._send_json({"error": "internal error"}, 500)
+
+        if result is None:
+            return self._send_json({"error": "not found"}, 404)
+        if not isinstance(result, pd.DataFrame):
+            return self._send_json(result)
+        if ARROW_STREAM in self.headers.get("Accept", ""):
+            return self._send(_to_arrow(result), ARROW_STREAM)
+        self._send(result.to_json(orient="records").encode(), "application/json")
+
+    def do_POST(self):
+        if urlparse(self.path).path != "/reload":
+            return self._send_json({"error": "not found"}, 404)
+        try:
+            self._send_json({"update": self.service.reload()})
+        except Exception:
+            logger.exception("reloading the feed failed")
+            self._send_json({"error": "internal error"}, 500)
+
+    def _send_json(self, content, status=200):
+        self._send(json.dumps(content).encode(), "application/json", status)
+
+    def _send(self, content, content_type, status=200):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+
+def _to_arrow(frame):
+    import pyarrow
+
+    table = pyarrow.Table.from_pandas(frame, preserve_index=False)
+    sink = pyarrow.BufferOutputStream()
+    with pyarrow.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+def create_server(service, host="127.0.0.1", port=8000):
+    handler = type("Handler", (QueryRequestHandler,), {"service": service})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Headless triangulation query API.")
+    parser.add_argument("--feed", default=core.FEED_PATH)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument(
+        "--watch",
+        type=float,
+        default=0,
+        help="check the feed file for changes every this many seconds",
+    )
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    # served on /metrics next to the queries
+    metrics.install(core.get_cache())
+    service = QueryService(args.feed)
+    metrics.track_feed(service.feed)
+    if args.watch:
+        service.live.watch(args.watch)
+    server = create_server(service, args.host, args.port)
+    logger.info("Serving on http://%s:%d", *server.server_address[:2])
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+import logging
+import os
+import threading
+import tracemalloc
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from time import perf_counter
+
+import pandas as pd
+
+# recording a span is two clock reads and an append, it can stay on
+SPANS = os.environ.get("COMMUTE_SPANS", "1") != "0"
+
+logger = logging.getLogger(__name__)
+
+# the spans of the current rerun or request and the name of the enclosing span
+_trace = ContextVar("trace", default=None)
+_parent = ContextVar("parent", default=None)
+# called with every finished span, from any thread
+_listeners = []
+
+
+def rows(value):
+    # rows of a dataframe, the length of other sized values but text and mappings
+    if isinstance(value, (str, bytes, dict)):
+        return None
+    try:
+        return len(value)
+    except TypeError:
+        return None
+
+
+def _bytes(value):
+    # without deep, only the arrays are counted, not the strings they point to
+    if isinstance(value, (pd.DataFrame, pd.Series)):
+        return int(value.memory_usage(index=False).sum())
+    if isinstance(value, (str, bytes)):
+        return len(value)
+    return None
+
+
+class Span:
+    """Duration, rows and memory of one processing or rendering stage.
+
+    `rows_in` is set when the span starts, `output` before it ends. Allocated
+    memory is only measured while tracemalloc is tracing, it is too slow to
+    leave on.
+    """
+
+    __slots__ = ("name", "rows_in", "output", "cached", "_start", "_allocated")
+
+    def __init__(self, name, rows_in=None):
+        self.name = name
+        self.rows_in = rows_in
+        self.output = None
+        self.cached = None
+        self._allocated = (
+            tracemalloc.get_traced_memory()[0] if tracemalloc.is_tracing() else None
+        )
+        self._start = perf_counter()
+
+    def record(self):
+        duration = perf_counter() - self._start
+        allocated = (
+            tracemalloc.get_traced_memory()[0] - self._allocated
+            if self._allocated is not None
+            else None
+        )
+        return {
+            "name": self.name,
+            "ms": duration * 1000,
+            "rows_in": self.rows_in,
+            "rows_out": rows(self.output),
+            "bytes_out": _bytes(self.output),
+            "allocated_kb": allocated / 1024 if allocated is not None else None,
+            "cached": self.cached,
+            "thread": threading.current_thread().name,
+        }
+
+
+class _NullSpan:
+    # what `span` yields when the spans are off, setting attributes does nothing
+    __slots__ = ()
+
+    def __setattr__(self, name, value):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+
+
+def start_trace():
+    """Collect the spans of the current thread and the pipelines it starts.
+
+    Returns the list the spans are appended to, a new call replaces it.
+    """
+    trace = []
+    _trace.set(trace)
+    return trace
+
+
+def add_listener(listener):
+    _listeners.append(listener)
+
+
+def _log_line(record):
+    # logfmt, one line per span
+    return " ".join(
+        f"{key}={value:.3f}" if isinstance(value, float) else f"{key}={value}"
+        for key, value in record.items()
+        if value is not None
+    )
+
+
+@contextmanager
+def span(name, rows_in=None):
+    """Time a stage, nested spans are named `parent.child`.
+
+    The yielded span takes the result as `output`, its rows and size are
+    recorded.
+    """
+    if not SPANS:
+        yield _NULL_SPAN
+        return
+    parent = _parent.get()
+    name = f"{parent}.{name}" if parent else name
+    token = _parent.set(name)
+    current = Span(name, rows_in)
+    try:
+        yield current
+    finally:
+        _parent.reset(token)
+        record = current.record()
+        trace = _trace.get()
+        if trace is not None:
+            trace.append(record)
+        for listener in _listeners:
+            listener(record)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("span %s", _log_line(record))
+
+
+def traced(function):
+    """Record every call of `function` as a span, the first argument is the input."""
+
+    @wraps(function)
+    def wrapper(*args, **kwargs):
+        with span(function.__name__, rows(args[0]) if args else None) as current:
+            result = function(*args, **kwargs)
+            current.output = result
+        return result
+
+    return wrapper
+
+
+def summarize(trace):
+    """The spans of a trace as a dataframe, in the order they finished."""
+    return pd.DataFrame.from_records(
+        trace,
+        columns=[
+            "name",
+            "ms",
+            "rows_in",
+            "rows_out",
+            "bytes_out",
+            "allocated_kb",
+            "cached",
+            "thread",
+        ],
+    )
@@ -0,0 +1,145 @@
+import sys
+
+import numpy as np
+
+EARTH_RADIUS_KM = 6371.0
+KM_PER_DEGREE = np.pi * EARTH_RADIUS_KM / 180
+CELL_KM = 5.0
+# beyond this many rings of cells a scan over all points is cheaper
+MAX_RINGS = 32
+
+
+def haversine(lat, lon, lats, lons):
+    lat, lon, lats, lons = map(np.radians, (lat, lon, lats, lons))
+    a = (
+        np.sin((lats - lat) / 2) ** 2
+        + np.cos(lat) * np.cos(lats) * np.sin((lons - lon) / 2) ** 2
+    )
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+
+
+class PointGrid:
+    """Uniform grid over points for nearest and radius queries.
+
+    The points are projected to kilometers around their mean latitude, which
+    is accurate enough to pick the grid cells of a country sized area. The
+    returned distances are great circle distances.
+    """
+
+    def __init__(self, ids, lats, lons, cell_km=CELL_KM):
+        self.ids = np.asarray(ids)
+        self.lats = np.asarray(lats, dtype=float)
+        self.lons = np.asarray(lons, dtype=float)
+        self.cell_km = cell_km
+        self._lon_scale = np.cos(np.radians(self.lats.mean() if len(self.lats) else 0))
+        # the projection stretches the longitudes of points away from the mean
+        # latitude, a searched cell covers at least this share of its size
+        self._reach = min(
+            np.cos(np.radians(np.abs(self.lats).max() if len(self.lats) else 0))
+            / self._lon_scale,
+            1.0,
+        )
+
+        cells = self._cells(self.lats, self.lons)
+        order = np.lexsort((cells[:, 1], cells[:, 0]))
+        keys, starts = np.unique(cells[order], axis=0, return_index=True)
+        ends = np.append(starts[1:], len(order))
+        self._cells_of = {
+            (x, y): order[start:end]
+            for (x, y), start, end in zip(keys.tolist(), starts, ends)
+        }
+        self._bounds = (
+            (keys.min(axis=0), keys.max(axis=0)) if len(keys) else ((0, 0), (0, 0))
+        )
+
+    @classmethod
+    def from_frame(cls, frame, id_column, cell_km=CELL_KM):
+        frame = frame.dropna(subset=["stop_lat", "stop_lon"])
+        return cls(frame[id_column], frame["stop_lat"], frame["stop_lon"], cell_km)
+
+    def __len__(self):
+        return len(self.ids)
+
+    def memory_usage(self, deep=True):
+        # like pandas, `deep` adds the python objects of an object id array
+        size = self.ids.nbytes + self.lats.nbytes + self.lons.nbytes
+        size += sys.getsizeof(self._cells_of) + sum(
+            sys.getsizeof(key) + positions.nbytes
+            for key, positions in self._cells_of.items()
+        )
+        if deep and self.ids.dtype == object:
+            size += sum(map(sys.getsizeof, self.ids))
+        return int(size)
+
+    def _cells(self, lats, lons):
+        x = np.asarray(lons) * KM_PER_DEGREE * self._lon_scale
+        y = np.asarray(lats) * KM_PER_DEGREE
+        return np.floor(np.column_stack([x, y]) / self.cell_km).astype(np.int64)
+
+    def _ring(self, center, radius):
+        # positions of the cells `radius` cells away from the center cell
+        cx, cy = center
+        if radius == 0:
+            cells = [(cx, cy)]
+        else:
+            cells = [
+                (x, y)
+                for x in range(cx - radius, cx + radius + 1)
+                for y in (cy - radius, cy + radius)
+            ] + [
+                (x, y)
+                for x in (cx - radius, cx + radius)
+                for y in range(cy - radius + 1, cy + radius)
+            ]
+        found = [self._cells_of[cell] for cell in cells if cell in self._cells_of]
+        return np.concatenate(found) if found else np.empty(0, np.int64)
+
+    def _max_ring(self, center):
+        (min_x, min_y), (max_x, max_y) = self._bounds
+        cx, cy = center
+        return max(cx - min_x, max_x - cx, cy - min_y, max_y - cy, 0)
+
+    def _result(self, positions, lat, lon):
+        distances = haversine(lat, lon, self.lats[positions], self.lons[positions])
+        order = np.argsort(distances, kind="stable")
+        return self.ids[positions[order]], distances[order]
+
+    def nearest(self, lat, lon, k=1):
+        """Ids and distances in km of the `k` closest points."""
+        if not len(self):
+            return self._result(np.empty(0, np.int64), lat, lon)
+        center = tuple(self._cells([lat], [lon])[0].tolist())
+        if self._max_ring(center) > MAX_RINGS:
+            ids, distances = self._result(np.arange(len(self)), lat, lon)
+            return ids[:k], distances[:k]
+        found = []
+        count = 0
+        for radius in range(self._max_ring(center) + 1):
+            ring = self._ring(center, radius)
+            found.append(ring)
+            count += len(ring)
+            # a point further out than the searched rings is at least
+            # `radius` cells away, everything closer is already found
+            if count >= k:
+                positions = np.concatenate(found)
+                distances = haversine(
+                    lat, lon, self.lats[positions], self.lons[positions]
+                )
+                if np.sort(distances)[k - 1] <= radius * self.cell_km * self._reach:
+                    break
+        ids, distances = self._result(np.concatenate(found), lat, lon)
+        return ids[:k], distances[:k]
+
+    def within(self, lat, lon, radius_km):
+        """Ids and distances in km of the points within `radius_km`, closest first."""
+        center = tuple(self._cells([lat], [lon])[0].tolist())
+        rings = int(np.ceil(radius_km / (self.cell_km * self._reach)))
+        if rings > MAX_RINGS:
+            positions = np.arange(len(self))
+        else:
+            positions = np.concatenate(
+                [self._ring(center, radius) for radius in range(rings + 1)]
+            )
+        ids, distances = self._result(positions, lat, lon)
+        inside = distances <= radius_km
+        return ids[inside], distances[inside]
@@ -0,0 +1,316 @@
+import os
+import sqlite3
+import threading
+from functools import cached_property
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+from timetable import time_to_seconds, trip_hashes
+
+# tables which are kept in memory, the large ones are only queried
+MEMORY_TABLES = ["routes", "stops", "calendar", "calendar_dates"]
+INDEXES = {
+    "stop_times_trip": "stop_times(trip_id)",
+    "stop_times_stop": "stop_times(stop_id)",
+    "trips_route": "trips(route_id)",
+    "trips_trip": "trips(trip_id)",
+    "stops_parent": "stops(parent_station)",
+    "stops_stop": "stops(stop_id)",
+    "routes_route": "routes(route_id)",
+}
+WEEKDAY_COLUMNS = [
+    "monday",
+    "tuesday",
+    "wednesday",
+    "thursday",
+    "friday",
+    "saturday",
+    "sunday",
+]
+
+
+def database_path(feed_path, version):
+    # one file per feed version, a feed update removes the old one once
+    # nothing uses that feed any more
+    return Path(feed_path).with_name(f"{Path(feed_path).stem}.{version}.sqlite")
+
+
+def build_database(feed, path):
+    """Write the tables of a loaded feed to a SQLite file with indexes."""
+    path = Path(path)
+    temporary = path.with_suffix(".tmp")
+    temporary.unlink(missing_ok=True)
+    with sqlite3.connect(temporary) as connection:
+        for name in ["routes", "trips", "stops", "calendar", "calendar_dates"]:
+            table = getattr(feed, name)
+            if table is not None:
+                table.to_sql(name, connection, index=False, chunksize=100_000)
+        # the parsed times are stored next to the text, written in chunks
+        stop_times = feed.stop_times.assign(
+            arrival_seconds=time_to_seconds(feed.stop_times["arrival_time"]),
+            departure_seconds=time_to_seconds(feed.stop_times["departure_time"]),
+        )
+        for start in range(0, len(stop_times), 500_000):
+            stop_times.iloc[start : start + 500_000].to_sql(
+                "stop_times", connection, index=False, if_exists="append"
+            )
+        # hashed now, a feed update compares them without reading the stop times
+        hashes = trip_hashes(stop_times, ("arrival_seconds", "departure_seconds"))
+        # sqlite integers are signed
+        hashes.astype(np.int64).rename_axis("trip_id").reset_index().to_sql(
+            "trip_hashes", connection, index=False
+        )
+        del stop_times
+        ghost_stops = getattr(feed, "ghost_stops", None)
+        if ghost_stops is not None:
+            ghost_stops.to_sql("ghost_stops", connection, index=False)
+        for name, columns in INDEXES.items():
+            connection.execute(f"create index {name} on {columns}")
+        connection.execute("create table metadata (key text primary key, value text)")
+        connection.executemany(
+            "insert into metadata values (?, ?)",
+            [
+                ("version", str(feed.version)),
+                (
+                    "ghost_stops_dropped",
+                    str(int(getattr(feed, "ghost_stops_dropped", False))),
+                ),
+            ],
+        )
+        connection.execute("analyze")
+    os.replace(temporary, path)
+    return path
+
+
+def database_version(path):
+    if not Path(path).exists():
+        return None
+    with sqlite3.connect(f"file:{path}?mode=ro", uri=True) as connection:
+        row = connection.execute(
+            "select value from metadata where key = 'version'"
+        ).fetchone()
+    return row[0] if row else None
+
+
+class SqlFeed:
+    """A feed stored in SQLite, the small tables are also kept in memory.
+
+    Each thread gets its own read only connection.
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self._local = threading.local()
+        self.version = database_version(self.path)
+        tables = {
+            row[0]
+            for row in self.connection.execute(
+                "select name from sqlite_master where type = 'table'"
+            )
+        }
+        # missing optional tables are None like in gtfs_kit
+        for name in MEMORY_TABLES:
+            setattr(
+                self,
+                name,
+                self.query(f"select * from {name}") if name in tables else None,
+            )
+        self.ghost_stops = (
+            self.query("select * from ghost_stops")
+            if "ghost_stops" in tables
+            else pd.DataFrame(columns=["route_id", "parent_station"])
+        )
+        # missing in databases built before the hashes were stored
+        self.trip_hashes = (
+            self.query("select * from trip_hashes")
+            .set_index("trip_id")["hash"]
+            .astype(np.uint64)
+            if "trip_hashes" in tables
+            else None
+        )
+        self.ghost_stops_dropped = self.connection.execute(
+            "select value from metadata where key = 'ghost_stops_dropped'"
+        ).fetchone() == ("1",)
+        self.columns = {
+            name: [
+                row[1] for row in self.connection.execute(f"pragma table_info({name})")
+            ]
+            for name in ["stop_times", "trips", "routes", "stops"]
+        }
+
+    @property
+    def connection(self):
+        if getattr(self._local, "connection", None) is None:
+            self._local.connection = sqlite3.connect(
+                f"file:{self.path}?mode=ro", uri=True, check_same_thread=False
+            )
+        return self._local.connection
+
+    def query(self, sql, parameters=()):
+        return pd.read_sql_query(sql, self.connection, params=list(parameters))
+
+    @cached_property
+    def trips(self):
+        # read on first use and kept, a feed update reads them several times
+        return self.query("select * from trips")
+
+    @property
+    def stop_times(self):
+        return self.stop_times_of()
+
+    def stop_times_of(self, trip_ids=None, times="text"):
+        columns = [
+            column
+            for column in self.columns["stop_times"]
+            if column not in ("arrival_seconds", "departure_seconds")
+        ]
+        if times is None:
+            columns = [
+                column
+                for column in columns
+                if column not in ("arrival_time", "departure_time")
+            ]
+        elif times == "seconds":
+            columns += [
+                "arrival_seconds as arrival_time_parsed",
+                "departure_seconds as departure_time_parsed",
+            ]
+        sql = f"select {', '.join(columns)} from stop_times"
+        if trip_ids is None:
+            return self.query(sql + " order by rowid")
+        trip_ids = list(pd.unique(pd.Series(trip_ids, dtype=object)))
+        return self._with_values(
+            sql + " where trip_id in (select value from values_) order by rowid",
+            trip_ids,
+        )
+
+    def _with_values(self, sql, values):
+        # long id lists go through a temporary table instead of parameters
+        connection = self.connection
+        connection.execute("create temp table if not exists values_ (value text)")
+        connection.execute("delete from values_")
+        connection.executemany(
+            "insert into values_ values (?)", ((value,) for value in values)
+        )
+        return self.query(sql)
+
+    def trips_at(self, stop_ids):
+        return self._with_values(
+            "select distinct trip_id from stop_times"
+            " where stop_id in (select value from values_)",
+            list(stop_ids),
+        )["trip_id"].to_numpy()
+
+    def get_routes(self, station_id):
+        return self.query(
+            """
+            select * from routes
+            where route_id in (
+                select trips.route_id
+                from stops
+                join stop_times on stop_times.stop_id = stops.stop_id
+                join trips on trips.trip_id = stop_times.trip_id
+                where stops.parent_station = ?
+            )
+            -- EXT are special trains, not usually accessible
+            and coalesce(route_short_name, '') != 'EXT'
+            order by rowid
+            """,
+            [station_id],
+        )
+
+    def get_stops(self, route_ids, active_days, relevant_hours):
+        days = " and ".join(
+            f"{day.lower()} = 1"
+            for day in active_days
+            if day.lower() in WEEKDAY_COLUMNS
+        )
+        lower_bound, upper_bound = [hour * 3600 for hour in relevant_hours]
+        trip_columns = [
+            f"trips.{column}" for column in self.columns["trips"] if column != "trip_id"
+        ]
+        route_columns = [
+            f"routes.{column}"
+            for column in self.columns["routes"]
+            if column != "route_id"
+        ]
+        stop_columns = [
+            f"stops.{column}" for column in self.columns["stops"] if column != "stop_id"
+        ]
+        stop_time_columns = [
+            f"stop_times.{column}"
+            for column in self.columns["stop_times"]
+            if column not in ("arrival_seconds", "departure_seconds")
+        ]
+        columns = stop_time_columns + trip_columns + route_columns + stop_columns
+        names = ", ".join(column.split(".")[1] for column in columns)
+        # like the pandas version: the trip with the highest stop sequence of
+        # the filtered stops is the longest trip of a route, its whole stop
+        # times are returned
+        return self._with_values(
+            f"""
+            with route_trips as (
+                select trip_id, route_id from trips
+                where route_id in (select value from values_)
+                and service_id in (
+                    select service_id from calendar {"where " + days if days else ""}
+                )
+            ),
+            filtered as (
+                select route_trips.route_id, stop_times.trip_id,
+                    stop_times.stop_sequence, stop_times.rowid as row
+                from stop_times
+                join route_trips on route_trips.trip_id = stop_times.trip_id
+                where stop_times.pickup_type = 0 and stop_times.drop_off_type = 0
+                and (
+                    (arrival_seconds > {lower_bound} and arrival_seconds < {upper_bound})
+                    or (
+                        departure_seconds > {lower_bound}
+                        and departure_seconds < {upper_bound}
+                    )
+                )
+            ),
+            longest as (
+                select trip_id from (
+                    select trip_id, row_number() over (
+                        partition by route_id order by stop_sequence desc, row
+                    ) as rank
+                    from filtered
+                )
+                where rank = 1
+            ),
+            joined as (
+                select {", ".join(columns)}, stop_times.rowid as row,
+                    min(stop_times.rowid) over (partition by stop_times.trip_id)
+                        as trip_first
+                from stop_times
+                join trips on trips.trip_id = stop_times.trip_id
+                join routes on routes.route_id = trips.route_id
+                join stops on stops.stop_id = stop_times.stop_id
+                where stop_times.trip_id in (select trip_id from longest)
+            ),
+            -- the rows in the order of the pandas merges, which group them by
+            -- trip, then by route and then by stop in order of appearance
+            by_trip as (
+                select *, row_number() over (order by trip_first, row) as trip_order
+                from joined
+            ),
+            by_route as (
+                select *, row_number() over (order by route_first, trip_order)
+                    as route_order
+                from (
+                    select *, min(trip_order) over (partition by route_id)
+                        as route_first
+                    from by_trip
+                )
+            )
+            select {names} from (
+                select *, min(route_order) over (partition by stop_id) as stop_first
+                from by_route
+            )
+            order by stop_first, route_order
+            """,
+            list(route_ids),
+        )
@@ -0,0 +1,29 @@
+import pandas as pd
+
+import batch
+import core
+from benchmarks.synthetic import generate
+
+
+def test_bad_rows_only_fail_their_job(tmp_path):
+    feed_path = tmp_path / "feed.zip"
+    generate(feed_path, scale=0.01)
+    station_ids = core.parse_stations(core.load_feed(feed_path, lazy=False))["stop_id"]
+    first, second = station_ids.iloc[0], station_ids.iloc[1]
+    pd.DataFrame(
+        {
+            "id": ["ok", "letters", "one_hour", "reversed", "late", "funday", "none"],
+            "destinations": [f"{first};{second}"] * 6 + [""],
+            "hours": ["6-22", "abc", "7", "22-6", "6-24", "", ""],
+            "weekdays": ["", "", "", "", "", "Monday;Funday", ""],
+        }
+    ).to_csv(tmp_path / "jobs.csv", index=False)
+
+    _, failed = batch.run(
+        tmp_path / "jobs.csv", str(tmp_path / "out.csv"), feed_path, processes=1
+    )
+
+    assert set(failed) == {"letters", "one_hour", "reversed", "late", "funday", "none"}
+    assert "abc" in failed["letters"]
+    assert "Funday" in failed["funday"]
+    assert set(pd.read_csv(tmp_path / "out.csv")["job"]) == {"ok"}
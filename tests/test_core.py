@@ -0,0 +1,29 @@
+import numpy as np
+import pytest
+
+import core
+from benchmarks.synthetic import generate
+from cache import LRUCache
+
+DAYS = core.WEEKDAYS[:5]
+HOURS = (6, 22)
+
+
+@pytest.fixture
+def cache():
+    previous = core.get_cache()
+    core.set_cache(LRUCache(64 * 1024 * 1024))
+    yield core.get_cache()
+    core.set_cache(previous)
+
+
+def test_array_arguments_share_the_cached_result(tmp_path, cache):
+    path = tmp_path / "feed.zip"
+    generate(path, scale=0.01)
+    feed = core.load_feed(path, backend="pandas", lazy=False)
+    route_ids = feed.routes["route_id"].to_numpy()[:3]
+
+    stops = core.get_stops(feed, route_ids, DAYS, HOURS)
+    assert core.get_stops.is_cached(feed, list(route_ids), DAYS, HOURS)
+    assert core.get_stops(feed, list(route_ids), DAYS, HOURS) is stops
+    assert core.get_stops.is_cached(feed, np.array(list(route_ids)), DAYS, HOURS)
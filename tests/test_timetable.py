@@ -0,0 +1,121 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from timetable import (
+    STOP_TIMES_COLUMNS,
+    CompressedTimetable,
+    seconds_to_time,
+    time_to_seconds,
+)
+
+STOPS = ["8503000", "8503006", "8503011", "8503016"]
+
+
+def _stop_times(trips=6, headway=1800):
+    # trips of one line every half hour, the first stop only has a departure
+    rows = []
+    for trip in range(trips):
+        start = 6 * 3600 + trip * headway
+        for sequence, stop_id in enumerate(STOPS):
+            arrival = start + sequence * 300
+            rows.append(
+                {
+                    "trip_id": f"trip-{trip}",
+                    "arrival_time": arrival if sequence else np.nan,
+                    "departure_time": arrival + 60,
+                    "stop_id": stop_id,
+                    "stop_sequence": sequence + 1,
+                    "pickup_type": 0,
+                    "drop_off_type": 0,
+                }
+            )
+    stop_times = pd.DataFrame(rows)
+    for column in ("arrival_time", "departure_time"):
+        stop_times[column] = seconds_to_time(stop_times[column])
+    return stop_times[STOP_TIMES_COLUMNS]
+
+
+def _sorted(stop_times):
+    return (
+        stop_times[STOP_TIMES_COLUMNS]
+        .sort_values(["trip_id", "stop_sequence"])
+        .reset_index(drop=True)
+    )
+
+
+def _assert_roundtrip(stop_times):
+    timetable = CompressedTimetable.from_stop_times(stop_times)
+    pd.testing.assert_frame_equal(
+        _sorted(timetable.stop_times()), _sorted(stop_times), check_dtype=False
+    )
+    return timetable
+
+
+def _at(stop_times, trip_id, stop_id):
+    return (stop_times["trip_id"] == trip_id) & (stop_times["stop_id"] == stop_id)
+
+
+def test_roundtrip_shares_one_pattern():
+    timetable = _assert_roundtrip(_stop_times())
+    assert len(timetable.pattern_lengths) == 1
+    assert len(timetable.deviations) == 0
+
+
+def test_roundtrip_missing_times():
+    stop_times = _stop_times()
+    # a stop without times in every trip and one without an arrival in one trip
+    stop_times.loc[stop_times["stop_id"] == STOPS[2], STOP_TIMES_COLUMNS[1:3]] = None
+    stop_times.loc[_at(stop_times, "trip-3", STOPS[3]), "arrival_time"] = None
+    _assert_roundtrip(stop_times)
+
+
+def test_roundtrip_jittered_trips():
+    stop_times = _stop_times()
+    stop_times.loc[_at(stop_times, "trip-1", STOPS[1]), "departure_time"] = "06:37:30"
+    stop_times.loc[_at(stop_times, "trip-4", STOPS[3]), "arrival_time"] = "08:17:00"
+    timetable = _assert_roundtrip(stop_times)
+    assert len(timetable.pattern_lengths) == 1
+    assert len(timetable.deviations) == 2
+
+
+def test_roundtrip_pickup_changes():
+    stop_times = _stop_times()
+    stop_times.loc[_at(stop_times, "trip-2", STOPS[1]), "pickup_type"] = 1
+    stop_times.loc[_at(stop_times, "trip-5", STOPS[3]), "drop_off_type"] = 3
+    timetable = _assert_roundtrip(stop_times)
+    assert len(timetable.pattern_lengths) == 3
+
+
+def test_roundtrip_shuffled_rows():
+    stop_times = _stop_times()
+    stop_times.loc[_at(stop_times, "trip-1", STOPS[2]), "arrival_time"] = "06:41:00"
+    _assert_roundtrip(stop_times.sample(frac=1, random_state=0))
+
+
+def test_stop_times_of_some_trips():
+    stop_times = _stop_times()
+    timetable = CompressedTimetable.from_stop_times(stop_times)
+    selected = timetable.stop_times(["trip-4", "trip-2", "unknown"])
+    pd.testing.assert_frame_equal(
+        _sorted(selected),
+        _sorted(stop_times.loc[stop_times["trip_id"].isin(["trip-2", "trip-4"])]),
+        check_dtype=False,
+    )
+
+
+def test_time_to_seconds():
+    seconds = time_to_seconds(
+        pd.Series(["07:05:00", " 7:05:00", "7:05:00\t", "25:00:01", None, "", " "])
+    )
+    np.testing.assert_array_equal(
+        seconds, [25500, 25500, 25500, 90001, np.nan, np.nan, np.nan]
+    )
+
+
+@pytest.mark.parametrize(
+    "value", ["100:00:00", "   12:30:459", "7:5:00", "07:65:00", "07.05.00", "ab"]
+)
+def test_time_to_seconds_rejects(value):
+    with pytest.raises(ValueError, match="invalid time"):
+        time_to_seconds(pd.Series(["07:05:00", value]))
@@ -0,0 +1,132 @@
+import gc
+import os
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+import pytest
+
+import core
+from benchmarks.synthetic import generate
+from cache import LRUCache
+from updates import LiveFeed
+
+DAYS = core.WEEKDAYS[:5]
+HOURS = (6, 22)
+
+
+@pytest.fixture
+def cache():
+    previous = core.get_cache()
+    core.set_cache(LRUCache(64 * 1024 * 1024))
+    yield core.get_cache()
+    core.set_cache(previous)
+
+
+def _load(path):
+    return core.load_feed(path, backend="pandas", lazy=False)
+
+
+def _rewrite(path, changes):
+    # the same feed with some tables changed, read and written as text
+    with zipfile.ZipFile(path) as archive:
+        tables = {
+            name: pd.read_csv(archive.open(name), dtype=str, keep_default_na=False)
+            for name in archive.namelist()
+        }
+    for name, change in changes.items():
+        change(tables[name])
+    with zipfile.ZipFile(path, "w") as archive:
+        for name, table in tables.items():
+            archive.writestr(name, table.to_csv(index=False))
+
+
+def _routes_of_stations(feed):
+    return {
+        station_id: set(core.get_routes(feed, station_id)["route_id"])
+        for station_id in core.parse_stations(feed)["stop_id"]
+    }
+
+
+def test_update_keeps_unaffected_results(tmp_path, cache):
+    path = tmp_path / "feed.zip"
+    generate(path, scale=0.01)
+    live = LiveFeed(path, load=_load)
+    old = live.feed
+    route_ids = list(old.routes["route_id"])
+    renamed_route, retimed_route = route_ids[0], route_ids[-1]
+    retimed_trip = old.trips.loc[old.trips["route_id"] == retimed_route, "trip_id"]
+    retimed_trip = retimed_trip.iloc[0]
+
+    # every station and route has results in the cache
+    stations = _routes_of_stations(old)
+    for route_id in route_ids:
+        core.get_stops(old, [route_id], DAYS, HOURS)
+    changed = {renamed_route, retimed_route}
+    affected = [station for station, routes in stations.items() if routes & changed]
+    unaffected = [
+        station for station, routes in stations.items() if not routes & changed
+    ]
+    assert affected and unaffected
+
+    def rename(routes):
+        routes.loc[routes["route_id"] == renamed_route, "route_short_name"] = "X99"
+
+    def retime(stop_times):
+        trip = stop_times["trip_id"] == retimed_trip
+        for column in ("arrival_time", "departure_time"):
+            stop_times.loc[trip, column] = "23:59:00"
+
+    _rewrite(path, {"routes.txt": rename, "stop_times.txt": retime})
+    update = live.update()
+    new = live.feed
+
+    assert update.changed_trips == {retimed_trip}
+    assert update.affected_routes == changed
+    assert core.feed_version(new) != core.feed_version(old)
+    for station_id in affected:
+        assert not core.get_routes.is_cached(new, station_id)
+    for station_id in unaffected:
+        assert core.get_routes.is_cached(new, station_id)
+    for route_id in route_ids:
+        kept = core.get_stops.is_cached(new, [route_id], DAYS, HOURS)
+        assert kept == (route_id not in changed)
+    # nothing of the old version is left
+    assert not any(core.feed_version(old) in key for key in cache.keys())
+
+    # the cached results are the ones of the new feed
+    renamed = core.get_stops(new, [renamed_route], DAYS, HOURS)
+    assert set(renamed["route_short_name"]) == {"X99"}
+
+
+def test_unchanged_file_is_not_loaded_again(tmp_path, cache):
+    path = tmp_path / "feed.zip"
+    generate(path, scale=0.01)
+    loads = []
+    live = LiveFeed(path, load=lambda path: loads.append(path) or _load(path))
+    # only the modification time changes
+    os.utime(path, ns=(0, 0))
+    assert live.check() is None
+    assert len(loads) == 1
+
+
+@pytest.mark.parametrize("backend", ["sqlite", "parquet"])
+def test_old_feed_stays_readable_until_unused(tmp_path, cache, backend):
+    path = tmp_path / "feed.zip"
+    generate(path, scale=0.01)
+    live = LiveFeed(path, load=lambda path: core.load_feed(path, backend=backend))
+    old = live.feed
+    old_files = set(tmp_path.iterdir())
+
+    generate(path, scale=0.01, seed=1)
+    live.update()
+    # a thread which did not query the old feed yet, like a rerun in flight
+    with ThreadPoolExecutor(1) as executor:
+        stops = executor.submit(core.stop_times_of, old, old.trips["trip_id"][:5])
+        assert len(stops.result())
+    assert old_files <= set(tmp_path.iterdir())
+
+    del old
+    gc.collect()
+    remaining = set(tmp_path.iterdir())
+    assert remaining & old_files == {path}
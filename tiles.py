@@ -0,0 +1,431 @@
+import argparse
+import json
+import math
+import struct
+import shutil
+import threading
+import urllib.request
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import numpy as np
+
+from core import load_feed, parse_stations, stop_times_of
+
+TILES_DIR = "tiles"
+EXTENT = 4096
+# extra pixels around each tile, so lines and markers are not cut at the edges
+BUFFER = 64
+MIN_ZOOM = 5
+MAX_ZOOM = 11
+CACHE_MAX_AGE = 24 * 60 * 60
+# served next to the tiles, the maps do not load scripts from the internet,
+# pinned as a new release could change the styling API
+VECTORGRID_JS = (
+    "https://unpkg.com/leaflet.vectorgrid@1.3.0/dist/Leaflet.VectorGrid.bundled.js"
+)
+VECTORGRID_FILE = "vectorgrid.js"
+
+ROUTES_LAYER = "routes"
+STATIONS_LAYER = "stations"
+
+
+# Encoding
+#####
+# minimal protobuf writer for the Mapbox vector tile spec 2.1
+# https://github.com/mapbox/vector-tile-spec/blob/master/2.1/vector_tile.proto
+def _varint(value):
+    out = bytearray()
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return bytes(out)
+
+
+def _zigzag(value):
+    return (value << 1) ^ (value >> 63)
+
+
+def _field(number, wire_type, payload):
+    key = _varint((number << 3) | wire_type)
+    if wire_type == 0:
+        return key + _varint(payload)
+    return key + _varint(len(payload)) + payload
+
+
+def _packed(values):
+    return b"".join(_varint(value) for value in values)
+
+
+def _encode_value(value):
+    if isinstance(value, (bool, np.bool_)):
+        return _field(7, 0, int(value))
+    if isinstance(value, (int, np.integer)):
+        return _field(6, 0, _zigzag(int(value)))
+    if isinstance(value, (float, np.floating)):
+        return b"\x19" + struct.pack("<d", value)
+    return _field(1, 2, str(value).encode())
+
+
+def _encode_geometry(geom_type, parts):
+    geometry = []
+    cursor_x = cursor_y = 0
+    for part in parts:
+        for i, (x, y) in enumerate(part):
+            if i == 0:
+                geometry.append((1 & 0x7) | (1 << 3))
+            elif i == 1 and geom_type == 2:
+                geometry.append((2 & 0x7) | ((len(part) - 1) << 3))
+            geometry.append(_zigzag(x - cursor_x))
+            geometry.append(_zigzag(y - cursor_y))
+            cursor_x, cursor_y = x, y
+    return geometry
+
+
+def encode_layer(name, features):
+    keys, values = {}, {}
+    encoded_features = []
+    for geom_type, parts, properties in features:
+        tags = []
+        for key, value in properties.items():
+            if value is None or (isinstance(value, float) and math.isnan(value)):
+                continue
+            tags.append(keys.setdefault(key, len(keys)))
+            tags.append(values.setdefault(_encode_value(value), len(values)))
+        feature = (
+            _field(2, 2, _packed(tags))
+            + _field(3, 0, geom_type)
+            + _field(4, 2, _packed(_encode_geometry(geom_type, parts)))
+        )
+        encoded_features.append(_field(2, 2, feature))
+
+    return _field(
+        3,
+        2,
+        _field(15, 0, 2)
+        + _field(1, 2, name.encode())
+        + b"".join(encoded_features)
+        + b"".join(_field(3, 2, key.encode()) for key in keys)
+        + b"".join(_field(4, 2, value) for value in values)
+        + _field(5, 0, EXTENT),
+    )
+
+
+# Geometry
+#####
+def project(lat, lon, zoom):
+    # web mercator to global pixel coordinates in tile extent units
+    size = EXTENT * 2**zoom
+    lat = np.radians(np.clip(lat, -85.0511, 85.0511))
+    x = (np.asarray(lon) + 180) / 360 * size
+    y = (1 - np.arcsinh(np.tan(lat)) / math.pi) / 2 * size
+    return x, y
+
+
+def _tile_range(low, high):
+    return range(int((low - BUFFER) // EXTENT), int((high + BUFFER) // EXTENT) + 1)
+
+
+def _clip_line(x, y):
+    # split the line into runs of segments per tile, which touch the buffered tile
+    segments = defaultdict(list)
+    for i in range(len(x) - 1):
+        for tile_x in _tile_range(min(x[i], x[i + 1]), max(x[i], x[i + 1])):
+            for tile_y in _tile_range(min(y[i], y[i + 1]), max(y[i], y[i + 1])):
+                segments[(tile_x, tile_y)].append(i)
+
+    for (tile_x, tile_y), indices in segments.items():
+        parts = []
+        run = [indices[0]]
+        for i in indices[1:]:
+            if i != run[-1] + 1:
+                parts.append(run)
+                run = []
+            run.append(i)
+        parts.append(run)
+
+        tile_parts = []
+        for run in parts:
+            points = []
+            for i in [*run, run[-1] + 1]:
+                point = (
+                    int(round(x[i] - tile_x * EXTENT)),
+                    int(round(y[i] - tile_y * EXTENT)),
+                )
+                # low zooms collapse close stops onto the same pixel
+                if not points or points[-1] != point:
+                    points.append(point)
+            if len(points) > 1:
+                tile_parts.append(points)
+        if tile_parts:
+            yield (tile_x, tile_y), tile_parts
+
+
+def _new_segments(parts, drawn):
+    # the parts without the segments in `drawn`, in either direction
+    new_parts = []
+    for part in parts:
+        run = [part[0]]
+        for start, end in zip(part, part[1:]):
+            segment = (start, end) if start <= end else (end, start)
+            if segment not in drawn:
+                drawn.add(segment)
+                run.append(end)
+                continue
+            if len(run) > 1:
+                new_parts.append(run)
+            run = [end]
+        if len(run) > 1:
+            new_parts.append(run)
+    return new_parts
+
+
+# Network
+#####
+def network_patterns(feed):
+    stop_times = stop_times_of(feed, times=None)[
+        ["trip_id", "stop_sequence", "stop_id"]
+    ].sort_values(["trip_id", "stop_sequence"])
+    sequences = stop_times.groupby("trip_id", sort=False)["stop_id"].agg(" ".join)
+    patterns = (
+        feed.trips[["trip_id", "route_id"]]
+        .assign(stops=lambda trips: trips["trip_id"].map(sequences))
+        .dropna(subset="stops")
+        .drop_duplicates(["route_id", "stops"])
+        .merge(
+            feed.routes[["route_id", "route_short_name", "route_type"]], on="route_id"
+        )
+    )
+    # EXT are special trains, not usually accessible
+    return patterns.loc[patterns["route_short_name"] != "EXT"]
+
+
+def build_tiles(feed, version, out_dir=TILES_DIR, zooms=range(MIN_ZOOM, MAX_ZOOM + 1)):
+    out_dir = Path(out_dir)
+    coordinates = feed.stops.set_index("stop_id")[["stop_lat", "stop_lon"]]
+    patterns = network_patterns(feed)
+    stations = parse_stations(feed)
+
+    pattern_coordinates = [
+        coordinates.reindex(stops.split(" ")).dropna().to_numpy()
+        for stops in patterns["stops"]
+    ]
+    pattern_properties = patterns[
+        ["route_id", "route_short_name", "route_type"]
+    ].to_dict(orient="records")
+
+    route_properties = {
+        properties["route_id"]: properties for properties in pattern_properties
+    }
+
+    tile_count = 0
+    for zoom in zooms:
+        tiles = defaultdict(lambda: {ROUTES_LAYER: [], STATIONS_LAYER: []})
+
+        # one feature per route and tile, the patterns of a route (directions,
+        # short turns, other platforms) mostly run on the same track
+        route_parts = defaultdict(lambda: defaultdict(list))
+        drawn = defaultdict(set)
+        for points, properties in zip(pattern_coordinates, pattern_properties):
+            if len(points) < 2:
+                continue
+            route_id = properties["route_id"]
+            x, y = project(points[:, 0], points[:, 1], zoom)
+            for tile, parts in _clip_line(x, y):
+                route_parts[tile][route_id].extend(
+                    _new_segments(parts, drawn[tile, route_id])
+                )
+        for tile, routes in route_parts.items():
+            for route_id, parts in routes.items():
+                tiles[tile][ROUTES_LAYER].append((2, parts, route_properties[route_id]))
+
+        x, y = project(stations["stop_lat"].values, stations["stop_lon"].values, zoom)
+        for station, station_x, station_y in zip(
+            stations[["stop_id", "stop_name"]].to_dict(orient="records"), x, y
+        ):
+            for tile_x in _tile_range(station_x, station_x):
+                for tile_y in _tile_range(station_y, station_y):
+                    point = (
+                        int(round(station_x - tile_x * EXTENT)),
+                        int(round(station_y - tile_y * EXTENT)),
+                    )
+                    tiles[(tile_x, tile_y)][STATIONS_LAYER].append(
+                        (1, [[point]], station)
+                    )
+
+        for (tile_x, tile_y), layers in tiles.items():
+            path = out_dir / str(zoom) / str(tile_x) / f"{tile_y}.pbf"
+            path.parent.mkdir(parents=True, exist_ok=True)
+            path.write_bytes(
+                b"".join(
+                    encode_layer(name, features)
+                    for name, features in layers.items()
+                    if features
+                )
+            )
+            tile_count += 1
+
+    bounds = [
+        float(feed.stops["stop_lon"].min()),
+        float(feed.stops["stop_lat"].min()),
+        float(feed.stops["stop_lon"].max()),
+        float(feed.stops["stop_lat"].max()),
+    ]
+    metadata = {
+        "version": version,
+        "minzoom": min(zooms),
+        "maxzoom": max(zooms),
+        "bounds": bounds,
+        "layers": [ROUTES_LAYER, STATIONS_LAYER],
+        "tiles": tile_count,
+    }
+    (out_dir / "metadata.json").write_text(json.dumps(metadata, indent=2))
+    return metadata
+
+
+def copy_vectorgrid(out_dir=TILES_DIR, source=None):
+    """Put the VectorGrid script into the tiles, from `source` or downloaded."""
+    path = Path(out_dir) / VECTORGRID_FILE
+    path.parent.mkdir(parents=True, exist_ok=True)
+    if source is not None:
+        shutil.copyfile(source, path)
+    elif not path.exists():
+        with urllib.request.urlopen(VECTORGRID_JS, timeout=30) as response:
+            path.write_bytes(response.read())
+    return path
+
+
+def read_metadata(tiles_dir=TILES_DIR):
+    path = Path(tiles_dir) / "metadata.json"
+    if not path.exists():
+        return None
+    return json.loads(path.read_text())
+
+
+# Serving
+#####
+class TileRequestHandler(BaseHTTPRequestHandler):
+    tiles_dir = Path(TILES_DIR)
+    version = ""
+
+    def do_GET(self):
+        path = self.path.split("?")[0].strip("/")
+        if path == "metadata.json":
+            return self._send((self.tiles_dir / path).read_bytes(), "application/json")
+        if path == VECTORGRID_FILE:
+            script = self.tiles_dir / path
+            if not script.exists():
+                return self.send_error(404)
+            return self._send(script.read_bytes(), "text/javascript")
+
+        parts = path.removesuffix(".pbf").split("/")
+        if len(parts) != 3 or not all(part.lstrip("-").isdigit() for part in parts):
+            return self.send_error(404)
+
+        etag = f'"{self.version}-{"-".join(parts)}"'
+        if self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self._cache_headers(etag)
+            return self.end_headers()
+
+        # tiles without any feature are not written, an empty body is a valid tile
+        tile = self.tiles_dir.joinpath(*parts[:2], f"{parts[2]}.pbf")
+        content = tile.read_bytes() if tile.exists() else b""
+        self._send(content, "application/x-protobuf", etag)
+
+    def _cache_headers(self, etag):
+        self.send_header("Cache-Control", f"public, max-age={CACHE_MAX_AGE}")
+        self.send_header("ETag", etag)
+        # the maps are rendered in an iframe from another origin
+        self.send_header("Access-Control-Allow-Origin", "*")
+
+    def _send(self, content, content_type, etag=None):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(content)))
+        self._cache_headers(etag or f'"{self.version}"')
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class TileServer:
+    def __init__(self, tiles_dir=TILES_DIR, host="127.0.0.1", port=0):
+        metadata = read_metadata(tiles_dir)
+        handler = type(
+            "Handler",
+            (TileRequestHandler,),
+            {"tiles_dir": Path(tiles_dir), "version": metadata["version"]},
+        )
+        self.metadata = metadata
+        self.httpd = ThreadingHTTPServer((host, port), handler)
+        self.httpd.daemon_threads = True
+
+    @property
+    def base_url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    @property
+    def url(self):
+        return f"{self.base_url}/{{z}}/{{x}}/{{y}}.pbf"
+
+    @property
+    def script_url(self):
+        return f"{self.base_url}/{VECTORGRID_FILE}"
+
+    def start(self):
+        threading.Thread(target=self.httpd.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Pre-render the network into vector tiles and serve them locally."
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+    build = commands.add_parser("build")
+    build.add_argument("--feed", default="gtfs.zip")
+    build.add_argument("--out", default=TILES_DIR)
+    build.add_argument("--min-zoom", type=int, default=MIN_ZOOM)
+    build.add_argument("--max-zoom", type=int, default=MAX_ZOOM)
+    build.add_argument(
+        "--vectorgrid",
+        help=f"local copy of the VectorGrid script, downloaded from {VECTORGRID_JS}"
+        " if not given",
+    )
+    serve = commands.add_parser("serve")
+    serve.add_argument("--dir", default=TILES_DIR)
+    serve.add_argument("--host", default="127.0.0.1")
+    serve.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args()
+
+    if args.command == "build":
+        # before the tiles, which take a while to render
+        copy_vectorgrid(args.out, args.vectorgrid)
+        feed = load_feed(args.feed)
+        metadata = build_tiles(
+            feed,
+            feed.version,
+            args.out,
+            range(args.min_zoom, args.max_zoom + 1),
+        )
+        print(f"Wrote {metadata['tiles']} tiles to {args.out}")
+    else:
+        server = TileServer(args.dir, args.host, args.port)
+        print(f"Serving {server.url}")
+        server.httpd.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,316 @@
+import numpy as np
+import pandas as pd
+
+STOP_TIMES_COLUMNS = [
+    "trip_id",
+    "arrival_time",
+    "departure_time",
+    "stop_id",
+    "stop_sequence",
+    "pickup_type",
+    "drop_off_type",
+]
+# the columns which make up a stop pattern besides the order of the stops
+PATTERN_COLUMNS = ["stop_id", "stop_sequence", "pickup_type", "drop_off_type"]
+# the stop times a trip hash covers, the two times are in seconds
+TRIP_HASH_COLUMNS = [
+    "trip_id",
+    "stop_id",
+    "stop_sequence",
+    "pickup_type",
+    "drop_off_type",
+]
+# positions of the digits in HH:MM:SS and the characters str.strip removes first
+TIME_DIGITS = [0, 1, 3, 4, 6, 7]
+WHITESPACE = [ord(character) for character in " \t\n\r\x0b\x0c"]
+
+
+def time_to_seconds(times):
+    """Seconds of HH:MM:SS times, hours can be past 24.
+
+    Missing and blank times become NaN, anything else which is not a time
+    raises a ValueError.
+    """
+    # parsed with numpy, which unlike pd.to_timedelta does not hold the GIL
+    text = times.fillna("").to_numpy(dtype="U9")
+    codes = text.view(np.uint32).reshape(-1, 9)
+    # one character more than a time shows the values which are too long,
+    # those and the ones with spaces are stripped one by one
+    irregular = np.flatnonzero(
+        (codes[:, 8] != 0) | np.isin(codes, WHITESPACE).any(axis=1)
+    )
+    if len(irregular):
+        values = times.iloc[irregular].fillna("").astype(str).str.strip()
+        too_long = values.loc[values.str.len() > 8]
+        if len(too_long):
+            raise ValueError(f"invalid time {too_long.iloc[0]!r}")
+        text[irregular] = values.to_numpy()
+    missing = text == ""
+    text = np.char.rjust(text.astype("U8"), 8, "0")
+    digits = text.view(np.uint32).reshape(-1, 8).astype(np.int64) - ord("0")
+
+    valid = missing | (
+        (digits[:, TIME_DIGITS] >= 0) & (digits[:, TIME_DIGITS] <= 9)
+    ).all(axis=1) & (digits[:, [2, 5]] == ord(":") - ord("0")).all(axis=1) & (
+        digits[:, [3, 6]] <= 5
+    ).all(
+        axis=1
+    )
+    if not valid.all():
+        raise ValueError(f"invalid time {times.iloc[np.argmin(valid)]!r}")
+    seconds = (
+        (digits[:, 0] * 10 + digits[:, 1]) * 3600
+        + (digits[:, 3] * 10 + digits[:, 4]) * 60
+        + digits[:, 6] * 10
+        + digits[:, 7]
+    )
+    return np.where(missing, np.nan, seconds)
+
+
+def seconds_to_time(seconds):
+    # the reverse of time_to_seconds, NaN becomes None
+    seconds = np.asarray(seconds, dtype=float)
+    missing = np.isnan(seconds)
+    whole = np.where(missing, 0, seconds).astype(np.int64)
+    digits = np.column_stack(
+        [
+            whole // 36000,
+            whole // 3600 % 10,
+            np.full(len(whole), ord(":") - ord("0")),
+            whole // 600 % 6,
+            whole // 60 % 10,
+            np.full(len(whole), ord(":") - ord("0")),
+            whole // 10 % 6,
+            whole % 10,
+        ]
+    )
+    text = (digits + ord("0")).astype(np.uint8).view("S8").ravel().astype(str)
+    return np.where(missing, None, text.astype(object))
+
+
+def trip_hashes(stop_times, times=("arrival_time_parsed", "departure_time_parsed")):
+    """One hash per trip over all its stop times, independent of the row order.
+
+    `times` are the columns of the arrival and departure in seconds, the
+    hashes are the same for every representation of the stop times.
+    """
+    stop_times = stop_times[[*TRIP_HASH_COLUMNS, *times]].astype(
+        {column: float for column in [*TRIP_HASH_COLUMNS[2:], *times]}
+    )
+    codes, trip_ids = pd.factorize(stop_times["trip_id"])
+    order = np.argsort(codes, kind="stable")
+    hashes = pd.util.hash_pandas_object(stop_times, index=False).to_numpy()[order]
+    starts = np.flatnonzero(np.r_[True, np.diff(codes[order]) != 0])
+    # a sum does not depend on the row order, the stop sequence is hashed too
+    sums = np.add.reduceat(hashes, starts) if len(hashes) else hashes
+    return pd.Series(sums, index=trip_ids[codes[order][starts]], name="hash")
+
+
+def _trip_hashes(codes, starts, values):
+    # two independent 64 bit polynomial hashes of the rows of every trip,
+    # a collision of both for different trips is practically impossible
+    hashes = []
+    for seed in (0x9E3779B97F4A7C15, 0xC2B2AE3D27D4EB4F):
+        mixed = np.zeros(len(codes), np.uint64)
+        for column, value in enumerate(values):
+            weight = np.uint64((seed * (column + 1) * 2 + 1) % 2**64)
+            mixed = mixed * weight + value.astype(np.int64).view(np.uint64)
+        position = np.arange(len(codes)) - starts[codes]
+        weights = np.uint64(seed) ** (position.astype(np.uint64) + np.uint64(1))
+        with np.errstate(over="ignore"):
+            hashes.append(np.add.reduceat(mixed * weights, starts))
+    return hashes
+
+
+class CompressedTimetable:
+    """Stop times stored as stop patterns shared by the trips.
+
+    A trip is its pattern, its first departure and the few stops where its
+    times differ from the most common times of the pattern. Stop times are
+    only rebuilt for the trips asked for, columns other than
+    `STOP_TIMES_COLUMNS` are not kept.
+    """
+
+    def __init__(self, trip_ids, trip_patterns, trip_starts, patterns, deviations):
+        self.trip_ids = pd.Index(trip_ids)
+        self.trip_patterns = trip_patterns
+        self.trip_starts = trip_starts
+        # one row per stop of a pattern, with offsets to the first departure
+        self.patterns = patterns
+        self.pattern_starts = np.flatnonzero(
+            np.r_[True, np.diff(patterns["pattern_id"].to_numpy()) != 0]
+        )
+        self.pattern_lengths = np.diff(np.r_[self.pattern_starts, len(patterns)])
+        # trip (position), stop (position in the pattern) and the actual offsets
+        self.deviations = deviations
+
+    @classmethod
+    def from_stop_times(cls, stop_times):
+        # trips in the order they appear, their stops in sequence
+        codes, trip_ids = pd.factorize(stop_times["trip_id"])
+        order = np.lexsort((stop_times["stop_sequence"].to_numpy(), codes))
+        codes = codes[order]
+        rows = stop_times.iloc[order]
+        starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]])
+        lengths = np.diff(np.r_[starts, len(codes)])
+        position = np.arange(len(codes)) - np.repeat(starts, lengths)
+
+        arrival = time_to_seconds(rows["arrival_time"])
+        departure = time_to_seconds(rows["departure_time"])
+        first = np.where(
+            np.isnan(departure[starts]), arrival[starts], departure[starts]
+        )
+        trip_starts = np.nan_to_num(first).astype(np.int32)
+        arrival = arrival - np.repeat(trip_starts, lengths)
+        departure = departure - np.repeat(trip_starts, lengths)
+
+        stop_codes, _ = pd.factorize(rows["stop_id"])
+        pattern_values = [
+            lengths[codes],
+            stop_codes,
+            rows["stop_sequence"].to_numpy(),
+            rows["pickup_type"].fillna(-1).to_numpy(),
+            rows["drop_off_type"].fillna(-1).to_numpy(),
+        ]
+        trip_patterns, _ = pd.MultiIndex.from_arrays(
+            [lengths, *_trip_hashes(codes, starts, pattern_values)]
+        ).factorize()
+
+        # the most common times of a pattern are its reference times
+        timing_values = [
+            np.nan_to_num(arrival, nan=-1),
+            np.nan_to_num(departure, nan=-1),
+        ]
+        timings, _ = pd.MultiIndex.from_arrays(
+            [trip_patterns, *_trip_hashes(codes, starts, timing_values)]
+        ).factorize()
+        timing_counts = np.bincount(timings)
+        reference = (
+            pd.DataFrame(
+                {"pattern": trip_patterns, "count": timing_counts[timings]},
+            )
+            .sort_values("count", ascending=False, kind="stable")
+            .drop_duplicates("pattern")
+            .sort_values("pattern")
+            .index.to_numpy()
+        )
+
+        reference_lengths = lengths[reference]
+        reference_rows = np.repeat(starts[reference], reference_lengths) + (
+            np.arange(reference_lengths.sum())
+            - np.repeat(
+                np.cumsum(reference_lengths) - reference_lengths, reference_lengths
+            )
+        )
+        patterns = pd.DataFrame(
+            {
+                "pattern_id": np.repeat(
+                    np.arange(len(reference), dtype=np.int32), lengths[reference]
+                ),
+                **{
+                    column: rows[column].to_numpy()[reference_rows]
+                    for column in PATTERN_COLUMNS
+                },
+                "arrival_offset": arrival[reference_rows],
+                "departure_offset": departure[reference_rows],
+            }
+        )
+        patterns["stop_id"] = patterns["stop_id"].astype("category")
+
+        # compare every stop with the same stop of the reference trip
+        expected = starts[reference[trip_patterns]][codes] + position
+        deviating = ~(
+            _same(arrival, arrival[expected]) & _same(departure, departure[expected])
+        )
+        deviations = pd.DataFrame(
+            {
+                "trip": codes[deviating].astype(np.int32),
+                "position": position[deviating].astype(np.int32),
+                "arrival_offset": arrival[deviating],
+                "departure_offset": departure[deviating],
+            }
+        )
+        return cls(
+            trip_ids,
+            trip_patterns.astype(np.int32),
+            trip_starts,
+            patterns,
+            deviations,
+        )
+
+    def __len__(self):
+        return int(self.pattern_lengths[self.trip_patterns].sum())
+
+    def memory_usage(self):
+        return int(
+            self.trip_ids.memory_usage(deep=True)
+            + self.trip_patterns.nbytes
+            + self.trip_starts.nbytes
+            + self.patterns.memory_usage(deep=True).sum()
+            + self.deviations.memory_usage(deep=True).sum()
+        )
+
+    def trips_at(self, stop_ids):
+        """Ids of the trips which stop at any of `stop_ids`."""
+        pattern_ids = self.patterns.loc[
+            self.patterns["stop_id"].isin(stop_ids), "pattern_id"
+        ].unique()
+        return self.trip_ids[np.isin(self.trip_patterns, pattern_ids)]
+
+    def stop_times(self, trip_ids=None, times="text"):
+        """Rebuild the stop times of `trip_ids`, all trips if `None`.
+
+        `times` is `text` for HH:MM:SS arrival and departure times, `seconds`
+        for `arrival_time_parsed` and `departure_time_parsed` in seconds or
+        `None` to leave the times out.
+        """
+        if trip_ids is None:
+            trips = np.arange(len(self.trip_ids))
+        else:
+            trips = self.trip_ids.get_indexer(pd.unique(np.asarray(trip_ids)))
+            trips = np.sort(trips[trips >= 0])
+        patterns = self.trip_patterns[trips]
+        lengths = self.pattern_lengths[patterns]
+        starts = np.cumsum(lengths) - lengths
+        position = np.arange(lengths.sum()) - np.repeat(starts, lengths)
+        rows = self.patterns.iloc[
+            np.repeat(self.pattern_starts[patterns], lengths) + position
+        ]
+
+        stop_times = pd.DataFrame(
+            {
+                "trip_id": np.repeat(self.trip_ids.to_numpy()[trips], lengths),
+                "stop_id": rows["stop_id"].astype(object).to_numpy(),
+                **{
+                    column: rows[column].to_numpy()
+                    for column in PATTERN_COLUMNS
+                    if column != "stop_id"
+                },
+            }
+        )
+        if times is None:
+            return stop_times
+
+        arrival = rows["arrival_offset"].to_numpy().copy()
+        departure = rows["departure_offset"].to_numpy().copy()
+        deviations = self.deviations.loc[self.deviations["trip"].isin(trips)]
+        if len(deviations):
+            local = np.searchsorted(trips, deviations["trip"].to_numpy())
+            indices = starts[local] + deviations["position"].to_numpy()
+            arrival[indices] = deviations["arrival_offset"].to_numpy()
+            departure[indices] = deviations["departure_offset"].to_numpy()
+        trip_starts = np.repeat(self.trip_starts[trips], lengths)
+        arrival = arrival + trip_starts
+        departure = departure + trip_starts
+
+        if times == "seconds":
+            return stop_times.assign(
+                arrival_time_parsed=arrival, departure_time_parsed=departure
+            )
+        stop_times.insert(1, "arrival_time", seconds_to_time(arrival))
+        stop_times.insert(2, "departure_time", seconds_to_time(departure))
+        return stop_times
+
+
+def _same(left, right):
+    return (left == right) | (np.isnan(left) & np.isnan(right))
@@ -0,0 +1,250 @@
+import logging
+import os
+import threading
+import time
+import weakref
+
+import pandas as pd
+
+import core
+
+logger = logging.getLogger(__name__)
+
+TABLE_KEYS = {
+    "routes": ["route_id"],
+    "trips": ["trip_id"],
+    "stops": ["stop_id"],
+    "calendar": ["service_id"],
+    "calendar_dates": ["service_id", "date"],
+}
+WATCH_INTERVAL = 60
+
+
+def _row_hashes(table, keys, columns):
+    hashes = pd.util.hash_pandas_object(table[columns], index=False)
+    return pd.Series(hashes.to_numpy(), index=pd.MultiIndex.from_frame(table[keys]))
+
+
+def diff_table(old, new, keys):
+    """Keys of the added, removed and changed rows, rows are compared by hash."""
+    if old is None or new is None:
+        old = old if old is not None else pd.DataFrame(columns=keys)
+        new = new if new is not None else pd.DataFrame(columns=keys)
+    columns = sorted(set(old.columns) & set(new.columns))
+    old_hashes = _row_hashes(old, keys, columns)
+    new_hashes = _row_hashes(new, keys, columns)
+    common = old_hashes.index.intersection(new_hashes.index)
+    return {
+        "added": new_hashes.index.difference(old_hashes.index),
+        "removed": old_hashes.index.difference(new_hashes.index),
+        "changed": common[
+            old_hashes.loc[common].to_numpy() != new_hashes.loc[common].to_numpy()
+        ],
+    }
+
+
+def _changed_keys(diff):
+    # the first key of every added, removed or changed row
+    return set().union(*(set(keys.get_level_values(0)) for keys in diff.values()))
+
+
+class FeedUpdate:
+    """What changed between two feeds and which cached results stay valid."""
+
+    def __init__(self, old, new):
+        self.tables = {
+            name: diff_table(getattr(old, name), getattr(new, name), keys)
+            for name, keys in TABLE_KEYS.items()
+        }
+        old_trips, new_trips = core.trip_hashes(old), core.trip_hashes(new)
+        common = old_trips.index.intersection(new_trips.index)
+        changed_trips = (
+            set(old_trips.index.symmetric_difference(new_trips.index))
+            | set(common[old_trips[common].to_numpy() != new_trips[common].to_numpy()])
+            | _changed_keys(self.tables["trips"])
+        )
+        self.changed_trips = changed_trips
+        changed_services = _changed_keys(self.tables["calendar"]) | _changed_keys(
+            self.tables["calendar_dates"]
+        )
+        changed_stops = _changed_keys(self.tables["stops"])
+
+        self.affected_routes = _changed_keys(self.tables["routes"])
+        for feed in (old, new):
+            trips = feed.trips
+            touched = trips.loc[
+                trips["trip_id"].isin(changed_trips)
+                | trips["service_id"].isin(changed_services)
+                | trips["trip_id"].isin(core.trips_at_stops(feed, list(changed_stops)))
+            ]
+            self.affected_routes |= set(touched["route_id"])
+
+        # every station on an affected route, results of other stations are kept
+        self.affected_stations = set()
+        for feed in (old, new):
+            trip_ids = feed.trips.loc[
+                feed.trips["route_id"].isin(self.affected_routes), "trip_id"
+            ]
+            stop_ids = core.stop_times_of(feed, trip_ids, times=None)["stop_id"]
+            self.affected_stations |= _stations(feed, set(stop_ids) | changed_stops)
+
+        old_stations = core.parse_stations(old).reset_index(drop=True)
+        new_stations = core.parse_stations(new).reset_index(drop=True)
+        self.stations_changed = not old_stations.equals(new_stations)
+
+    def keeps_result(self, key):
+        # keys of core.cached, (function name, feed version, *arguments)
+        name, _, *args = key
+        if name in ("parse_stations", "station_index", "station_grid"):
+            return not self.stations_changed
+        if name == "get_routes":
+            return args[0] not in self.affected_stations
+        if name == "get_stops":
+            return self.affected_routes.isdisjoint(args[0])
+        return False
+
+    def keeps_layer(self, key):
+        # keys of rendering.layer_key, (feed version, station id, ...)
+        return key[1] not in self.affected_stations
+
+    def summary(self):
+        return {
+            "tables": {
+                name: {kind: len(keys) for kind, keys in diff.items()}
+                for name, diff in self.tables.items()
+            },
+            "changed_trips": len(self.changed_trips),
+            "affected_routes": len(self.affected_routes),
+            "affected_stations": len(self.affected_stations),
+            "stations_changed": self.stations_changed,
+        }
+
+
+def _stations(feed, stop_ids):
+    stops = feed.stops.loc[feed.stops["stop_id"].isin(stop_ids)]
+    return set(stops["parent_station"].dropna()) | set(
+        stops.loc[stops["parent_station"].isna(), "stop_id"]
+    )
+
+
+def carry_over(cache, old_version, new_version, keep):
+    """Move the cached results `keep` accepts to the new feed version.
+
+    The results of the old version are dropped, caches without `keys` and
+    `pop` are left alone.
+    """
+    if not hasattr(cache, "keys") or not hasattr(cache, "pop"):
+        return 0
+    kept = 0
+    for key in cache.keys():
+        if not isinstance(key, tuple) or old_version not in key:
+            continue
+        value = cache.pop(key)
+        if value is not None and keep(key):
+            cache.set(
+                tuple(new_version if part == old_version else part for part in key),
+                value,
+            )
+            kept += 1
+    return kept
+
+
+def _remove_artifacts(path, version):
+    try:
+        core.remove_artifacts(path, version)
+        logger.info("removed the files of %s", version)
+    except OSError:
+        logger.warning("could not remove the files of %s", version, exc_info=True)
+
+
+class LiveFeed:
+    """The current feed, swapped for a new one when the feed file changes.
+
+    `caches` are `(cache, keep)` pairs besides the core cache, `keep` is
+    called with the `FeedUpdate` and a cache key. `version` has to give the
+    version `load` will, the listeners are called with the new feed and the
+    `FeedUpdate` after a swap.
+    """
+
+    def __init__(
+        self,
+        path=core.FEED_PATH,
+        caches=(),
+        load=core.load_feed,
+        version=core.path_version,
+    ):
+        self.path = path
+        self.load = load
+        self.version = version
+        self.caches = [(core.get_cache(), FeedUpdate.keeps_result), *caches]
+        self.listeners = []
+        self.feed = load(path)
+        self.last_update = None
+        self._stat = self._file_stat()
+        self._lock = threading.Lock()
+
+    def _file_stat(self):
+        stat = os.stat(self.path)
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def update(self):
+        """Load the feed file again and swap it in if its content changed."""
+        with self._lock:
+            self._stat = self._file_stat()
+            start = time.perf_counter()
+            old = self.feed
+            # a touched file is not loaded, a lazy feed would start loading
+            if self.version(self.path) == core.feed_version(old):
+                return None
+            new = self.load(self.path)
+            if core.feed_version(new) == core.feed_version(old):
+                return None
+            update = FeedUpdate(old, new)
+            kept = sum(
+                carry_over(
+                    cache,
+                    core.feed_version(old),
+                    core.feed_version(new),
+                    lambda key, keep=keep: keep(update, key),
+                )
+                for cache, keep in self.caches
+            )
+            # readers get either the old or the new feed, never a mix
+            self.feed = new
+            self.last_update = update.summary() | {
+                "version": core.feed_version(new),
+                "kept_results": kept,
+                "seconds": time.perf_counter() - start,
+            }
+            logger.info("feed updated: %s", self.last_update)
+            self._remove_when_unused(old)
+            for listener in self.listeners:
+                listener(new, update)
+            return update
+
+    def _remove_when_unused(self, feed):
+        # reruns, prefetch jobs, the warmer and pipeline threads can still query
+        # the old feed and open its files, they go once it is garbage collected
+        version = core.feed_version(feed)
+        # feeds which were not loaded from the file have no artifacts
+        if not isinstance(version, str):
+            return
+        loaded = feed.feed if isinstance(feed, core.LazyFeed) else feed
+        weakref.finalize(loaded, _remove_artifacts, self.path, version)
+
+    def check(self):
+        if self._file_stat() != self._stat:
+            return self.update()
+        return None
+
+    def watch(self, interval=WATCH_INTERVAL):
+        def run():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.check()
+                except Exception:
+                    logger.exception("updating the feed from %s failed", self.path)
+
+        threading.Thread(target=run, name="feed-watcher", daemon=True).start()
+        return self
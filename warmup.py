@@ -0,0 +1,162 @@
+import atexit
+import json
+import logging
+import os
+import threading
+import time
+from collections import Counter
+from functools import partial
+from pathlib import Path
+
+import core
+from rendering import DESTINATION_STYLES, draw_destination_layers, layer_key
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_STATIONS = ["Zürich HB", "Bern", "Basel SBB", "Luzern"]
+# the default filters of the dashboard
+DEFAULT_PROFILES = [(core.WEEKDAYS[:5], (6, 22))]
+MAX_STATIONS = 8
+USAGE_PATH = ".usage.json"
+USAGE_SAVE_INTERVAL = 60
+
+
+class UsageCounter:
+    """Counts selected stations and keeps them on disk for the next start."""
+
+    def __init__(self, path=USAGE_PATH):
+        self.path = Path(path)
+        self.counts = Counter()
+        if self.path.exists():
+            self.counts.update(json.loads(self.path.read_text()))
+        self._lock = threading.Lock()
+        self._saved_at = time.monotonic()
+        atexit.register(self.save)
+
+    def record(self, station_id):
+        with self._lock:
+            self.counts[station_id] += 1
+            if time.monotonic() - self._saved_at > USAGE_SAVE_INTERVAL:
+                self._save()
+
+    def save(self):
+        # also called at exit, while a session thread can still record
+        with self._lock:
+            self._save()
+
+    def _save(self):
+        # a full disk or a read only directory only loses the counts
+        try:
+            self.path.write_text(json.dumps(self.counts))
+        except OSError:
+            logger.warning("could not write %s", self.path, exc_info=True)
+        self._saved_at = time.monotonic()
+
+    def top(self, count):
+        return [station_id for station_id, _ in self.counts.most_common(count)]
+
+
+def warmup_stations(index, usage=None, limit=MAX_STATIONS):
+    """Station ids to warm, configured or the most used ones plus the big hubs.
+
+    `COMMUTE_WARMUP_STATIONS` takes station names or ids separated by `;`.
+    """
+    configured = os.environ.get("COMMUTE_WARMUP_STATIONS")
+    if configured:
+        names = [name.strip() for name in configured.split(";") if name.strip()]
+    else:
+        names = (usage.top(limit) if usage else []) + DEFAULT_STATIONS
+
+    station_ids = []
+    for name in names:
+        station_id = index.resolve(name)
+        if station_id is not None and station_id not in station_ids:
+            station_ids.append(station_id)
+    return station_ids[:limit]
+
+
+class CacheWarmer:
+    """Computes routes, stops and map layers of popular stations in the background."""
+
+    def __init__(self, feed, station_ids, layer_cache, profiles=DEFAULT_PROFILES):
+        self.feed = feed
+        self.station_ids = station_ids
+        self.layer_cache = layer_cache
+        self.profiles = profiles
+        self.done = 0
+        self.errors = 0
+        self.current = None
+        self.started_at = None
+        self.finished_at = None
+
+    @property
+    def total(self):
+        return len(self.station_ids) * len(self.profiles)
+
+    def start(self):
+        threading.Thread(target=self.run, name="cache-warmer", daemon=True).start()
+        return self
+
+    def run(self):
+        self.started_at = time.monotonic()
+        for station_id in self.station_ids:
+            for active_days, relevant_hours in self.profiles:
+                self.current = station_id
+                try:
+                    self.warm(station_id, active_days, relevant_hours)
+                except Exception:
+                    self.errors += 1
+                    logger.exception("warming %s failed", station_id)
+                self.done += 1
+                logger.info("warmed %s (%d/%d)", station_id, self.done, self.total)
+        self.current = None
+        self.finished_at = time.monotonic()
+
+    def set_feed(self, feed):
+        """Warm `feed` from now on, a finished warm-up runs again for it.
+
+        Results of stations an update did not touch were carried over, only
+        the others are computed again.
+        """
+        self.feed = feed
+        if self.finished_at is not None:
+            self.done = 0
+            self.errors = 0
+            self.finished_at = None
+            self.start()
+
+    def warm(self, station_id, active_days, relevant_hours):
+        # the feed can be swapped in the middle of a station
+        feed = self.feed
+        routes = core.get_routes(feed, station_id)
+        stops = core.get_stops(feed, routes["route_id"], active_days, relevant_hours)
+        key = partial(
+            layer_key,
+            core.feed_version(feed),
+            station_id,
+            active_days,
+            relevant_hours,
+            [],
+        )
+        # the station can be picked as destination A or B
+        for color, palette in DESTINATION_STYLES:
+            draw_destination_layers(self.layer_cache, key, stops, color, palette)
+
+    def status(self):
+        if self.finished_at is not None:
+            state = "done"
+        elif self.started_at is not None:
+            state = "running"
+        else:
+            state = "idle"
+        end = self.finished_at or time.monotonic()
+        return {
+            "state": state,
+            "done": self.done,
+            "total": self.total,
+            "errors": self.errors,
+            "current": self.current,
+            "seconds": end - self.started_at if self.started_at else 0,
+            "query_cache": core.get_cache().stats(),
+            "layer_cache": self.layer_cache.stats(),
+        }